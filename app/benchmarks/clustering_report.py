@@ -0,0 +1,106 @@
+'''
+Compare approximate clustering (through the IVF index) with exact clustering on a
+sample of a corpus: time, number of clusters and how cluster assignments changed,
+for several nprobe values.
+
+    python -m benchmarks.clustering_report                        # synthetic corpus, stub encoder
+    python -m benchmarks.clustering_report --size 200000 --sample 30000 --nprobe 5 10 20
+    python -m benchmarks.clustering_report --dataset "Some video.parquet"
+
+Run it from the app directory. A synthetic corpus is embedded with the stub encoder
+in a scratch directory; --dataset uses a dataset of the app and its real encoder.
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.append('modules')
+
+from modules.constants import *
+from modules.clustering import cluster_maker
+from modules.embeddings import embedding_store
+from modules.retrieval import ann_index
+from . import stub_encoder, synthetic_corpus
+from .quantization_report import compare_clusters
+
+DEFAULT_NPROBES = [5, 10, 20]
+
+
+def compare_modes(embeddings, sample_size, nprobes=DEFAULT_NPROBES, seed=0):
+    '''
+    To cluster a random sample of the embeddings exactly, then approximately with every nprobe.
+    Returns one record per mode, exact first.
+    '''
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(embeddings), size=min(sample_size, len(embeddings)), replace=False))
+    vectors = np.asarray(embeddings[sample], dtype=np.float32)
+    block_size = DETECTION_BLOCK_SIZE if len(vectors) > BLOCKED_DETECTION_MIN_SIZE else None
+
+    start = time.perf_counter()
+    reference = cluster_maker._detect_clusters(vectors, block_size=block_size)
+    records = [{'mode': 'exact', 'seconds': time.perf_counter() - start, 'clusters': len(reference),
+                'clustered': sum(len(cluster) for cluster in reference), 'adjusted_rand_index': 1.0, 'moved_comments': 0.0}]
+
+    start = time.perf_counter()
+    index = ann_index.build_index(vectors)
+    index_seconds = time.perf_counter() - start
+
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        clusters = cluster_maker._detect_clusters(vectors, index=index, nprobe=nprobe)
+        record = {'mode': f'nprobe={nprobe}', 'seconds': time.perf_counter() - start + index_seconds, 'clusters': len(clusters),
+                  'clustered': sum(len(cluster) for cluster in clusters)}
+        record.update(compare_clusters(reference, clusters, len(vectors)))
+        records.append(record)
+
+    return records
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compare approximate clustering with exact clustering on a sample.')
+    parser.add_argument('--size', type=int, default=50000, help='number of comments of the synthetic corpus')
+    parser.add_argument('--sample', type=int, default=20000, help='comments clustered both ways')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=DEFAULT_NPROBES, help='lists each list is compared with')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dataset', help='dataset of the app to use instead of a synthetic corpus')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    app_path = os.getcwd()
+    work_path = None
+    if args.dataset:
+        filename = args.dataset
+    else:
+        stub_encoder.register()
+        work_path = tempfile.mkdtemp(prefix='moodmap_clustering_')
+        os.makedirs(os.path.join(work_path, 'data'))
+        os.chdir(work_path)
+        filename = synthetic_corpus.write_dataset(args.size, args.seed)
+
+    try:
+        _, long_comments_list, _ = cluster_maker.load_data(filename)
+        embeddings = embedding_store.get_embeddings(long_comments_list, filename)
+        records = compare_modes(embeddings, args.sample, args.nprobe, args.seed)
+    finally:
+        os.chdir(app_path)
+        if work_path:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    print(f"Sample of {min(args.sample, len(long_comments_list))} of the {len(long_comments_list)} comments of {filename}:")
+    print(f"  {'mode':<12}{'seconds':>9}{'clusters':>10}{'clustered':>11}{'ARI':>8}{'moved':>8}")
+    for record in records:
+        print(f"  {record['mode']:<12}{record['seconds']:9.2f}{record['clusters']:10d}{record['clustered']:11d}"
+              f"{record['adjusted_rand_index']:8.3f}{record['moved_comments']:8.1%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+'''
+Compare clustering and retrieval on float32 embeddings with their float16 and int8
+forms: memory used, time, cluster assignments and recall@10 of exact search.
+
+    python -m benchmarks.quantization_report                      # synthetic corpus, stub encoder
+    python -m benchmarks.quantization_report --size 50000
+    python -m benchmarks.quantization_report --dataset "Some video.parquet"
+
+Run it from the app directory. A synthetic corpus is embedded with the stub encoder
+in a scratch directory; --dataset uses a dataset of the app and its real encoder.
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+sys.path.append('modules')
+
+from modules.constants import *
+from modules.clustering import cluster_maker
+from modules.embeddings import embedding_store, quantization
+from modules.retrieval import ann_index
+from . import stub_encoder, synthetic_corpus
+
+NUM_QUERIES = 200
+
+
+def _get_labels(clusters, num_items):
+    labels = np.full(num_items, -1)
+    for label, cluster in enumerate(clusters):
+        labels[cluster] = label
+    return labels
+
+
+def compare_clusters(reference, clusters, num_items):
+    '''
+    To compare clusters with reference clusters of the same comments: the adjusted Rand
+    index of the assignments (unclustered comments form one group), and the share of
+    comments clustered in either that moved, once every cluster is matched with the
+    reference cluster holding most of its comments
+    '''
+    reference_labels = _get_labels(reference, num_items)
+    labels = _get_labels(clusters, num_items)
+
+    matched = np.full(num_items, -1)
+    for cluster in clusters:
+        matched[cluster] = np.bincount(reference_labels[cluster] + 1).argmax() - 1
+
+    clustered = (reference_labels >= 0) | (labels >= 0)
+    moved = np.count_nonzero(matched[clustered] != reference_labels[clustered]) / max(1, np.count_nonzero(clustered))
+    return {'adjusted_rand_index': float(adjusted_rand_score(reference_labels, labels)), 'moved_comments': moved}
+
+
+def measure_recall(reference_hits, hits, reference_embeddings, queries):
+    '''
+    To get the share of the reference hits found, over every query.
+    Corpora have many duplicate and near-duplicate comments, so a hit scoring as high
+    as the last reference hit with the reference embeddings counts as found.
+    '''
+    queries = ann_index._normalize(queries)
+    found = 0
+    for query, query_hits, query_reference_hits in zip(queries, hits, reference_hits):
+        if not query_hits:
+            continue
+        ids = [hit['corpus_id'] for hit in query_hits]
+        scores = ann_index._normalize(reference_embeddings[ids]) @ query
+        found += min(len(query_reference_hits), np.count_nonzero(scores >= query_reference_hits[-1]['score'] - 1e-6))
+    total = sum(len(r) for r in reference_hits)
+    return found / total if total else 1.0
+
+
+def compare_dtypes(comments_list, filename, dtypes=quantization.QUANTIZED_DTYPES, num_queries=NUM_QUERIES, seed=0):
+    '''
+    To cluster and search the comments with float32 embeddings and with every dtype.
+    Returns one record per dtype, float32 first.
+    '''
+    block_size = DETECTION_BLOCK_SIZE if len(comments_list) > BLOCKED_DETECTION_MIN_SIZE else None
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(comments_list), size=min(num_queries, len(comments_list)), replace=False))
+
+    records = []
+    reference = None
+    for dtype in ('float32', *dtypes):
+        embeddings = embedding_store.get_embeddings(comments_list, filename, dtype=dtype)
+        if reference is None:
+            queries = np.asarray(embeddings[sample], dtype=np.float32)
+
+        start = time.perf_counter()
+        clusters = cluster_maker._detect_clusters(embeddings, block_size=block_size)
+        cluster_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        hits = ann_index.exact_search(embeddings, queries)
+        search_seconds = time.perf_counter() - start
+
+        record = {'dtype': dtype,
+                  'megabytes': embeddings.nbytes / 1024 ** 2,
+                  'cluster_seconds': cluster_seconds,
+                  'search_seconds': search_seconds,
+                  'clusters': len(clusters)}
+        if reference is None:
+            reference = {'megabytes': record['megabytes'], 'clusters': clusters, 'hits': hits, 'embeddings': embeddings}
+        record['saved_megabytes'] = reference['megabytes'] - record['megabytes']
+        record.update(compare_clusters(reference['clusters'], clusters, len(comments_list)))
+        record['recall_at_10'] = measure_recall(reference['hits'], hits, reference['embeddings'], queries)
+        records.append(record)
+
+    return records
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Compare clustering and retrieval on quantized embeddings.')
+    parser.add_argument('--size', type=int, default=10000, help='number of comments of the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dataset', help='dataset of the app to use instead of a synthetic corpus')
+    parser.add_argument('--queries', type=int, default=NUM_QUERIES, help='corpus comments used as queries')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    app_path = os.getcwd()
+    work_path = None
+    if args.dataset:
+        filename = args.dataset
+    else:
+        stub_encoder.register()
+        work_path = tempfile.mkdtemp(prefix='moodmap_quantization_')
+        os.makedirs(os.path.join(work_path, 'data'))
+        os.chdir(work_path)
+        filename = synthetic_corpus.write_dataset(args.size, args.seed)
+
+    try:
+        _, long_comments_list, _ = cluster_maker.load_data(filename)
+        records = compare_dtypes(long_comments_list, filename, num_queries=args.queries, seed=args.seed)
+    finally:
+        os.chdir(app_path)
+        if work_path:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    print(f"{len(long_comments_list)} comments of {filename}:")
+    print(f"  {'dtype':<9}{'MB':>9}{'saved MB':>10}{'cluster s':>11}{'search s':>10}{'clusters':>10}{'ARI':>8}{'moved':>8}{'recall@10':>11}")
+    for record in records:
+        print(f"  {record['dtype']:<9}{record['megabytes']:9.1f}{record['saved_megabytes']:10.1f}{record['cluster_seconds']:11.2f}"
+              f"{record['search_seconds']:10.3f}{record['clusters']:10d}{record['adjusted_rand_index']:8.3f}"
+              f"{record['moved_comments']:8.1%}{record['recall_at_10']:11.3f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+'''
+Time the analysis steps on synthetic datasets, with stub models so no model is
+downloaded:
+
+    python -m benchmarks.run_benchmarks                       # 1k, 10k and 50k comments
+    python -m benchmarks.run_benchmarks --sizes 1000 200000 --repeat 3
+
+Run it from the app directory. Every run works in a scratch directory, so the caches
+of the app are not touched, and appends one record per dataset size to
+data/benchmarks/history.jsonl. Steps slower than in the previous record of the same size
+on the same machine are reported as regressions.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+sys.path.append('modules')
+
+from modules.constants import *
+from modules.clustering import cluster_maker
+from modules.embeddings import embedding_store
+from modules.emojitask import emoji_extractor
+from modules.retrieval import relevant_comments
+from modules.sentiment import sentiment_engine
+from modules.terms import term_index
+from modules.pipeline import batch_pipeline
+from . import stub_encoder, synthetic_corpus
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+PATH_TO_HISTORY = os.path.join(PATH_TO_DATA, 'benchmarks', 'history.jsonl')
+
+DEFAULT_SIZES = [1000, 10000, 50000]
+
+NUM_QUERIES = 20
+
+
+def _get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_PATH,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def _time(timings, name, function, repeat=1):
+    '''
+    To run a step repeat times, keeping its fastest time, and get its last result
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    timings[name] = best
+    return result
+
+
+def benchmark_dataset(num_comments, seed=0, repeat=1):
+    '''
+    To time every step on a synthetic dataset of num_comments comments.
+    Must run in a scratch working directory, the steps store their caches under ./data.
+    '''
+    timings = {}
+    filename = _time(timings, 'generate', lambda: synthetic_corpus.write_dataset(num_comments, seed))
+
+    short_comments_list, long_comments_list, df = _time(timings, 'load_data', lambda: cluster_maker.load_data(filename), repeat)
+    comment_ids = df['Comment ID'].astype(str).tolist()
+
+    embeddings = _time(timings, 'embedding', lambda: embedding_store.get_embeddings(long_comments_list, filename, comment_ids=comment_ids))
+    _time(timings, 'embedding_cached', lambda: embedding_store.get_embeddings(long_comments_list, filename, comment_ids=comment_ids), repeat)
+
+    block_size = DETECTION_BLOCK_SIZE if len(embeddings) > BLOCKED_DETECTION_MIN_SIZE else None
+    clusters = _time(timings, 'detect_clusters', lambda: cluster_maker._detect_clusters(embeddings, block_size=block_size), repeat)
+
+    # Queries are made of words of random comments, so that they have related comments
+    rng = np.random.default_rng(seed)
+    queries = [' '.join(long_comments_list[i].split()[:4]) for i in rng.choice(len(long_comments_list), size=NUM_QUERIES)]
+    _time(timings, 'retrieval', lambda: relevant_comments.get_relevant_comments_batch(queries, filename, long_comments_list, comment_ids=comment_ids), repeat)
+
+    # The emoji regexes are compiled once per process, not on every call
+    emoji_extractor.count_emojis([])
+    top_emojis = _time(timings, 'most_freq_emojis', lambda: emoji_extractor.get_most_freq_emojis(short_comments_list, 10), repeat)
+
+    terms = _time(timings, 'term_index', lambda: term_index.build_index(long_comments_list), repeat)
+
+    def score_sentiment():
+        sentiment_engine.clear()
+        return sentiment_engine.score_comments(long_comments_list)
+    _time(timings, 'sentiment', score_sentiment)
+
+    _time(timings, 'statistics', lambda: batch_pipeline.get_statistics(df, long_comments_list, terms), repeat)
+
+    return {'size': num_comments,
+            'seed': seed,
+            'timings': timings,
+            'counts': {'long_comments': len(long_comments_list),
+                       'clusters': len(clusters),
+                       'top_emojis': len(top_emojis),
+                       'vocabulary': len(terms['word_vocabulary'])}}
+
+
+def _load_history(history_path):
+    if not os.path.isfile(history_path):
+        return []
+    with open(history_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(record, history, tolerance):
+    '''
+    To get the steps slower than in the last record of the same size from the same
+    machine, by more than tolerance (0.25 is 25% slower)
+    '''
+    previous = [old for old in history if old['size'] == record['size'] and old['machine'] == record['machine']]
+    if not previous:
+        return []
+
+    regressions = []
+    for step, seconds in record['timings'].items():
+        old_seconds = previous[-1]['timings'].get(step)
+        # Steps faster than 10ms are too noisy to compare
+        if old_seconds and max(seconds, old_seconds) >= 0.01 and seconds > old_seconds * (1 + tolerance):
+            regressions.append({'step': step, 'seconds': seconds, 'previous_seconds': old_seconds, 'previous_commit': previous[-1]['commit']})
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Time the analysis steps on synthetic datasets.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES, help='numbers of comments of the datasets (1000 to 200000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='runs of every step, the fastest is kept')
+    parser.add_argument('--history', default=PATH_TO_HISTORY, help='JSON lines file the results are appended to')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown reported as a regression')
+    parser.add_argument('--no-history', action='store_true', help='do not record the results')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    history_path = os.path.abspath(args.history)
+    history = _load_history(history_path)
+    stub_encoder.register()
+
+    work_path = tempfile.mkdtemp(prefix='moodmap_benchmarks_')
+    app_path = os.getcwd()
+    os.makedirs(os.path.join(work_path, 'data'))
+    os.chdir(work_path)
+
+    found_regressions = False
+    try:
+        for num_comments in args.sizes:
+            record = benchmark_dataset(num_comments, args.seed, args.repeat)
+            record.update({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           'commit': _get_commit(),
+                           'machine': platform.node(),
+                           'python': platform.python_version(),
+                           'cpus': os.cpu_count(),
+                           'encoder': 'stub'})
+
+            print(f"{num_comments} comments:")
+            for step, seconds in record['timings'].items():
+                print(f"  {step:<18}{seconds:10.3f}s")
+
+            regressions = find_regressions(record, history, args.tolerance)
+            for regression in regressions:
+                print(f"  REGRESSION {regression['step']}: {regression['seconds']:.3f}s, was {regression['previous_seconds']:.3f}s at {regression['previous_commit']}")
+            found_regressions = found_regressions or bool(regressions)
+
+            if not args.no_history:
+                os.makedirs(os.path.dirname(history_path), exist_ok=True)
+                with open(history_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + '\n')
+                history.append(record)
+    finally:
+        os.chdir(app_path)
+        if args.keep:
+            print(f"Scratch directory kept at {work_path}")
+        else:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    return 1 if found_regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
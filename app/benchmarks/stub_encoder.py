@@ -0,0 +1,46 @@
+'''
+Deterministic offline stand-ins for the sentence encoder and the cross-encoder, so
+benchmarks run without downloading models.
+The encoder hashes the words of a comment into a fixed-size vector, so comments
+sharing words are similar, and the cross-encoder scores the words shared by the
+query and the comment.
+'''
+
+import numpy as np
+import torch
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from modules.constants import *
+from modules.models import model_registry
+
+# Same size as the embeddings of the real encoder
+EMBEDDING_SIZE = 768
+
+
+class StubEncoder:
+    def __init__(self, embedding_size=EMBEDDING_SIZE):
+        self.vectorizer = HashingVectorizer(n_features=embedding_size, ngram_range=(1, 2), norm='l2')
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=None, convert_to_numpy=True, convert_to_tensor=False, **kwargs):
+        single = isinstance(sentences, str)
+        embeddings = self.vectorizer.transform([sentences] if single else list(sentences)).toarray().astype(np.float32)
+        if single:
+            embeddings = embeddings[0]
+        return torch.from_numpy(embeddings) if convert_to_tensor else embeddings
+
+
+class StubCrossEncoder:
+    def predict(self, sentence_pairs, batch_size=32, show_progress_bar=None, **kwargs):
+        scores = []
+        for query, comment in sentence_pairs:
+            query_words = set(query.lower().split())
+            scores.append(len(query_words & set(comment.lower().split())) / max(len(query_words), 1))
+        return np.array(scores, dtype=np.float32)
+
+
+def register():
+    '''
+    To put the stub models in the model registry under the names of the real ones
+    '''
+    model_registry.register_model(StubEncoder(), ENCODER_MODEL_NAME)
+    model_registry.register_model(StubCrossEncoder(), CROSS_ENCODER_MODEL_NAME, kind=model_registry.CROSS_ENCODER)
@@ -0,0 +1,103 @@
+'''
+Local HTTP server standing in for the YouTube Data API, replaying pages recorded
+by the asyncio client (AsyncYouTubeClient(record_path=...)) or written by
+record_synthetic_video. It can delay every response and answer the first requests
+with errors, to exercise the retries of the client:
+
+    server, base_url = start_server(record_path, latency=0.05, failures=[429, 503])
+    ... AsyncYouTubeClient(api_key, base_url=base_url) ...
+    server.shutdown()
+'''
+
+import os
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+from modules.commentsextractor.async_client import get_record_key
+
+
+def _get_error_body(status):
+    reason = {403: 'rateLimitExceeded', 429: 'rateLimitExceeded'}.get(status, 'backendError')
+    return json.dumps({'error': {'code': status, 'message': 'Injected error', 'errors': [{'reason': reason}]}}).encode('utf-8')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        resource = url.path.rstrip('/').split('/')[-1]
+        params = dict(parse_qsl(url.query))
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            server.num_requests += 1
+            status = server.failures.pop(0) if server.failures else 200
+
+        path = os.path.join(server.record_path, f'{get_record_key(resource, params)}.json')
+        if status == 200 and not os.path.isfile(path):
+            status = 404
+
+        if status == 200:
+            with open(path, 'rb') as f:
+                body = f.read()
+        else:
+            body = _get_error_body(status)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(record_path, port=0, latency=0.0, failures=()):
+    '''
+    To serve the recorded pages from a background thread.
+    failures are the statuses returned to the first requests, one each.
+    Returns the server and the base URL to give to the client.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.record_path = record_path
+    server.latency = latency
+    server.failures = list(failures)
+    server.num_requests = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/youtube/v3'
+
+
+def _write_page(record_path, resource, params, response):
+    with open(os.path.join(record_path, f'{get_record_key(resource, params)}.json'), 'w', encoding='utf-8') as f:
+        json.dump(response, f, ensure_ascii=False)
+
+
+def record_synthetic_video(record_path, video_ID, title, comments, page_size=100, order=None):
+    '''
+    To write the pages the client would get for a video with the given comments
+    '''
+    os.makedirs(record_path, exist_ok=True)
+    _write_page(record_path, 'videos', {'part': 'snippet', 'id': video_ID}, {'items': [{'snippet': {'title': title}}]})
+
+    num_pages = max(1, -(-len(comments) // page_size))
+    for page in range(num_pages):
+        params = {'part': 'snippet', 'videoId': video_ID, 'textFormat': 'plainText', 'maxResults': 100}
+        if page:
+            params['pageToken'] = f'page{page}'
+        if order:
+            params['order'] = order
+
+        items = [{'snippet': {'topLevelComment': {'id': f'{video_ID}-{page * page_size + i}',
+                                                  'snippet': {'authorDisplayName': f'user{i}', 'textDisplay': comment, 'likeCount': i}}}}
+                 for i, comment in enumerate(comments[page * page_size:(page + 1) * page_size])]
+        response = {'items': items}
+        if page + 1 < num_pages:
+            response['nextPageToken'] = f'page{page + 1}'
+        _write_page(record_path, 'commentThreads', params, response)
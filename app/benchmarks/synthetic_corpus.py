@@ -0,0 +1,100 @@
+'''
+Synthetic comment datasets for benchmarks.
+Comments are drawn around a set of topics, with a long-tailed length distribution,
+emojis (including skin tones, ZWJ sequences, flags and keycaps) on some of them and
+repeated comments, roughly like the comments of a popular video.
+The same size and seed always give the same dataset.
+'''
+
+import os
+import numpy as np
+import pandas as pd
+
+from modules.constants import *
+from modules.datasets import dataset_store
+
+NUM_TOPICS = 40
+
+# Words shared by every topic, and words specific to each topic
+COMMON_WORDS = ('the this that is was so and i you it of to a in for my he she they we just really '
+                'video song part love like best one time when who what why how still never always').split()
+
+TOPIC_WORDS_PER_TOPIC = 30
+
+EMOJIS = ['😂', '❤️', '😭', '🔥', '👍', '🤣', '🙏', '😍', '💀', '🥺', '👍🏽', '🙏🏻', '👏🏾',
+          '👨‍👩‍👧‍👦', '🏳️‍🌈', '❤️‍🔥', '🇺🇸', '🇬🇧', '1️⃣', '✨']
+
+SHORT_COMMENTS = ['first!', 'lol', 'W video', 'nice', 'who is here in 2024', 'ok', 'love this', 'so good']
+
+# Share of comments with emojis, of repeated comments and of comments shorter than 23 characters
+EMOJI_RATE = 0.2
+
+DUPLICATE_RATE = 0.08
+
+SHORT_RATE = 0.15
+
+
+def _get_topic_words(rng):
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    return [[''.join(rng.choice(letters, size=rng.integers(3, 10))) for _ in range(TOPIC_WORDS_PER_TOPIC)]
+            for _ in range(NUM_TOPICS)]
+
+
+def generate_comments(num_comments, seed=0):
+    '''
+    To get num_comments synthetic comments
+    '''
+    rng = np.random.default_rng(seed)
+    topic_words = _get_topic_words(rng)
+
+    # Topic popularity and emoji use follow Zipf-like distributions
+    topic_weights = 1 / np.arange(1, NUM_TOPICS + 1)
+    topic_weights /= topic_weights.sum()
+    emoji_weights = 1 / np.arange(1, len(EMOJIS) + 1)
+    emoji_weights /= emoji_weights.sum()
+
+    # Lengths in words are log-normal: mostly a sentence, sometimes a paragraph
+    num_words = np.clip(rng.lognormal(mean=2.4, sigma=0.8, size=num_comments).astype(int), 4, 300)
+    topics = rng.choice(NUM_TOPICS, size=num_comments, p=topic_weights)
+    kinds = rng.random(num_comments)
+
+    comments = []
+    for i in range(num_comments):
+        if kinds[i] < DUPLICATE_RATE and comments:
+            # Repeated comments favour the earliest ones, like copied top comments
+            comments.append(comments[int(rng.integers(0, max(1, min(len(comments), 50))))])
+            continue
+        if kinds[i] < DUPLICATE_RATE + SHORT_RATE:
+            comments.append(SHORT_COMMENTS[int(rng.integers(0, len(SHORT_COMMENTS)))])
+            continue
+
+        is_topic_word = rng.random(num_words[i]) < 0.4
+        words = [topic_words[topics[i]][int(rng.integers(0, TOPIC_WORDS_PER_TOPIC))] if topic_word
+                 else COMMON_WORDS[int(rng.integers(0, len(COMMON_WORDS)))]
+                 for topic_word in is_topic_word]
+        comment = ' '.join(words)
+        if rng.random() < EMOJI_RATE:
+            comment += ' ' + ''.join(rng.choice(EMOJIS, size=int(rng.integers(1, 4)), p=emoji_weights))
+        comments.append(comment)
+
+    return comments
+
+
+def generate_dataset(num_comments, seed=0):
+    '''
+    To get a synthetic dataset with the columns of a fetched video
+    '''
+    rng = np.random.default_rng(seed + 1)
+    return pd.DataFrame({COLUMN_COMMENT: generate_comments(num_comments, seed),
+                         'Author': [f'user{author}' for author in rng.zipf(1.3, size=num_comments) % (num_comments // 2 + 1)],
+                         'Comment ID': [f'synthetic{seed}-{i}' for i in range(num_comments)],
+                         COLUMN_LIKE_COUNT: np.minimum(rng.zipf(1.8, size=num_comments) - 1, 10 ** 6)})
+
+
+def write_dataset(num_comments, seed=0):
+    '''
+    To save a synthetic dataset under PATH_TO_DATA. Returns its file name.
+    '''
+    df = generate_dataset(num_comments, seed)
+    path = dataset_store.save_dataset(df.to_dict(orient='list'), f'synthetic_{num_comments}_{seed}')
+    return path and os.path.basename(path)
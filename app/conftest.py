@@ -0,0 +1,57 @@
+'''
+Fixtures shared by the tests next to the modules.
+Modules read and write under paths relative to the app directory (./data, ./data/cache),
+so tests that touch files run in a scratch directory, and the stub models of the
+benchmarks stand in for the real ones.
+'''
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+APP_PATH = os.path.dirname(os.path.abspath(__file__))
+if APP_PATH not in sys.path:
+    sys.path.insert(0, APP_PATH)
+
+
+@pytest.fixture(autouse=True)
+def no_trace_log(monkeypatch):
+    '''Spans are kept in memory only, the trace log would be written under the current directory'''
+    from modules.tracing import tracer
+    monkeypatch.setattr(tracer, 'TRACE_LOG', False)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''A scratch app directory with an empty ./data, made the current directory'''
+    os.makedirs(tmp_path / 'data' / 'cache')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def stub_models():
+    '''The stub encoder and cross-encoder registered under the names of the real models'''
+    from benchmarks import stub_encoder
+    stub_encoder.register()
+
+
+def make_topic_embeddings(num_topics=30, per_topic=40, dimensions=32, noise=0.25, num_noise=300, seed=0):
+    '''
+    To get normalized float32 embeddings drawn around num_topics random directions,
+    with num_noise unrelated ones, shuffled so that topics span every block of rows
+    '''
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_topics, dimensions))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    vectors = np.repeat(centers, per_topic, axis=0) + rng.normal(scale=noise / np.sqrt(dimensions), size=(num_topics * per_topic, dimensions))
+    vectors = np.concatenate([vectors, rng.normal(size=(num_noise, dimensions))])
+    vectors = vectors[rng.permutation(len(vectors))].astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def topic_embeddings():
+    return make_topic_embeddings()
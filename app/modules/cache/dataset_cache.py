@@ -0,0 +1,141 @@
+'''
+Process-wide cache of loaded datasets and of everything computed from them
+(clusters, top emojis, statistics, query results), shared by every Streamlit
+rerun and session.
+Entries are keyed by the dataset file and its modification time and size, so a
+re-fetched dataset is loaded again, and the least recently used entries are
+evicted once the cache holds too many entries or too many bytes. The size of an
+entry counts its dataset and every result cached with it.
+'''
+
+import sys
+import threading
+import numpy as np
+import scipy.sparse as sp
+from collections import OrderedDict
+
+from modules.constants import *
+from modules.clustering import cluster_maker
+from modules.datasets import dataset_store
+from modules.pipeline import batch_pipeline
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+
+def _get_key(filename):
+    return (filename, *dataset_store.get_dataset_version(filename))
+
+
+def _estimate_size(df, comments_list):
+    size = sys.getsizeof(comments_list)
+    if df is not None:
+        size += int(df.memory_usage(deep=True).sum())
+    return size
+
+
+def _estimate_result_size(value):
+    '''
+    To estimate the memory held by a result: arrays, sparse matrices and dataframes by
+    their buffers, containers by their items. Memory-mapped arrays are backed by their
+    files and not counted.
+    '''
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sp.issparse(value):
+        return sum(getattr(value, name).nbytes for name in ('data', 'indices', 'indptr', 'row', 'col') if hasattr(value, name))
+    if hasattr(value, 'memory_usage'):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_estimate_result_size(k) + _estimate_result_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(_estimate_result_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def _evict():
+    '''
+    To drop the least recently used entries until the cache is within its limits
+    '''
+    total_size = sum(entry['size'] for entry in _entries.values())
+    while _entries and (len(_entries) > DATASET_CACHE_MAX_ENTRIES or total_size > DATASET_CACHE_MAX_BYTES):
+        _, entry = _entries.popitem(last=False)
+        total_size -= entry['size']
+
+
+def get_dataset(filename):
+    '''
+    To get the cached entry of a dataset, loading it on first use or when the file changed.
+    The entry holds the comment lists, the dataframe, the Comment IDs and a
+    'results' dictionary for anything computed from the dataset, starting with the
+    results precomputed by the headless pipeline.
+    '''
+    key = _get_key(filename)
+    with _lock:
+        if key in _entries:
+            _entries.move_to_end(key)
+            return _entries[key]
+
+    short_comments_list, long_comments_list, df = cluster_maker.load_data(filename)
+    comment_ids = None
+    if df is not None and 'Comment ID' in df:
+        comment_ids = df['Comment ID'].astype(str).tolist()
+
+    results = batch_pipeline.load_results(filename)
+    entry = {'filename': filename,
+             'short_comments_list': short_comments_list,
+             'long_comments_list': long_comments_list,
+             'df': df,
+             'comment_ids': comment_ids,
+             'results': results,
+             'size': _estimate_size(df, long_comments_list) + _estimate_result_size(results)}
+
+    with _lock:
+        # Older versions of the same file will not be asked for again
+        for stale_key in [k for k in _entries if k[0] == filename]:
+            del _entries[stale_key]
+        _entries[key] = _entries.get(key, entry)
+        _evict()
+        return _entries.get(key, entry)
+
+
+def has_result(entry, name):
+    return name in entry['results']
+
+
+def get_result(entry, name, compute):
+    '''
+    To get a result computed from a dataset, computing and caching it on first use.
+    The result is counted in the size of the entry, which can evict older entries.
+    '''
+    results = entry['results']
+    if name not in results:
+        value = compute()
+        size = _estimate_result_size(value)
+        with _lock:
+            if name not in results:
+                results[name] = value
+                entry['size'] += size
+                _evict()
+    return results[name]
+
+
+def drop_results(entry, names):
+    '''
+    To forget results of a dataset, e.g. lookups that a newer result made stale
+    '''
+    results = entry['results']
+    with _lock:
+        for name in names:
+            if name in results:
+                entry['size'] -= _estimate_result_size(results.pop(name))
+
+
+def clear():
+    '''
+    To empty the cache
+    '''
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.constants import COLUMN_SENTIMENT
+from modules.cache import dataset_cache
+from modules.datasets import dataset_store
+from modules.pipeline import batch_pipeline
+
+
+@pytest.fixture
+def datasets(workdir, monkeypatch):
+    monkeypatch.setattr(dataset_cache, '_entries', type(dataset_cache._entries)())
+    filenames = []
+    for name in ('first', 'second'):
+        comments = [f'a comment long enough to be kept, number {i}' for i in range(20)]
+        path = dataset_store.save_dataset({'Comment': comments, 'Author': ['someone'] * 20, 'Comment ID': [str(i) for i in range(20)], 'Like Count': list(range(20))}, name)
+        filenames.append(os.path.basename(path))
+    return filenames
+
+
+def test_results_count_in_the_entry_size(datasets):
+    entry = dataset_cache.get_dataset(datasets[0])
+    size = entry['size']
+
+    dataset_cache.get_result(entry, ('hits', 'query'), lambda: [{'corpus_id': i, 'score': 0.5} for i in range(100)])
+    assert entry['size'] > size + 100 * 64
+
+    size = entry['size']
+    dataset_cache.get_result(entry, 'matrix', lambda: np.zeros((100, 100)))
+    assert entry['size'] >= size + 80000
+
+
+def test_results_evict_older_entries(datasets, monkeypatch):
+    first = dataset_cache.get_dataset(datasets[0])
+    second = dataset_cache.get_dataset(datasets[1])
+    statistics = pd.DataFrame({'value': np.arange(5000)})
+    # Room for both datasets, or for the second one with its statistics
+    monkeypatch.setattr(dataset_cache, 'DATASET_CACHE_MAX_BYTES', second['size'] + dataset_cache._estimate_result_size(statistics) + first['size'] // 2)
+
+    dataset_cache.get_result(second, 'statistics', lambda: statistics)
+    assert dataset_cache.get_dataset(datasets[1]) is second
+    assert dataset_cache.get_dataset(datasets[0]) is not first
+
+
+def test_memory_mapped_results_are_not_counted(tmp_path):
+    path = tmp_path / 'array.npy'
+    np.save(path, np.zeros(10000))
+    assert dataset_cache._estimate_result_size(np.load(path, mmap_mode='r')) == 0
+
+
+def test_pipeline_sentiments_are_loaded_into_the_entry(datasets):
+    summary = batch_pipeline.analyze_dataset(datasets[0], stages=['sentiment'])
+    assert summary['error'] is None
+
+    entry = dataset_cache.get_dataset(datasets[0])
+    sentiments = entry['results']['sentiment']
+    assert len(sentiments) == len(entry['df'])
+    assert COLUMN_SENTIMENT not in entry['df']
+    assert entry['size'] >= dataset_cache._estimate_size(entry['df'], entry['long_comments_list']) + sentiments.nbytes
+    # Views reuse the loaded polarities instead of scoring the comments again
+    assert dataset_cache.get_result(entry, 'sentiment', lambda: pytest.fail('scored again')) is sentiments
+
+
+def test_dropped_results_leave_the_entry_size(datasets):
+    entry = dataset_cache.get_dataset(datasets[0])
+    size = entry['size']
+    dataset_cache.get_result(entry, ('no_stored_topics', 0.6, 5), lambda: True)
+    dataset_cache.get_result(entry, 'matrix', lambda: np.zeros((100, 100)))
+
+    dataset_cache.drop_results(entry, ['matrix', ('no_stored_topics', 0.6, 5), 'missing'])
+    assert not dataset_cache.has_result(entry, 'matrix')
+    assert not dataset_cache.has_result(entry, ('no_stored_topics', 0.6, 5))
+    assert entry['size'] == size
@@ -1,23 +1,22 @@
 import plotly.graph_objects as go
 
 
-def get_donut_of_topics(clusters_to_show):
-    NUM_CLUSTERS_TO_USE = len(clusters_to_show)
+def get_donut_of_topics(topic_sizes):
+    '''
+    To get the donut chart of the share of the first 20 topics, from the sizes saved with their summaries
+    '''
+    NUM_CLUSTERS_TO_USE = len(topic_sizes)
     if NUM_CLUSTERS_TO_USE > 20:
         NUM_CLUSTERS_TO_USE = 20
 
-    sum = 0
-    for cluster in clusters_to_show[:NUM_CLUSTERS_TO_USE]:
-        sum += len(cluster)
+    sizes = topic_sizes[:NUM_CLUSTERS_TO_USE]
+    total = sum(sizes)
+    percentages = [(size / total) * 100.0 for size in sizes]
 
-    percentages = []
-    for cluster in clusters_to_show:
-        percentages.append((len(cluster)/sum)*100.0)
-
-    labels = [f"Topic{i}" for i in range(1, NUM_CLUSTERS_TO_USE)]
+    labels = [f"Topic{i}" for i in range(1, NUM_CLUSTERS_TO_USE + 1)]
     values = percentages
 
     fig = go.Figure(data=[go.Pie(labels=labels, values=values, hole=.3)])
     fig.update_layout(width = 720, height = 720)
 
-    return fig
\ No newline at end of file
+    return fig
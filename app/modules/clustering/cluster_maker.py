@@ -1,117 +1,365 @@
 import os
 import pandas as pd
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import util
 import numpy as np
-import pickle
+import torch
 
 from modules.constants import *
+from modules.embeddings import embedding_store, quantization
+from modules.datasets import dataset_store
+from modules.retrieval import ann_index
+from . import neighbour_store
+from modules.tracing import tracer
 
 df = None
 comments_list = None
 
-def load_data(filename):
+@tracer.traced('cluster_maker.load_data')
+def load_data(filename, columns=None):
     '''
-    Load data from a CSV file and preprocess it.
+    Load data from a dataset file (Parquet or CSV) and preprocess it.
+    Only the given columns are read; the comment column is always loaded.
     '''
     try:
-        df = pd.read_csv(f'./data/{filename}')
+        if columns is not None and COLUMN_COMMENT not in columns:
+            columns = [COLUMN_COMMENT] + list(columns)
+        df = dataset_store.read_dataset(dataset_store.get_dataset_path(filename), columns=columns)
         print(f"Data loaded successfully from {filename}")
 
         # Replace NaN values in the 'Comment' column with an empty string
-        df['Comment'] = df['Comment'].fillna('')
-
-        # Ensure all values in the 'Comment' column are strings
-        df['Comment'] = df['Comment'].astype(str)
+        # and ensure all values in the 'Comment' column are strings
+        df[COLUMN_COMMENT] = df[COLUMN_COMMENT].fillna('').astype(str)
 
         # Filter out comments that are too short (less than 23 characters)
-        df = df[df['Comment'].apply(lambda comment: len(comment) >= 23)]
+        df = df[df[COLUMN_COMMENT].str.len() >= 23]
 
-        # Extract the short and long comments lists
-        short_comments_list = df['Comment'].tolist()
-        long_comments_list = [comment for comment in short_comments_list if len(comment) >= 23]
+        # Every comment left is long enough, so the short and long lists are the same list
+        comments_list = df[COLUMN_COMMENT].tolist()
+        tracer.current_span().set(filename=filename, items=len(comments_list))
 
-        return short_comments_list, long_comments_list, df
+        return comments_list, comments_list, df
 
     except Exception as e:
         print(f"Error loading data from {filename}: {e}")
         return [], [], None
 
 
-def _detect_clusters(embeddings, threshold=0.85, min_community_size=15, init_max_size=5000):
-    # Compute cosine similarity scores
-    cos_scores = util.pytorch_cos_sim(embeddings, embeddings)
-
-    # Minimum size for a community
-    top_k_values, _ = cos_scores.topk(k=min_community_size, largest=True)
-
-    # Filter for rows >= min_threshold
-    extracted_communities = []
-    for i in range(len(top_k_values)):
-        if top_k_values[i][-1] >= threshold:
-            new_cluster = []
+def _extract_communities_from_rows(cos_scores, threshold, min_community_size, init_max_size, column_ids=None, num_items=None):
+    '''
+    Extract the candidate communities for a block of rows of the similarity matrix.
+    Every row is compared against the whole corpus, so the result for a row does not
+    depend on how the rows were split into blocks.
+    Returns the rows communities were found for and the communities, as arrays of
+    comment indices.
+    column_ids, sorted, are the comment indices of the columns when the rows are only
+    compared with some of the num_items comments.
+    '''
+    cos_scores = np.asarray(cos_scores)
+    above_threshold = cos_scores >= threshold
 
-                        # Only check top k most similar entries
-            # Determine the valid value for k
-            valid_k = min(init_max_size, len(cos_scores[i]))
+    # Minimum size for a community: the k-th largest score is >= threshold
+    # exactly when at least k scores are >= threshold
+    counts = np.count_nonzero(above_threshold, axis=1)
+    rows = np.flatnonzero(counts >= min_community_size)
+    if len(rows) == 0:
+        return rows, []
 
-            # Use valid_k instead of init_max_size
-            top_val_large, top_idx_large = cos_scores[i].topk(k=valid_k, largest=True)
-            top_idx_large = top_idx_large.tolist()
-            top_val_large = top_val_large.tolist()
+    # Every (row, index) pair above the threshold, grouped by row in index order
+    row_pos, member_idx = np.nonzero(above_threshold[rows])
+    member_scores = cos_scores[rows[row_pos], member_idx]
 
-            if top_val_large[-1] < threshold:
-                for idx, val in zip(top_idx_large, top_val_large):
-                    if val < threshold:
-                        break
+    # Communities that fit in the top k most similar entries are ordered by decreasing
+    # similarity, larger ones keep every entry above the threshold in index order
+    valid_k = min(init_max_size, cos_scores.shape[1] if num_items is None else num_items)
+    by_score = (counts[rows] < valid_k)[row_pos]
+    order = np.lexsort((member_idx, np.where(by_score, -member_scores, 0), row_pos))
 
-                    new_cluster.append(idx)
-            else:
-                # Iterate over all entries (slow)
-                for idx, val in enumerate(cos_scores[i].tolist()):
-                    if val >= threshold:
-                        new_cluster.append(idx)
+    if column_ids is not None:
+        member_idx = column_ids[member_idx]
+    communities = np.split(member_idx[order], np.cumsum(counts[rows])[:-1])
+    return rows, communities
 
-            extracted_communities.append(new_cluster)
 
+def _remove_overlapping_communities(extracted_communities, num_items):
+    '''
+    Keep communities from largest to smallest, dropping any that shares a member
+    with a community that was already kept.
+    '''
     # Largest cluster first
     extracted_communities = sorted(extracted_communities, key=lambda x: len(x), reverse=True)
 
-    # Step 2) Remove overlapping communities
     unique_communities = []
-    extracted_ids = set()
+    extracted_ids = np.zeros(num_items, dtype=bool)
 
     for community in extracted_communities:
-        add_cluster = True
-        for idx in community:
-            if idx in extracted_ids:
-                add_cluster = False
-                break
+        if not extracted_ids[community].any():
+            unique_communities.append(community.tolist())
+            extracted_ids[community] = True
+
+    return unique_communities
+
+
+def _iter_similarity_blocks(embeddings, block_size):
+    '''
+    Yield the cosine similarity matrix of the embeddings one block of rows at a time,
+    so that at most block_size x N scores are held in memory.
+    '''
+    embeddings = torch.as_tensor(np.asarray(embeddings))
+    for start in range(0, len(embeddings), block_size):
+        yield util.pytorch_cos_sim(embeddings[start:start + block_size], embeddings)
+
+
+def _iter_approximate_blocks(index, nprobe, block_size):
+    '''
+    Yield blocks of rows of an approximate similarity matrix, from an IVF index: the
+    comments of every list are only compared with the comments of the nprobe lists
+    whose centroids are closest to its own, so a block is the indices of its comments,
+    the sorted indices of the candidate neighbours and the similarities between them.
+    '''
+    centroids, ids, offsets, vectors = np.asarray(index['centroids']), index['ids'], index['offsets'], index['vectors']
+    nprobe = min(nprobe, len(centroids))
+
+    # A list is always the closest to itself
+    centroid_scores = centroids @ centroids.T
+    np.fill_diagonal(centroid_scores, np.inf)
+    closest_lists = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+
+    for l in range(len(centroids)):
+        if offsets[l] == offsets[l + 1]:
+            continue
+        positions = np.concatenate([np.arange(offsets[c], offsets[c + 1]) for c in closest_lists[l]])
+        positions = positions[np.argsort(ids[positions])]
+        column_ids = np.asarray(ids[positions])
+        candidates = np.asarray(vectors[positions], dtype=np.float32)
+
+        for start in range(offsets[l], offsets[l + 1], block_size):
+            stop = min(start + block_size, offsets[l + 1])
+            yield np.asarray(ids[start:stop]), column_ids, np.asarray(vectors[start:stop], dtype=np.float32) @ candidates.T
+
+
+def _iter_blocks(embeddings, block_size=None, index=None, nprobe=CLUSTERING_NPROBE):
+    '''
+    Yield the blocks of rows of the similarity matrix of the embeddings, as the comment
+    indices of the rows, the sorted comment indices of the columns (None when rows are
+    compared with every comment) and the similarities.
+    See _detect_clusters for how block_size and index are used.
+    '''
+    if index is not None:
+        yield from _iter_approximate_blocks(index, nprobe, block_size or DETECTION_BLOCK_SIZE)
+        return
+
+    if isinstance(embeddings, quantization.QuantizedEmbeddings):
+        blocks = quantization.iter_similarity_blocks(embeddings, block_size or DETECTION_BLOCK_SIZE)
+    elif block_size is None:
+        # Compute cosine similarity scores
+        with tracer.span('cluster_maker.similarity', items=len(embeddings)):
+            all_scores = util.pytorch_cos_sim(embeddings, embeddings)
+        blocks = (all_scores[start:start + DETECTION_BLOCK_SIZE] for start in range(0, len(all_scores), DETECTION_BLOCK_SIZE))
+    else:
+        blocks = _iter_similarity_blocks(embeddings, block_size)
+
+    start = 0
+    for cos_scores in blocks:
+        yield np.arange(start, start + len(cos_scores)), None, cos_scores
+        start += len(cos_scores)
+
 
-        if add_cluster:
-            unique_communities.append(community)
-            for idx in community:
-                extracted_ids.add(idx)
+def _detect_clusters(embeddings, threshold=CLUSTER_THRESHOLD, min_community_size=CLUSTER_MIN_COMMUNITY_SIZE, init_max_size=5000, block_size=None, progress_callback=None, index=None, nprobe=CLUSTERING_NPROBE):
+    '''
+    Find communities of comments whose embeddings are at least threshold similar.
+    If block_size is given, the similarity matrix is computed in blocks of rows
+    instead of all at once; the clusters found are the same either way.
+    Quantized embeddings are always compared in blocks, straight from their compact form.
+    With the IVF index of the embeddings, clusters are found approximately: comments are
+    only compared with the comments of nearby lists (see _iter_approximate_blocks).
+    progress_callback, if given, is called with the stage, the rows done and the number of rows.
+    '''
+    def report(stage, done):
+        if progress_callback:
+            progress_callback(stage, done, len(embeddings))
+
+    # Blocks are computed lazily, the time spent computing them is reported as similarity_seconds
+    row_ids = []
+    extracted_communities = []
+    num_rows = 0
+    report('Finding topics', 0)
+    with tracer.span('cluster_maker.extract_communities', items=len(embeddings), blocked=block_size is not None, approximate=index is not None) as current:
+        for block_ids, column_ids, cos_scores in tracer.timed_iter(_iter_blocks(embeddings, block_size, index, nprobe), current, 'similarity_seconds'):
+            rows, communities = _extract_communities_from_rows(cos_scores, threshold, min_community_size, init_max_size,
+                                                               column_ids=column_ids, num_items=len(embeddings))
+            row_ids.extend(block_ids[rows])
+            extracted_communities.extend(communities)
+            num_rows += len(block_ids)
+            report('Finding topics', num_rows)
+        current.set(communities=len(extracted_communities))
+
+    # Step 2) Remove overlapping communities
+    report('Merging topics', len(embeddings))
+    return _merge_communities(row_ids, extracted_communities, len(embeddings))
 
+
+def _merge_communities(row_ids, extracted_communities, num_items):
+    '''
+    Get the clusters from the candidate communities of the rows in row_ids
+    '''
+    # Approximate blocks are not in row order, communities are put back in it so that
+    # ties between communities are broken the same way in every mode
+    extracted_communities = [extracted_communities[i] for i in np.argsort(row_ids, kind='stable')]
+
+    with tracer.span('cluster_maker.remove_overlapping', items=len(extracted_communities)) as current:
+        unique_communities = _remove_overlapping_communities(extracted_communities, num_items)
+        current.set(clusters=len(unique_communities))
+    return unique_communities
+
+
+def _detect_clusters_from_neighbours(neighbours, threshold=CLUSTER_THRESHOLD, min_community_size=CLUSTER_MIN_COMMUNITY_SIZE, init_max_size=5000):
+    '''
+    Find the same communities as _detect_clusters from saved neighbour lists, for a
+    threshold at least as high as theirs. Neighbours are sorted by decreasing
+    similarity, so a community is a prefix of a list.
+    '''
+    indptr, indices, scores = neighbours['indptr'], neighbours['indices'], neighbours['scores']
+    num_items = neighbours['meta']['count']
+
+    above_threshold = np.zeros(len(scores) + 1, dtype=np.int64)
+    np.cumsum(scores >= threshold, out=above_threshold[1:])
+    counts = above_threshold[indptr[1:]] - above_threshold[indptr[:-1]]
+
+    valid_k = min(init_max_size, num_items)
+    extracted_communities = []
+    for row in np.flatnonzero(counts >= min_community_size):
+        community = indices[indptr[row]:indptr[row] + counts[row]]
+        # Larger communities keep their entries in index order
+        extracted_communities.append(np.sort(community) if counts[row] >= valid_k else community)
+
+    with tracer.span('cluster_maker.remove_overlapping', items=len(extracted_communities)) as current:
+        unique_communities = _remove_overlapping_communities(extracted_communities, num_items)
+        current.set(clusters=len(unique_communities))
     return unique_communities
 
 
+def _build_neighbours(embeddings, block_size=None, index=None, nprobe=CLUSTERING_NPROBE, progress_callback=None,
+                      threshold=None, min_community_size=CLUSTER_MIN_COMMUNITY_SIZE, init_max_size=5000):
+    '''
+    Compute the neighbour lists of the embeddings, from the same blocks of the similarity
+    matrix as _detect_clusters.
+    With a threshold, the communities for it are extracted from the same blocks, so that
+    when the lists are cut short of neighbours at that threshold the clusters are found
+    without computing the similarities again.
+    Returns the neighbour lists, and the clusters when they were cut short (None otherwise).
+    '''
+    row_ids = []
+    extracted_communities = []
+
+    def iter_blocks(current):
+        num_rows = 0
+        for block_ids, column_ids, cos_scores in tracer.timed_iter(_iter_blocks(embeddings, block_size, index, nprobe), current, 'similarity_seconds'):
+            if threshold is not None:
+                rows, communities = _extract_communities_from_rows(cos_scores, threshold, min_community_size, init_max_size,
+                                                                   column_ids=column_ids, num_items=len(embeddings))
+                row_ids.extend(block_ids[rows])
+                extracted_communities.extend(communities)
+            yield block_ids, column_ids, cos_scores
+            num_rows += len(block_ids)
+            if progress_callback:
+                progress_callback('Finding neighbours', num_rows, len(embeddings))
+
+    with tracer.span('cluster_maker.build_neighbours', items=len(embeddings), approximate=index is not None) as current:
+        neighbours = neighbour_store.build_neighbours(iter_blocks(current), len(embeddings))
+        current.set(neighbours=len(neighbours['indices']), truncated=neighbours['meta']['truncated'])
 
-def get_clusters_from_file(filename, comments_list = None):
-    if not os.path.isfile(os.path.join(PATH_TO_DATA_CACHE, f'{filename}_embedding_cache.pkl')):
-        model = SentenceTransformer('distilbert-base-nli-stsb-quora-ranking')
-        corpus_embeddings = model.encode(comments_list, show_progress_bar=True, convert_to_numpy=True)
+    if threshold is None or not neighbour_store.is_truncated(neighbours, threshold):
+        return neighbours, None
+    return neighbours, _merge_communities(row_ids, extracted_communities, len(embeddings))
 
-        with open(os.path.join(PATH_TO_DATA_CACHE, f'{filename}_embedding_cache.pkl'), 'wb') as f:
-            pickle.dump(corpus_embeddings, f)
+
+def _get_mode(num_comments, mode):
+    if mode is None:
+        return 'approximate' if num_comments > APPROXIMATE_CLUSTERING_MIN_SIZE else 'exact'
+    return mode
+
+
+def _load_stored_neighbours(corpus_key, num_comments, threshold, mode, nprobe):
+    if threshold < NEIGHBOUR_MIN_THRESHOLD:
+        return None
+    neighbours = neighbour_store.load_neighbours(neighbour_store.get_key(corpus_key, EMBEDDING_DTYPE, _get_mode(num_comments, mode), nprobe))
+    if neighbours is None or neighbours['meta']['count'] != num_comments:
+        return None
+    return neighbours
+
+
+def get_stored_clusters(corpus_key, num_comments, threshold=CLUSTER_THRESHOLD, min_community_size=CLUSTER_MIN_COMMUNITY_SIZE, mode=None, nprobe=CLUSTERING_NPROBE):
+    '''
+    Get the clusters of a corpus from its saved neighbour lists, in milliseconds, or
+    None if they have not been computed yet or were cut short of neighbours at this
+    threshold (see get_clusters_from_file).
+    '''
+    neighbours = _load_stored_neighbours(corpus_key, num_comments, threshold, mode, nprobe)
+    if neighbours is None or neighbour_store.is_truncated(neighbours, threshold):
+        return None
+    return sorted(_detect_clusters_from_neighbours(neighbours, threshold, min_community_size))
+
+
+@tracer.traced('cluster_maker.get_clusters')
+def get_clusters_from_file(filename, comments_list = None, blocked = None, block_size = DETECTION_BLOCK_SIZE, comment_ids = None, progress_callback = None, mode = None, nprobe = CLUSTERING_NPROBE,
+                           threshold = CLUSTER_THRESHOLD, min_community_size = CLUSTER_MIN_COMMUNITY_SIZE, corpus_key = None):
+    '''
+    Get the clusters of comments for a data file, computing the embeddings if they are not stored yet.
+    blocked=None switches to blocked detection automatically for large corpora.
+    mode is 'exact' or 'approximate' (through the IVF index shared with retrieval, nprobe
+    trades accuracy for speed); None switches to approximate for very large corpora.
+    The neighbour lists of the comments are saved on the first call, so later calls with
+    another threshold (down to NEIGHBOUR_MIN_THRESHOLD) or minimum size only derive the
+    clusters from them, unless lists cut at NEIGHBOUR_MAX_PER_ROW could miss neighbours
+    at that threshold.
+    comment_ids lets comments embedded for an earlier fetch of the video be reused.
+    corpus_key can be passed by callers that already hashed the corpus.
+    progress_callback, if given, is called with the current stage, the comments done and the number of comments.
+    '''
+    if progress_callback:
+        progress_callback('Embedding comments', 0, len(comments_list))
+    corpus_key = corpus_key or embedding_store.get_dataset_corpus_key(filename, comments_list)
+    mode = _get_mode(len(comments_list), mode)
+    tracer.current_span().set(mode=mode, threshold=threshold, min_community_size=min_community_size)
+
+    all_clusters = get_stored_clusters(corpus_key, len(comments_list), threshold, min_community_size, mode, nprobe)
+    if all_clusters is not None:
+        tracer.current_span().set(items=len(comments_list), clusters=len(all_clusters), cached=True)
+        return all_clusters
+
+    corpus_embeddings = embedding_store.get_embeddings(comments_list, filename, comment_ids=comment_ids, corpus_key=corpus_key)
+
+    index = None
+    if mode == 'approximate':
+        if progress_callback:
+            progress_callback('Indexing comments', 0, len(comments_list))
+        # Small corpora have no saved index, one is built for this run
+        index = ann_index.get_index(corpus_key, corpus_embeddings) or ann_index.build_index(corpus_embeddings)
     else:
-        # load embeddings from cache
-        with open(os.path.join(PATH_TO_DATA_CACHE, f'{filename}_embedding_cache.pkl'), 'rb') as f:
-            corpus_embeddings = pickle.load(f)
+        if blocked is None:
+            blocked = len(corpus_embeddings) > BLOCKED_DETECTION_MIN_SIZE
+        block_size = block_size if blocked else None
 
-    all_clusters = _detect_clusters(corpus_embeddings)
-        
+    # Saved neighbour lists that were not used above were cut short of neighbours at this threshold
+    neighbours = _load_stored_neighbours(corpus_key, len(comments_list), threshold, mode, nprobe)
+    all_clusters = None
+    if threshold >= NEIGHBOUR_MIN_THRESHOLD and neighbours is None:
+        neighbours, all_clusters = _build_neighbours(corpus_embeddings, block_size, index, nprobe, progress_callback,
+                                                     threshold=threshold, min_community_size=min_community_size)
+        neighbour_store.save_neighbours(neighbours, neighbour_store.get_key(corpus_key, EMBEDDING_DTYPE, mode, nprobe))
+
+    if all_clusters is not None:
+        tracer.current_span().set(truncated_neighbours=True)
+    elif neighbours is None or neighbour_store.is_truncated(neighbours, threshold):
+        tracer.current_span().set(truncated_neighbours=neighbours is not None)
+        all_clusters = _detect_clusters(corpus_embeddings, threshold, min_community_size, block_size=block_size, progress_callback=progress_callback, index=index, nprobe=nprobe)
+    else:
+        if progress_callback:
+            progress_callback('Finding topics', len(corpus_embeddings), len(corpus_embeddings))
+        all_clusters = _detect_clusters_from_neighbours(neighbours, threshold, min_community_size)
 
     all_clusters.sort()
+    tracer.current_span().set(items=len(corpus_embeddings), clusters=len(all_clusters))
 
     # for i, cluster in enumerate(clusters_to_show):
     #     print(f'Topic {i}: ')
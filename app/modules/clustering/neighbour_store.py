@@ -0,0 +1,133 @@
+'''
+Persisted neighbour lists of a corpus: for every comment, the comments at least
+NEIGHBOUR_MIN_THRESHOLD similar to it with their similarities, most similar first,
+in CSR form (indptr, indices, scores).
+Clusters for any threshold above NEIGHBOUR_MIN_THRESHOLD and any minimum community
+size are derived from them without computing similarities again, unless lists cut at
+NEIGHBOUR_MAX_PER_ROW could miss neighbours at that threshold (see is_truncated).
+'''
+
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+
+from modules.constants import *
+
+_loaded_neighbours = OrderedDict()
+
+
+def get_key(corpus_key, dtype, mode, nprobe):
+    '''
+    To get the key of the neighbour lists of a corpus, for the embeddings and the mode they come
+    from and the cut-offs of the lists, so lists saved with other cut-offs are not reused
+    '''
+    suffix = f'approximate{nprobe}' if mode == 'approximate' else 'exact'
+    return f'{corpus_key}_{dtype}_{suffix}_{NEIGHBOUR_MIN_THRESHOLD:g}_{NEIGHBOUR_MAX_PER_ROW}'
+
+
+def build_neighbours(blocks, num_items, min_threshold=None, max_neighbours=None):
+    '''
+    To collect the neighbour lists from the blocks of rows of a similarity matrix
+    (row indices, sorted column indices or None, similarities).
+    Only the max_neighbours (NEIGHBOUR_MAX_PER_ROW by default) most similar comments of
+    every comment at least min_threshold (NEIGHBOUR_MIN_THRESHOLD) similar are kept.
+    '''
+    min_threshold = NEIGHBOUR_MIN_THRESHOLD if min_threshold is None else min_threshold
+    max_neighbours = NEIGHBOUR_MAX_PER_ROW if max_neighbours is None else max_neighbours
+    counts = np.zeros(num_items, dtype=np.int64)
+    parts = []
+    for block_ids, column_ids, cos_scores in blocks:
+        cos_scores = np.asarray(cos_scores)
+        row_pos, column_pos = np.nonzero(cos_scores >= min_threshold)
+        scores = cos_scores[row_pos, column_pos].astype(np.float32)
+        columns = column_pos if column_ids is None else column_ids[column_pos]
+
+        # Most similar first, ties in index order, like communities
+        order = np.lexsort((columns, -scores, row_pos))
+        row_pos, columns, scores = row_pos[order], columns[order], scores[order]
+
+        row_counts = np.bincount(row_pos, minlength=len(block_ids))
+        ranks = np.arange(len(row_pos)) - (np.cumsum(row_counts) - row_counts)[row_pos]
+        keep = ranks < max_neighbours
+        counts[block_ids] = np.minimum(row_counts, max_neighbours)
+        parts.append((np.asarray(block_ids)[row_pos[keep]], columns[keep], scores[keep]))
+
+    rows = np.concatenate([part[0] for part in parts] or [np.zeros(0, dtype=np.int64)])
+    # Blocks of approximate clustering are not in row order, the order within a row is kept
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(num_items + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+
+    return {'indptr': indptr,
+            'indices': np.concatenate([part[1] for part in parts] or [np.zeros(0)]).astype(np.int32)[order],
+            'scores': np.concatenate([part[2] for part in parts] or [np.zeros(0)]).astype(np.float32)[order],
+            'meta': {'count': int(num_items),
+                     'min_threshold': float(min_threshold),
+                     'max_neighbours': int(max_neighbours),
+                     'truncated': int(np.count_nonzero(counts >= max_neighbours))}}
+
+
+def is_truncated(neighbours, threshold):
+    '''
+    To check whether clusters for threshold could miss neighbours: true when a list cut at
+    max_neighbours still ends with a neighbour at least threshold similar
+    '''
+    if not neighbours['meta']['truncated']:
+        return False
+    indptr = neighbours['indptr']
+    full_rows = np.flatnonzero(np.diff(indptr) >= neighbours['meta']['max_neighbours'])
+    return bool(np.any(neighbours['scores'][indptr[full_rows + 1] - 1] >= threshold))
+
+
+def _get_path(key):
+    return os.path.join(PATH_TO_NEIGHBOURS, f'{key}.npz')
+
+
+def _remember(key, neighbours):
+    _loaded_neighbours[key] = neighbours
+    _loaded_neighbours.move_to_end(key)
+    while len(_loaded_neighbours) > NEIGHBOUR_CACHE_MAX_ENTRIES:
+        _loaded_neighbours.popitem(last=False)
+
+
+def save_neighbours(neighbours, key):
+    '''
+    To save neighbour lists, through a temporary file so that readers never see a partially written file
+    '''
+    os.makedirs(PATH_TO_NEIGHBOURS, exist_ok=True)
+    path = _get_path(key)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, indptr=neighbours['indptr'], indices=neighbours['indices'], scores=neighbours['scores'],
+                 meta=np.array(json.dumps(neighbours['meta'])))
+    os.replace(tmp_path, path)
+    _remember(key, neighbours)
+
+
+def has_neighbours(key):
+    return key in _loaded_neighbours or os.path.isfile(_get_path(key))
+
+
+def load_neighbours(key):
+    '''
+    To get saved neighbour lists, kept in memory once loaded, or None if there are none
+    '''
+    if key in _loaded_neighbours:
+        _loaded_neighbours.move_to_end(key)
+        return _loaded_neighbours[key]
+
+    path = _get_path(key)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with np.load(path) as data:
+            neighbours = {name: data[name] for name in ('indptr', 'indices', 'scores')}
+            neighbours['meta'] = json.loads(str(data['meta']))
+    except Exception as e:
+        print(f"Error loading neighbour lists {path}: {e}")
+        return None
+
+    _remember(key, neighbours)
+    return neighbours
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from conftest import make_topic_embeddings
+from modules.clustering import cluster_maker, neighbour_store
+from modules.embeddings import quantization
+from modules.retrieval import ann_index
+
+
+def _as_sets(clusters):
+    return sorted(sorted(cluster) for cluster in clusters)
+
+
+def test_blocked_detection_matches_full_matrix(topic_embeddings):
+    full = cluster_maker._detect_clusters(topic_embeddings, threshold=0.85, min_community_size=15)
+    assert full
+
+    for block_size in (100, 333, len(topic_embeddings)):
+        blocked = cluster_maker._detect_clusters(topic_embeddings, threshold=0.85, min_community_size=15, block_size=block_size)
+        assert blocked == full
+
+
+def test_blocked_detection_reports_progress(topic_embeddings):
+    calls = []
+    cluster_maker._detect_clusters(topic_embeddings, block_size=500, progress_callback=lambda *args: calls.append(args))
+    assert calls[0] == ('Finding topics', 0, len(topic_embeddings))
+    assert ('Finding topics', len(topic_embeddings), len(topic_embeddings)) in calls
+    assert calls[-1][0] == 'Merging topics'
+
+
+def test_clusters_do_not_overlap(topic_embeddings):
+    clusters = cluster_maker._detect_clusters(topic_embeddings, threshold=0.8, min_community_size=5, block_size=256)
+    members = np.concatenate(clusters)
+    assert len(members) == len(np.unique(members))
+    assert all(len(cluster) >= 5 for cluster in clusters)
+
+
+def test_full_matrix_detection_scans_every_row(topic_embeddings):
+    # The full matrix is split in blocks of DETECTION_BLOCK_SIZE rows, a topic only in
+    # the rows after the first block must still be found
+    rng = np.random.default_rng(1)
+    noise = rng.normal(size=(cluster_maker.DETECTION_BLOCK_SIZE + 100, topic_embeddings.shape[1]))
+    topic = rng.normal(size=topic_embeddings.shape[1]) + rng.normal(scale=0.05, size=(40, topic_embeddings.shape[1]))
+    vectors = np.concatenate([noise, topic]).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    late_topic = cluster_maker._detect_clusters(vectors[-40:], threshold=0.85, min_community_size=5)
+
+    clusters = cluster_maker._detect_clusters(vectors, threshold=0.85, min_community_size=5)
+    assert clusters
+    assert sorted(min(cluster) for cluster in clusters) == sorted(min(cluster) + len(noise) for cluster in late_topic)
+    assert clusters == cluster_maker._detect_clusters(vectors, threshold=0.85, min_community_size=5, block_size=200)
+
+
+def test_full_matrix_detection_matches_blocked_on_large_corpus(topic_embeddings):
+    assert len(topic_embeddings) > cluster_maker.DETECTION_BLOCK_SIZE
+    full = cluster_maker._detect_clusters(topic_embeddings, threshold=0.85, min_community_size=15)
+    assert len(full) == 30
+    assert full == cluster_maker._detect_clusters(topic_embeddings, threshold=0.85, min_community_size=15, block_size=cluster_maker.DETECTION_BLOCK_SIZE)
+
+
+@pytest.mark.parametrize('dtype', quantization.QUANTIZED_DTYPES)
+def test_quantized_detection_matches_float32(topic_embeddings, dtype):
+    full = cluster_maker._detect_clusters(topic_embeddings, threshold=0.85, min_community_size=15)
+    quantized = quantization.quantize(topic_embeddings, dtype)
+    with pytest.raises(TypeError):
+        np.asarray(quantized)
+
+    # Members scored slightly differently can come in another order
+    for block_size in (None, 333):
+        clusters = cluster_maker._detect_clusters(quantized, threshold=0.85, min_community_size=15, block_size=block_size)
+        assert _as_sets(clusters) == _as_sets(full)
+
+
+def test_approximate_detection_matches_exact():
+    # Wider topics, so that some members fall in other IVF lists than their topic
+    embeddings = make_topic_embeddings(noise=0.6, seed=3)
+    exact = cluster_maker._detect_clusters(embeddings, threshold=0.85, min_community_size=5)
+    index = ann_index.build_index(embeddings)
+
+    for nprobe in (cluster_maker.CLUSTERING_NPROBE, index['meta']['nlist']):
+        approximate = cluster_maker._detect_clusters(embeddings, threshold=0.85, min_community_size=5, index=index, nprobe=nprobe)
+        assert _as_sets(approximate) == _as_sets(exact)
+
+
+def test_truncated_neighbour_lists_are_detected(topic_embeddings):
+    blocks = cluster_maker._iter_blocks(topic_embeddings, block_size=500)
+    neighbours = neighbour_store.build_neighbours(blocks, len(topic_embeddings), max_neighbours=10)
+    assert neighbours['meta']['truncated'] > 0
+    # Only the comment itself scores 1, the cut lists end below that
+    assert neighbour_store.is_truncated(neighbours, 0.85)
+    assert not neighbour_store.is_truncated(neighbours, 0.9999)
+
+
+def test_clusters_are_computed_again_when_neighbour_lists_are_cut(workdir, stub_models, monkeypatch):
+    # 5 topics of 30 identical comments, with room for 10 neighbours per comment
+    monkeypatch.setattr(neighbour_store, 'NEIGHBOUR_MAX_PER_ROW', 10)
+    comments = [f'topic {topic} ' + ' '.join(f'word{topic}x{i}' for i in range(8)) for topic in range(5) for _ in range(30)]
+    expected = [list(range(topic * 30, (topic + 1) * 30)) for topic in range(5)]
+
+    passes = []
+    iter_blocks = cluster_maker._iter_blocks
+    monkeypatch.setattr(cluster_maker, '_iter_blocks', lambda *args: passes.append(1) or iter_blocks(*args))
+    clusters = cluster_maker.get_clusters_from_file('stub', comments, threshold=0.9, min_community_size=15, corpus_key='stub')
+    assert _as_sets(clusters) == expected
+    # The clusters come from the same pass over the similarities as the saved lists
+    assert len(passes) == 1
+
+    # Later calls do not build the saved lists again, and cannot use them for this threshold
+    clusters = cluster_maker.get_clusters_from_file('stub', comments, threshold=0.9, min_community_size=15, corpus_key='stub')
+    assert _as_sets(clusters) == expected
+    assert len(passes) == 2
+    assert cluster_maker.get_stored_clusters('stub', len(comments), threshold=0.9, min_community_size=15) is None
+
+
+def test_neighbour_lists_with_other_cut_offs_are_not_reused(monkeypatch):
+    key = neighbour_store.get_key('corpus', 'float32', 'exact', None)
+    monkeypatch.setattr(neighbour_store, 'NEIGHBOUR_MAX_PER_ROW', 10)
+    assert neighbour_store.get_key('corpus', 'float32', 'exact', None) != key
+    monkeypatch.undo()
+    monkeypatch.setattr(neighbour_store, 'NEIGHBOUR_MIN_THRESHOLD', 0.5)
+    assert neighbour_store.get_key('corpus', 'float32', 'exact', None) != key
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from modules.clustering import cluster_maker, neighbour_store, topic_store
+
+# 3 topics of 20 comments, of 4 distinct comments each, and unrelated comments
+COMMENTS = [f'topic{topic} ' + ' '.join(f'word{topic}x{i}' for i in range(8)) + ('' if variant == 0 else f' variant{variant}')
+            for topic in range(3) for variant in range(4) for _ in range(5)]
+COMMENTS += [f'unrelated comment number {i} with its own words w{i}a w{i}b' for i in range(20)]
+
+
+@pytest.fixture
+def store(workdir, stub_models, monkeypatch):
+    '''Empty topic and neighbour stores, in memory and on disk'''
+    monkeypatch.setattr(topic_store, '_loaded_topics', type(topic_store._loaded_topics)())
+    monkeypatch.setattr(neighbour_store, '_loaded_neighbours', type(neighbour_store._loaded_neighbours)())
+
+
+def get_topics(**kwargs):
+    return topic_store.get_topics('stub', COMMENTS, threshold=0.85, min_community_size=15, corpus_key='stub', **kwargs)
+
+
+def test_summaries_describe_every_cluster():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(6, 4)).astype(np.float32)
+    embeddings[:4] = [1, 0, 0, 0]
+    embeddings[1] = [1, 0.2, 0, 0]
+    embeddings[3] = [1, -0.3, 0, 0]
+    comments = ['same', 'close', 'same', 'other', 'a', 'b']
+
+    summaries, centroids = topic_store.summarize_clusters([[0, 1, 2, 3], [4, 5]], embeddings, comments, num_representatives=2)
+    np.testing.assert_allclose(np.linalg.norm(centroids, axis=1), 1, rtol=1e-6)
+    assert [summary['size'] for summary in summaries] == [4, 2]
+    # Closest to the centroid first, and a repeated comment only once
+    assert summaries[0]['representatives'] == ['same', 'close']
+    assert summaries[0]['representative_ids'] == [0, 1]
+    assert summaries[0]['keywords'] == []
+
+
+def test_topics_are_saved_and_loaded(store, monkeypatch):
+    topics = get_topics()
+    assert sorted(summary['size'] for summary in topics['summaries']) == [20, 20, 20]
+    assert all(summary['keywords'] for summary in topics['summaries'])
+    assert len(topics['centroids']) == 3
+
+    # Loaded from the saved file, without clustering again
+    monkeypatch.setattr(topic_store, '_loaded_topics', type(topic_store._loaded_topics)())
+    monkeypatch.setattr(cluster_maker, 'get_clusters_from_file', None)
+    loaded = get_topics()
+    assert loaded['clusters'] == topics['clusters']
+    assert loaded['summaries'] == topics['summaries']
+    np.testing.assert_array_equal(loaded['centroids'], topics['centroids'])
+
+
+def test_stored_only_topics_come_from_saved_neighbour_lists(store):
+    assert get_topics(stored_only=True) is None
+    get_topics()
+
+    # Another minimum size is derived from the neighbour lists of the first call
+    topics = topic_store.get_topics('stub', COMMENTS, threshold=0.85, min_community_size=25, corpus_key='stub', stored_only=True)
+    assert topics is not None and topics['clusters'] == []
+
+
+def test_loaded_topics_are_bounded(monkeypatch):
+    monkeypatch.setattr(topic_store, 'TOPIC_CACHE_MAX_ENTRIES', 2)
+    monkeypatch.setattr(topic_store, '_loaded_topics', type(topic_store._loaded_topics)())
+    for key in ('a', 'b', 'c'):
+        topic_store._remember(key, {})
+    assert list(topic_store._loaded_topics) == ['b', 'c']
@@ -0,0 +1,162 @@
+'''
+Saved topics of a corpus: its clusters for one set of clustering parameters, with a
+summary of every cluster computed once (size, centroid, the distinct comments closest
+to the centroid and the most frequent words), so showing topics is only a lookup.
+Topics are saved under PATH_TO_TOPICS, keyed by the corpus (a hash of the encoder model
+and every comment), the form of its embeddings and the clustering parameters.
+'''
+
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+
+from modules.constants import *
+from modules.embeddings import embedding_store
+from modules.terms import term_index
+from modules.tracing import tracer
+from . import cluster_maker, neighbour_store
+
+_loaded_topics = OrderedDict()
+
+
+def get_key(corpus_key, threshold, min_community_size, mode, nprobe):
+    '''
+    To get the key of the topics of a corpus, for the embeddings they come from and the clustering parameters
+    '''
+    return f'{neighbour_store.get_key(corpus_key, EMBEDDING_DTYPE, mode, nprobe)}_{threshold:g}_{min_community_size}'
+
+
+def summarize_clusters(clusters, embeddings, comments_list, index=None, num_representatives=TOPIC_NUM_REPRESENTATIVES, num_keywords=TOPIC_NUM_KEYWORDS):
+    '''
+    To get the summary of every cluster and the centroids of the clusters.
+    A summary has the size of the cluster, its num_representatives distinct comments
+    closest to the centroid (ids and texts, closest first) and, from the term index of
+    the comments, its num_keywords most frequent words with their counts.
+    '''
+    keywords = term_index.get_cluster_term_counts(index, clusters, k=num_keywords) if index is not None else [[] for _ in clusters]
+    centroids = np.zeros((len(clusters), embeddings.shape[1]), dtype=np.float32)
+    summaries = []
+    for i, cluster in enumerate(clusters):
+        ids = np.sort(np.asarray(cluster, dtype=np.int64))
+        vectors = np.asarray(embeddings[ids], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        centroid = vectors.mean(axis=0)
+        centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        representative_ids = []
+        seen = set()
+        for comment_id in ids[np.argsort(-(vectors @ centroids[i]), kind='stable')]:
+            if comments_list[comment_id] not in seen:
+                seen.add(comments_list[comment_id])
+                representative_ids.append(int(comment_id))
+                if len(representative_ids) >= num_representatives:
+                    break
+
+        summaries.append({'size': len(cluster),
+                          'representative_ids': representative_ids,
+                          'representatives': [comments_list[comment_id] for comment_id in representative_ids],
+                          'keywords': [[word, count] for word, count in keywords[i]]})
+    return summaries, centroids
+
+
+def _get_path(key):
+    return os.path.join(PATH_TO_TOPICS, f'{key}.npz')
+
+
+def _remember(key, topics):
+    _loaded_topics[key] = topics
+    _loaded_topics.move_to_end(key)
+    while len(_loaded_topics) > TOPIC_CACHE_MAX_ENTRIES:
+        _loaded_topics.popitem(last=False)
+
+
+def save_topics(topics, key):
+    '''
+    To save topics, through a temporary file so that readers never see a partially written file
+    '''
+    os.makedirs(PATH_TO_TOPICS, exist_ok=True)
+    path = _get_path(key)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, centroids=topics['centroids'],
+                 topics=np.array(json.dumps({name: topics[name] for name in ('clusters', 'summaries', 'meta')})))
+    os.replace(tmp_path, path)
+    _remember(key, topics)
+
+
+def load_topics(key):
+    '''
+    To get saved topics, kept in memory once loaded, or None if there are none
+    '''
+    if key in _loaded_topics:
+        _loaded_topics.move_to_end(key)
+        return _loaded_topics[key]
+
+    path = _get_path(key)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with np.load(path) as data:
+            topics = json.loads(str(data['topics']))
+            topics['centroids'] = data['centroids']
+    except Exception as e:
+        print(f"Error loading topics {path}: {e}")
+        return None
+
+    _remember(key, topics)
+    return topics
+
+
+@tracer.traced('topic_store.get_topics')
+def get_topics(filename, comments_list, comment_ids=None, threshold=CLUSTER_THRESHOLD, min_community_size=CLUSTER_MIN_COMMUNITY_SIZE, mode=None, nprobe=CLUSTERING_NPROBE,
+               progress_callback=None, stored_only=False, corpus_key=None, index=None):
+    '''
+    Get the topics of a dataset: a dict of its clusters, the summary of every cluster
+    (see summarize_clusters), the centroids of the clusters and the parameters they come from.
+    Topics are computed and saved on the first call, later calls load them.
+    With stored_only, topics are only derived from saved neighbour lists, and None is
+    returned if similarities would have to be computed (see cluster_maker.get_stored_clusters).
+    corpus_key and index (the term index of the comments) can be passed by callers that already have them.
+    progress_callback, if given, is called with the current stage, the comments done and the number of comments.
+    '''
+    corpus_key = corpus_key or embedding_store.get_dataset_corpus_key(filename, comments_list)
+    mode = cluster_maker._get_mode(len(comments_list), mode)
+    key = get_key(corpus_key, threshold, min_community_size, mode, nprobe)
+    meta = {'corpus_key': corpus_key, 'model': ENCODER_MODEL_NAME, 'dtype': EMBEDDING_DTYPE, 'count': len(comments_list),
+            'mode': mode, 'nprobe': nprobe, 'threshold': threshold, 'min_community_size': min_community_size,
+            'num_representatives': TOPIC_NUM_REPRESENTATIVES, 'num_keywords': TOPIC_NUM_KEYWORDS}
+
+    topics = load_topics(key)
+    if topics is not None and topics['meta'] == meta:
+        tracer.current_span().set(items=len(comments_list), clusters=len(topics['clusters']), cached=True)
+        return topics
+
+    if stored_only:
+        clusters = cluster_maker.get_stored_clusters(corpus_key, len(comments_list), threshold, min_community_size, mode, nprobe)
+        if clusters is None:
+            return None
+    else:
+        clusters = cluster_maker.get_clusters_from_file(filename, comments_list, comment_ids=comment_ids, progress_callback=progress_callback, mode=mode, nprobe=nprobe,
+                                                        threshold=threshold, min_community_size=min_community_size, corpus_key=corpus_key)
+
+    if progress_callback:
+        progress_callback('Summarizing topics', len(comments_list), len(comments_list))
+    with tracer.span('topic_store.summarize', clusters=len(clusters)):
+        embeddings = embedding_store.get_embeddings(comments_list, filename, comment_ids=comment_ids, corpus_key=corpus_key)
+        if index is None:
+            index = term_index.get_term_index(filename, comments_list)
+        summaries, centroids = summarize_clusters(clusters, embeddings, comments_list, index)
+
+    topics = {'clusters': [[int(comment) for comment in cluster] for cluster in clusters],
+              'summaries': summaries,
+              'centroids': centroids,
+              'meta': meta}
+    try:
+        save_topics(topics, key)
+    except Exception as e:
+        print(f"Error saving topics of {filename}: {e}")
+        _remember(key, topics)
+    tracer.current_span().set(items=len(comments_list), clusters=len(clusters), cached=False)
+    return topics
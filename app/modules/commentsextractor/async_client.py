@@ -0,0 +1,206 @@
+'''
+Asyncio client for the two YouTube Data API calls the collector needs
+(videos.list and commentThreads.list), used instead of googleapiclient when
+aiohttp is installed.
+All requests of a client share one pooled HTTP session and the token-bucket rate
+limiter, so many videos can be fetched concurrently from one thread. Rate-limited
+and failed requests are retried with exponential backoff.
+base_url can point to a local stub server replaying recorded pages, and record_path
+saves every response so that it can be replayed.
+'''
+
+import os
+import json
+import random
+import asyncio
+import hashlib
+from urllib.parse import urlencode
+
+from .rate_limiter import QuotaExceededError, youtube_rate_limiter
+from .comments_collector import CommentPageWriter
+from modules.constants import *
+from modules.tracing import tracer
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# 403 reasons that are worth retrying, the others (quotaExceeded, commentsDisabled...) are not
+RETRY_403_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+class YouTubeAPIError(Exception):
+    def __init__(self, status, reason, message):
+        super().__init__(f'YouTube API error {status} ({reason}): {message}')
+        self.status = status
+        self.reason = reason
+
+
+def async_client_available():
+    return aiohttp is not None
+
+
+def get_record_key(resource, params):
+    '''
+    To get the name a response is recorded under, from its request without the API key
+    '''
+    query = urlencode(sorted((name, str(value)) for name, value in params.items() if name != 'key'))
+    return f'{resource}_{hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]}'
+
+
+def _get_error_reason(body):
+    try:
+        error = json.loads(body)['error']
+        return error['errors'][0]['reason'], error.get('message', '')
+    except Exception:
+        return None, body[:200]
+
+
+class AsyncYouTubeClient:
+    '''
+    Use as an async context manager:
+
+        async with AsyncYouTubeClient(api_key) as client:
+            title = await client.get_video_title(video_ID)
+    '''
+    def __init__(self, api_key, base_url=YOUTUBE_API_BASE_URL, rate_limiter=None, max_connections=YOUTUBE_MAX_CONNECTIONS,
+                 max_retries=YOUTUBE_MAX_RETRIES, backoff=YOUTUBE_RETRY_BACKOFF, record_path=None):
+        if aiohttp is None:
+            raise ImportError('aiohttp is needed for the asyncio YouTube client')
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.rate_limiter = rate_limiter or youtube_rate_limiter
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.record_path = record_path
+        self.session = None
+        self.num_requests = 0
+        self.num_retries = 0
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def _get_retry_wait(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        # Exponential backoff with jitter, so concurrent requests do not retry together
+        return self.backoff * 2 ** attempt * (0.5 + random.random() / 2)
+
+    def _record(self, resource, params, response):
+        os.makedirs(self.record_path, exist_ok=True)
+        with open(os.path.join(self.record_path, f'{get_record_key(resource, params)}.json'), 'w', encoding='utf-8') as f:
+            json.dump(response, f, ensure_ascii=False)
+
+    async def request(self, resource, **params):
+        '''
+        To GET a resource of the API, waiting on the rate limiter and retrying
+        429, 5xx, rate-limit 403 and connection errors up to max_retries times
+        '''
+        params = {name: value for name, value in params.items() if value is not None}
+        url = f'{self.base_url}/{resource}'
+
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire_async(YOUTUBE_QUOTA_COSTS.get(resource, 1))
+            self.num_requests += 1
+            retry_after = None
+            try:
+                async with self.session.get(url, params=dict(params, key=self.api_key)) as response:
+                    if response.status == 200:
+                        result = await response.json()
+                        if self.record_path:
+                            self._record(resource, params, result)
+                        return result
+
+                    body = await response.text()
+                    reason, message = _get_error_reason(body)
+                    if response.status == 403 and reason == 'quotaExceeded':
+                        raise QuotaExceededError(f'YouTube API quota used up: {message}')
+
+                    retryable = response.status == 429 or response.status >= 500 or (response.status == 403 and reason in RETRY_403_REASONS)
+                    error = YouTubeAPIError(response.status, reason, message)
+                    if not retryable:
+                        raise error
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == self.max_retries:
+                raise error
+            self.num_retries += 1
+            wait = self._get_retry_wait(attempt, retry_after)
+            print(f"Retrying {resource} in {wait:.1f}s after: {error}")
+            await asyncio.sleep(wait)
+
+    async def get_video_title(self, video_ID):
+        '''
+        To get the title of a video, or an empty string if it cannot be fetched
+        '''
+        try:
+            response = await self.request('videos', part='snippet', id=video_ID)
+            video_title = response['items'][0]['snippet']['title']
+            print(f"Fetching comments for video: {video_title}")
+            return video_title
+        except Exception as e:
+            print(f"Error fetching video title for video ID {video_ID}: {e}")
+            return ""
+
+    async def get_comment_page(self, video_ID, page_token=None, order=None):
+        '''
+        To get one page of comment threads, starting from the given page token
+        '''
+        with tracer.span('async_client.fetch_page', video_id=video_ID) as current:
+            response = await self.request('commentThreads', part='snippet', videoId=video_ID, textFormat='plainText',
+                                          maxResults=100, pageToken=page_token, order=order)
+            current.set(items=len(response.get('items', [])))
+            return response
+
+
+async def stream_comments_to_csv_async(client, video_ID, progress_callback=None, order=None):
+    '''
+    The asyncio counterpart of comments_collector.stream_comments_to_csv: the comments
+    are written to the CSV file page by page and checkpointed, so an interrupted
+    fetch resumes where it stopped, whichever client fetches it next.
+    Returns the video title, the number of comments written and whether the fetch completed.
+    '''
+    video_title = await client.get_video_title(video_ID)
+    if not video_title:
+        return "", 0, False
+
+    with CommentPageWriter(video_ID, video_title, order, progress_callback) as page_writer:
+        while True:
+            try:
+                response = await client.get_comment_page(video_ID, page_writer.next_page_token, order)
+            except Exception as e:
+                print(f"Error fetching comments for video ID {video_ID}: {e}")
+                break
+            if not page_writer.write_page(response):
+                break
+
+    return page_writer.finish()
+
+
+async def collect_comments_async(video_IDs, api_key, base_url=YOUTUBE_API_BASE_URL, rate_limiter=None,
+                                 max_concurrent_videos=COLLECTOR_MAX_WORKERS, progress_callback=None, order=None, record_path=None):
+    '''
+    To fetch the comments of many videos concurrently over one client.
+    Returns (title, number of comments, completed) for each video, in order; a video
+    that fails gets the exception instead.
+    '''
+    semaphore = asyncio.Semaphore(max_concurrent_videos)
+
+    async with AsyncYouTubeClient(api_key, base_url, rate_limiter, record_path=record_path) as client:
+        async def fetch_one(video_ID):
+            async with semaphore:
+                return await stream_comments_to_csv_async(client, video_ID, progress_callback, order)
+
+        return await asyncio.gather(*(fetch_one(video_ID) for video_ID in video_IDs), return_exceptions=True)
@@ -10,6 +10,13 @@ from apiclient.discovery import build
 from csv import writer
 from urllib.parse import urlparse, parse_qs
 import re
+import os
+
+from .rate_limiter import youtube_rate_limiter
+from modules.constants import PATH_TO_DATA
+from modules.datasets import dataset_store
+from modules.datasets.dataset_store import COMMENT_COLUMNS
+from modules.tracing import tracer
 
 def get_keys(filename):
     '''
@@ -49,108 +56,138 @@ def get_id(url):
 
 def save_to_csv(output_dict, filename):
     '''
-    To save the comments + other columns to the CSV file specified with name
+    To save the comments + other columns of the video with the given name.
+    Datasets are stored as Parquet when pyarrow is available, see dataset_store.export_csv for CSV.
     '''
-    if not output_dict['Comment']:
-        print(f"No comments found for {filename}. Skipping CSV save.")
-        return
-
-    # Remove special characters from the filename
-    safe_filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
+    dataset_store.save_dataset(output_dict, filename)
 
-    try:
-        output_df = pd.DataFrame(output_dict)
-        if output_df.empty:
-            print(f"DataFrame is empty for {safe_filename}. Skipping save.")
-            return
 
-        output_df.to_csv(f'./data/{safe_filename}.csv', index=False)
-        print(f"Successfully saved comments to ./data/{safe_filename}.csv")
-    except Exception as e:
-        print(f"Error saving CSV for {safe_filename}: {e}")
-
-
-def comments_helper(video_ID, api_key, service):
+def get_csv_path(video_title):
     '''
-    To get all comments in the form of a dictionary containing:
-    1. Comment ID
-    2. Comment text
-    3. Comment author
-    4. Comment likes
+    To get the path of the CSV file holding the comments of a video
     '''
+    return os.path.join(PATH_TO_DATA, f'{dataset_store.get_safe_name(video_title)}.csv')
 
-    # Lists to store extracted data
-    comments, commentsId, likesCount, authors = [], [], [], []
 
-    # Fetch video title
+def get_video_title(video_ID, service, rate_limiter=None):
+    '''
+    To get the title of a video, or an empty string if it cannot be fetched
+    '''
+    rate_limiter = rate_limiter or youtube_rate_limiter
     try:
+        rate_limiter.acquire()
         response_title = service.videos().list(
             part='snippet',
             id=video_ID
         ).execute()
         video_title = response_title['items'][0]['snippet']['title']
         print(f"Fetching comments for video: {video_title}")
+        return video_title
     except Exception as e:
         print(f"Error fetching video title for video ID {video_ID}: {e}")
-        return {}, ""
+        return ""
 
-    # Initial API request to get comments
-    try:
+
+def _get_comment_page(video_ID, service, rate_limiter, page_token=None, order=None):
+    '''
+    To request one page of comment threads, starting from the given page token.
+    order='time' asks for the newest comments first.
+    '''
+    with tracer.span('comments_collector.fetch_page', video_id=video_ID) as current:
+        start = time.perf_counter()
+        rate_limiter.acquire()
+        current.set(rate_limit_wait_seconds=time.perf_counter() - start)
+
+        request_args = {}
+        if page_token:
+            request_args['pageToken'] = page_token
+        if order:
+            request_args['order'] = order
         response = service.commentThreads().list(
             part="snippet",
             videoId=video_ID,
             textFormat="plainText",
-            maxResults=100
+            maxResults=100,
+            **request_args
         ).execute()
-    except Exception as e:
-        print(f"Error fetching comments for video ID {video_ID}: {e}")
-        return {}, video_title
+        current.set(items=len(response.get('items', [])))
+        return response
+
+
+def _parse_comment_page(response):
+    '''
+    To get the rows (comment, author, comment ID, like count) of a page of comment threads
+    '''
+    rows = []
+    for item in response['items']:
+        try:
+            comment = item["snippet"]["topLevelComment"]
+            author = comment["snippet"]["authorDisplayName"]
+            text = comment["snippet"]["textDisplay"]
+            comment_id = item['snippet']['topLevelComment']['id']
+            like_count = item['snippet']['topLevelComment']['snippet']['likeCount']
+
+            rows.append((text, author, comment_id, like_count))
+        except Exception as e:
+            print(f"Error parsing comment: {e}")
+    return rows
+
+
+def comments_helper(video_ID, api_key, service, rate_limiter=None, progress_callback=None):
+    '''
+    To get all comments in the form of a dictionary containing:
+    1. Comment ID
+    2. Comment text
+    3. Comment author
+    4. Comment likes
+    Every API call waits on the rate limiter, which is shared by the whole process by default.
+    progress_callback, if given, is called with the video ID, page number and comments fetched so far.
+    This keeps every comment in memory, use stream_comments_to_csv for large videos.
+    '''
+    rate_limiter = rate_limiter or youtube_rate_limiter
+
+    # Lists to store extracted data
+    comments, commentsId, likesCount, authors = [], [], [], []
+
+    # Fetch video title
+    video_title = get_video_title(video_ID, service, rate_limiter)
+    if not video_title:
+        return {}, ""
 
-    # Page number of comments
     page = 0
+    page_token = None
 
     # Fetch comments until there are no more pages
-    while response:
+    while True:
+        try:
+            response = _get_comment_page(video_ID, service, rate_limiter, page_token)
+        except Exception as e:
+            print(f"Error fetching comments for video ID {video_ID}: {e}")
+            break
+
         print(f"Processing page {page + 1}")
         page += 1
 
-        # Extract comments from the response
-        for item in response['items']:
-            try:
-                comment = item["snippet"]["topLevelComment"]
-                author = comment["snippet"]["authorDisplayName"]
-                text = comment["snippet"]["textDisplay"]
-                comment_id = item['snippet']['topLevelComment']['id']
-                like_count = item['snippet']['topLevelComment']['snippet']['likeCount']
-
-                # Append the comment data to the lists
-                comments.append(text)
-                commentsId.append(comment_id)
-                likesCount.append(like_count)
-                authors.append(author)
-            except Exception as e:
-                print(f"Error parsing comment: {e}")
+        # Append the comment data to the lists
+        for text, author, comment_id, like_count in _parse_comment_page(response):
+            comments.append(text)
+            commentsId.append(comment_id)
+            likesCount.append(like_count)
+            authors.append(author)
+
+        if progress_callback:
+            progress_callback(video_ID, page, len(comments))
 
         # Check if there's a next page of comments
-        if 'nextPageToken' in response:
-            time.sleep(0.1)  # Add a small delay to avoid rate limiting
-            try:
-                response = service.commentThreads().list(
-                    part="snippet",
-                    videoId=video_ID,
-                    textFormat="plainText",
-                    pageToken=response['nextPageToken'],
-                    maxResults=100
-                ).execute()
-            except Exception as e:
-                print(f"Error fetching next page of comments for video ID {video_ID}: {e}")
-                break
-        else:
-            # No more pages
+        page_token = response.get('nextPageToken')
+        if not page_token:
             break
 
     print(f"Fetched {len(comments)} comments.")
 
+    if not comments:
+        return {}, video_title
+
     # Return the data as a dictionary and the video title
     return {
         'Comment': comments,
@@ -158,3 +195,225 @@ def comments_helper(video_ID, api_key, service):
         'Comment ID': commentsId,
         'Like Count': likesCount
     }, video_title
+
+
+def _load_checkpoint(checkpoint_path, part_path, video_ID, order):
+    '''
+    To get the checkpoint of an interrupted fetch of the video, or None if there is none.
+    part_path, the file the fetched comments are written to, must exist too unless it is None.
+    '''
+    if not os.path.isfile(checkpoint_path) or (part_path is not None and not os.path.isfile(part_path)):
+        return None
+    try:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+    except Exception as e:
+        print(f"Error reading checkpoint {checkpoint_path}: {e}")
+        return None
+    if checkpoint.get('video_id') != video_ID or checkpoint.get('order') != order:
+        return None
+    return checkpoint
+
+
+def _save_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = f'{checkpoint_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+class CommentPageWriter:
+    '''
+    To write the comments of a video to its CSV file one page at a time, checkpointing
+    the next page token after every page so that an interrupted fetch resumes from the
+    last page written, whichever client fetches the video next. Shared by
+    stream_comments_to_csv and its asyncio counterpart:
+
+        with CommentPageWriter(video_ID, video_title, order) as page_writer:
+            while page_writer.write_page(fetch_page(page_writer.next_page_token)):
+                pass
+        video_title, num_comments, complete = page_writer.finish()
+    '''
+    def __init__(self, video_ID, video_title, order=None, progress_callback=None):
+        self.video_ID = video_ID
+        self.video_title = video_title
+        self.progress_callback = progress_callback
+        self.csv_path = get_csv_path(video_title)
+        self.part_path = f'{self.csv_path}.part'
+        self.checkpoint_path = f'{self.csv_path}.checkpoint.json'
+        self.complete = False
+
+        self.checkpoint = _load_checkpoint(self.checkpoint_path, self.part_path, video_ID, order)
+        if self.checkpoint:
+            print(f"Resuming from page {self.checkpoint['page'] + 1} with {self.checkpoint['num_comments']} comments already fetched")
+            self.file = open(self.part_path, 'r+', encoding='utf-8', newline='')
+            # Drop anything written after the last checkpoint
+            self.file.truncate(self.checkpoint['size'])
+            self.file.seek(self.checkpoint['size'])
+        else:
+            self.checkpoint = {'video_id': video_ID, 'order': order, 'page': 0, 'num_comments': 0, 'next_page_token': None}
+            self.file = open(self.part_path, 'w', encoding='utf-8', newline='')
+            writer(self.file).writerow(COMMENT_COLUMNS)
+        self.csv_writer = writer(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    @property
+    def next_page_token(self):
+        return self.checkpoint['next_page_token']
+
+    @property
+    def num_pages(self):
+        return self.checkpoint['page']
+
+    @property
+    def num_comments(self):
+        return self.checkpoint['num_comments']
+
+    def write_page(self, response):
+        '''
+        To write a page of comment threads and checkpoint it. Returns whether there are more pages.
+        '''
+        print(f"Processing page {self.checkpoint['page'] + 1}")
+        rows = _parse_comment_page(response)
+        self.csv_writer.writerows(rows)
+        self.file.flush()
+
+        self.checkpoint['page'] += 1
+        self.checkpoint['num_comments'] += len(rows)
+        self.checkpoint['next_page_token'] = response.get('nextPageToken')
+        self.checkpoint['size'] = self.file.tell()
+        _save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+        if self.progress_callback:
+            self.progress_callback(self.video_ID, self.checkpoint['page'], self.checkpoint['num_comments'])
+
+        # Check if there's a next page of comments
+        self.complete = not self.checkpoint['next_page_token']
+        return not self.complete
+
+    def finish(self):
+        '''
+        To store the dataset of a complete fetch, once the file is closed.
+        Returns the video title, the number of comments written and whether the fetch completed.
+        '''
+        num_comments = self.num_comments
+        if not self.complete:
+            print(f"Fetch of {self.video_title} interrupted after {num_comments} comments, run it again to resume.")
+            return self.video_title, num_comments, False
+
+        print(f"Fetched {num_comments} comments of {self.video_title}.")
+        os.remove(self.checkpoint_path)
+        if num_comments == 0:
+            os.remove(self.part_path)
+            print(f"No comments found for {self.video_title}. Skipping CSV save.")
+            return self.video_title, 0, True
+
+        os.replace(self.part_path, self.csv_path)
+
+        # Store the dataset as Parquet, converting the streamed CSV a chunk at a time
+        with tracer.span('dataset_store.import_csv', items=num_comments):
+            dataset_path = dataset_store.import_csv(self.csv_path, remove_csv=True)
+        print(f"Successfully saved comments to {dataset_path}")
+        return self.video_title, num_comments, True
+
+
+@tracer.traced('comments_collector.stream_comments')
+def stream_comments_to_csv(video_ID, service, rate_limiter=None, progress_callback=None, order=None):
+    '''
+    To fetch all comments of a video straight into its CSV file, one page at a time,
+    so memory use does not grow with the number of comments.
+    After every page the next page token is checkpointed; if the fetch fails it can be
+    run again and resumes from the last page written (see CommentPageWriter).
+    Returns the video title, the number of comments written and whether the fetch completed.
+    '''
+    rate_limiter = rate_limiter or youtube_rate_limiter
+
+    video_title = get_video_title(video_ID, service, rate_limiter)
+    if not video_title:
+        return "", 0, False
+
+    with CommentPageWriter(video_ID, video_title, order, progress_callback) as page_writer:
+        while True:
+            try:
+                response = _get_comment_page(video_ID, service, rate_limiter, page_writer.next_page_token, order)
+            except Exception as e:
+                print(f"Error fetching comments for video ID {video_ID}: {e}")
+                break
+            if not page_writer.write_page(response):
+                break
+
+    tracer.current_span().set(video_id=video_ID, pages=page_writer.num_pages, items=page_writer.num_comments, complete=page_writer.complete)
+    return page_writer.finish()
+
+
+@tracer.traced('comments_collector.refresh_comments')
+def refresh_comments_csv(video_ID, service, rate_limiter=None, progress_callback=None):
+    '''
+    To add the comments posted since the last fetch to a video's stored dataset.
+    Comments are fetched newest first and fetching stops at the first page that
+    reaches a Comment ID already stored; only the new rows are merged in, ahead
+    of the stored ones. Videos without a dataset yet are fetched in full.
+    The new rows and the next page token are checkpointed after every page, so a
+    refresh that fails can be run again and resumes from the last page fetched.
+    Returns the video title, the number of new comments and whether the refresh completed.
+    '''
+    rate_limiter = rate_limiter or youtube_rate_limiter
+
+    video_title = get_video_title(video_ID, service, rate_limiter)
+    if not video_title:
+        return "", 0, False
+
+    dataset_path = dataset_store.find_dataset(video_title)
+    if dataset_path is None:
+        print(f"No stored comments for {video_title}, fetching all of them.")
+        return stream_comments_to_csv(video_ID, service, rate_limiter, progress_callback, order='time')
+
+    known_ids = set(dataset_store.read_dataset(dataset_path, columns=['Comment ID'])['Comment ID'].astype(str))
+
+    # The checkpoint only holds for the version of the dataset it was taken on
+    dataset_version = dataset_store.get_dataset_version(os.path.basename(dataset_path))
+    checkpoint_path = f'{dataset_path}.refresh.json'
+    checkpoint = _load_checkpoint(checkpoint_path, None, video_ID, 'time')
+    if checkpoint and checkpoint.get('dataset_version') == dataset_version:
+        print(f"Resuming from page {checkpoint['page'] + 1} with {len(checkpoint['rows'])} new comments already fetched")
+    else:
+        checkpoint = {'video_id': video_ID, 'order': 'time', 'dataset_version': dataset_version, 'page': 0, 'next_page_token': None, 'rows': []}
+
+    while True:
+        try:
+            response = _get_comment_page(video_ID, service, rate_limiter, checkpoint['next_page_token'], order='time')
+        except Exception as e:
+            print(f"Error fetching comments for video ID {video_ID}: {e}")
+            print(f"Refresh of {video_title} interrupted after {len(checkpoint['rows'])} new comments, run it again to resume.")
+            return video_title, len(checkpoint['rows']), False
+
+        print(f"Processing page {checkpoint['page'] + 1}")
+        rows = _parse_comment_page(response)
+        # Comments come newest first, so the first stored one ends the new comments
+        reached_known = any(row[2] in known_ids for row in rows)
+        checkpoint['rows'].extend(row for row in rows if row[2] not in known_ids)
+        checkpoint['page'] += 1
+        checkpoint['next_page_token'] = None if reached_known else response.get('nextPageToken')
+        _save_checkpoint(checkpoint_path, checkpoint)
+
+        if progress_callback:
+            progress_callback(video_ID, checkpoint['page'], len(checkpoint['rows']))
+
+        if not checkpoint['next_page_token']:
+            break
+
+    new_rows = [tuple(row) for row in checkpoint['rows']]
+    print(f"Fetched {len(new_rows)} new comments in {checkpoint['page']} pages.")
+    tracer.current_span().set(video_id=video_ID, pages=checkpoint['page'], items=len(new_rows))
+    if new_rows:
+        # New rows first, then the stored ones
+        with tracer.span('dataset_store.prepend_rows', items=len(new_rows)):
+            dataset_store.prepend_rows(dataset_path, new_rows)
+        print(f"Successfully merged {len(new_rows)} new comments into {dataset_path}")
+    os.remove(checkpoint_path)
+    return video_title, len(new_rows), True
@@ -0,0 +1,84 @@
+'''
+Token-bucket rate limiter for the YouTube Data API, shared by every thread that
+talks to the API, which also keeps track of the daily quota units spent
+'''
+
+import time
+import asyncio
+import threading
+
+from modules.constants import *
+
+
+class QuotaExceededError(Exception):
+    '''
+    Raised when a request would go over the daily quota
+    '''
+    pass
+
+
+class RateLimiter:
+    def __init__(self, rate=YOUTUBE_REQUESTS_PER_SECOND, burst=None, quota=YOUTUBE_QUOTA_PER_DAY, quota_period=24 * 60 * 60):
+        self.rate = rate
+        self.burst = burst or rate
+        self.quota = quota
+        self.quota_period = quota_period
+
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.quota_used = 0
+        self.quota_start = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _spend_quota(self, cost):
+        if time.time() - self.quota_start >= self.quota_period:
+            self.quota_used = 0
+            self.quota_start = time.time()
+        if self.quota is not None and self.quota_used + cost > self.quota:
+            raise QuotaExceededError(f'YouTube API quota of {self.quota} units used up')
+        self.quota_used += cost
+
+    def _try_acquire(self, cost):
+        '''
+        To take a token if one is available, otherwise get how long to wait for it
+        '''
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self._spend_quota(cost)
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, cost=1):
+        '''
+        To wait until a request of the given quota cost is allowed
+        '''
+        while True:
+            wait = self._try_acquire(cost)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, cost=1):
+        '''
+        To wait, without blocking the event loop, until a request of the given quota cost is allowed
+        '''
+        while True:
+            wait = self._try_acquire(cost)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def get_quota_left(self):
+        with self.lock:
+            return None if self.quota is None else self.quota - self.quota_used
+
+
+# Limiter shared by every request made by this process
+youtube_rate_limiter = RateLimiter()
@@ -1,54 +1,186 @@
 import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .comments_collector import *
-from modules.constants import PATH_TO_API_KEY
+from .rate_limiter import youtube_rate_limiter
+from .async_client import async_client_available, collect_comments_async
+from modules.constants import PATH_TO_API_KEY, COLLECTOR_MAX_WORKERS, YOUTUBE_ASYNC_CLIENT, YOUTUBE_API_BASE_URL
+
+_api_keys = {}
+_thread_services = threading.local()
+
+
+def _read_api_key(api_key_file):
+    """
+    Reads the API key from the specified JSON file, once per file.
+    """
+    if api_key_file not in _api_keys:
+        # Read the API key from the JSON file
+        with open(api_key_file, 'r') as f:
+            creds = json.load(f)
+
+        # Get the API key and remove any extra whitespace or newlines
+        api_key = creds.get("api_key", "").strip()
+
+        if not api_key:
+            raise ValueError("API key not found in creds.json")
+
+        _api_keys[api_key_file] = api_key
+
+    return _api_keys[api_key_file]
+
 
 def build_service(api_key_file):
     """
     Reads the API key from the specified JSON file and initializes the YouTube service.
     """
-    # Read the API key from the JSON file
-    with open(api_key_file, 'r') as f:
-        creds = json.load(f)
-    
-    # Get the API key and remove any extra whitespace or newlines
-    api_key = creds.get("api_key", "").strip()
-
-    if not api_key:
-        raise ValueError("API key not found in creds.json")
+    api_key = _read_api_key(api_key_file)
 
     # Initialize and return the YouTube Data API service
     yt_service = build('youtube', 'v3', developerKey=api_key)
     return yt_service
 
-def _get_comments(video_url, api_key_file, order='time', part='snippet', maxResults=100):
+
+def get_service(api_key_file):
+    """
+    Returns the YouTube service of the calling thread, building it on first use.
+    googleapiclient services are not thread-safe, so each worker thread keeps its own
+    and reuses it for every video it fetches.
+    """
+    services = getattr(_thread_services, 'services', None)
+    if services is None:
+        services = _thread_services.services = {}
+    if api_key_file not in services:
+        services[api_key_file] = build_service(api_key_file)
+    return services[api_key_file]
+
+
+def _get_comments(video_url, api_key_file, order='time', part='snippet', maxResults=100, service=None, rate_limiter=None, progress_callback=None, refresh=False):
     """
     Fetches comments for a given YouTube video URL using the specified API key file.
+    With refresh=True only the comments posted since the last fetch are downloaded.
     """
-    # Build the YouTube service with the API key
-    yt_service = build_service(api_key_file)
-    
+    # Reuse the YouTube service of this thread unless one is given
+    yt_service = service or get_service(api_key_file)
+
     # Extract the video ID from the URL
     video_ID = get_id(video_url)
-    
-    # Get comments and the video title using the helper function
-    comments_dict, title = comments_helper(video_ID, api_key_file, yt_service)
-    
-    # Save the comments to a CSV file
-    save_to_csv(comments_dict, title)
-    
-    return title
 
-def get_comments_from_urls(urls):
+    if refresh:
+        # Fetch newest first until reaching comments that are already stored
+        return refresh_comments_csv(video_ID, yt_service, rate_limiter, progress_callback)
+
+    # Stream the comments to a CSV file, resuming an interrupted fetch of the same video
+    title, num_comments, complete = stream_comments_to_csv(video_ID, yt_service, rate_limiter, progress_callback, order)
+
+    return title, num_comments, complete
+
+
+def collect_comments(urls, api_key_file=PATH_TO_API_KEY, max_workers=COLLECTOR_MAX_WORKERS, service=None, rate_limiter=None, progress_callback=None, refresh=False):
+    """
+    Fetches comments for many YouTube video URLs in parallel.
+    All threads share one rate limiter so the API quota is respected globally, and a
+    failing video is reported in its result without stopping the others.
+    progress_callback, if given, is called with the URL, a status ('started', 'page',
+    'done' or 'failed') and a dictionary with details.
+    With refresh=True only comments newer than the stored ones are fetched, and
+    num_comments in the results counts the new comments.
+    Full fetches go through the asyncio client when aiohttp is installed, unless a
+    googleapiclient service is given.
+    Returns one result per URL, in the order of the URLs: its URL, title, num_comments
+    and error. The error is set when the video failed, was interrupted or has no comments;
+    the title is kept whenever it was fetched, so only results without an error are successes.
+    """
+    rate_limiter = rate_limiter or youtube_rate_limiter
+
+    def report(url, status, **details):
+        if progress_callback:
+            try:
+                progress_callback(url, status, details)
+            except Exception as e:
+                print(f"Error reporting progress for {url}: {e}")
+
+    def finish(url, fetched):
+        result = {'url': url, 'title': None, 'num_comments': 0, 'error': None}
+        if isinstance(fetched, Exception):
+            result['error'] = str(fetched)
+        else:
+            title, num_comments, complete = fetched
+            result['title'] = title or None
+            result['num_comments'] = num_comments
+            if not title:
+                result['error'] = 'Could not fetch the video details'
+            elif not complete:
+                result['error'] = f'Interrupted after {num_comments} comments, fetch the video again to resume'
+            elif not result['num_comments'] and not refresh:
+                result['error'] = 'No comments fetched'
+
+        if result['error']:
+            print(f"Failed to fetch comments from {url}: {result['error']}")
+            report(url, 'failed', error=result['error'])
+        else:
+            report(url, 'done', title=result['title'], num_comments=result['num_comments'])
+        return result
+
+    if YOUTUBE_ASYNC_CLIENT and async_client_available() and service is None and not refresh:
+        return _collect_comments_with_asyncio(urls, api_key_file, max_workers, rate_limiter, report, finish, base_url=YOUTUBE_API_BASE_URL)
+
+    def collect_one(url):
+        report(url, 'started')
+        try:
+            fetched = _get_comments(url, api_key_file,
+                                    service=service,
+                                    rate_limiter=rate_limiter,
+                                    progress_callback=lambda video_ID, page, num_comments: report(url, 'page', page=page, num_comments=num_comments),
+                                    refresh=refresh)
+        except Exception as e:
+            fetched = e
+        return finish(url, fetched)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls)))) as executor:
+        return list(executor.map(collect_one, urls))
+
+
+def _collect_comments_with_asyncio(urls, api_key_file, max_workers, rate_limiter, report, finish, base_url=YOUTUBE_API_BASE_URL):
+    """
+    Fetches the comments of every URL concurrently on one event loop, with the asyncio client.
+    """
+    try:
+        api_key = _read_api_key(api_key_file)
+    except Exception as e:
+        return [finish(url, e) for url in urls]
+
+    # URLs of the same video share one fetch
+    urls_by_ID = {}
+    for url in urls:
+        urls_by_ID.setdefault(get_id(url), []).append(url)
+        report(url, 'started')
+    video_IDs = list(urls_by_ID)
+
+    def report_page(video_ID, page, num_comments):
+        for url in urls_by_ID[video_ID]:
+            report(url, 'page', page=page, num_comments=num_comments)
+
+    fetched = asyncio.run(collect_comments_async(video_IDs, api_key, base_url, rate_limiter,
+                                                 max_concurrent_videos=max_workers, progress_callback=report_page))
+    fetched_by_ID = dict(zip(video_IDs, fetched))
+    return [finish(url, fetched_by_ID[get_id(url)]) for url in urls]
+
+
+def get_comments_from_urls(urls, refresh=False):
     """
     Fetches comments for a list of YouTube video URLs.
+    With refresh=True only new comments are added to the videos already stored.
+    Returns the video title of each URL, or None for videos that failed, were interrupted
+    or have no comments (collect_comments reports why).
     """
     # Get the path to the API key from the constants
     api_key_path = PATH_TO_API_KEY
-    
-    video_titles = []
-    for url in urls:
-        # Get comments for each URL and append the video title to the list
-        title = _get_comments(url, api_key_path)
-        video_titles.append(title)
-    
+
+    results = collect_comments(urls, api_key_path, refresh=refresh)
+
+    # Get the video title of each URL
+    video_titles = [None if result['error'] else result['title'] for result in results]
+
     return video_titles
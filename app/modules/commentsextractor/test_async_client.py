@@ -0,0 +1,59 @@
+import os
+import json
+
+import pytest
+
+from modules.commentsextractor import run_comments_collector
+from modules.commentsextractor.async_client import async_client_available
+from modules.commentsextractor.rate_limiter import RateLimiter
+from modules.datasets import dataset_store
+from benchmarks import stub_youtube_server
+
+pytestmark = pytest.mark.skipif(not async_client_available(), reason='aiohttp is not installed')
+
+COMMENTS = [f'comment number {i} about the video' for i in range(250)]
+
+
+@pytest.fixture
+def server(workdir, monkeypatch):
+    record_path = os.path.join(str(workdir), 'recorded')
+    stub_youtube_server.record_synthetic_video(record_path, 'video', 'Stub video', COMMENTS)
+    server, base_url = stub_youtube_server.start_server(record_path)
+    server.record_path = record_path
+    monkeypatch.setattr(run_comments_collector, 'YOUTUBE_ASYNC_CLIENT', True)
+    monkeypatch.setattr(run_comments_collector, 'YOUTUBE_API_BASE_URL', base_url)
+    with open('creds.json', 'w') as f:
+        json.dump({'api_key': 'stub'}, f)
+    yield server
+    server.shutdown()
+
+
+def collect(urls):
+    return run_comments_collector.collect_comments(urls, 'creds.json', rate_limiter=RateLimiter(rate=1000, quota=None))
+
+
+def test_interrupted_fetch_resumes_from_the_last_page(server):
+    # The last page is missing, so the fetch stops after the first two
+    page_names = [name for name in os.listdir(server.record_path) if name.startswith('commentThreads')]
+    pages = {}
+    for name in page_names:
+        with open(os.path.join(server.record_path, name)) as f:
+            pages[name] = f.read()
+    missing = next(name for name, page in pages.items() if 'nextPageToken' not in page)
+    os.remove(os.path.join(server.record_path, missing))
+
+    # Both URLs are the same video, fetched once
+    urls = ['https://www.youtube.com/watch?v=video', 'https://youtu.be/video']
+    results = collect(urls)
+    assert [result['error'] for result in results] == ['Interrupted after 200 comments, fetch the video again to resume'] * 2
+    assert server.num_requests == 4
+
+    with open(os.path.join(server.record_path, missing), 'w') as f:
+        f.write(pages[missing])
+    results = collect(urls[:1])
+    assert results[0]['error'] is None and results[0]['num_comments'] == 250
+    # Only the title and the missing page are requested again
+    assert server.num_requests == 6
+
+    df = dataset_store.read_dataset(dataset_store.find_dataset('Stub video'))
+    assert df['Comment'].tolist() == COMMENTS
@@ -0,0 +1,74 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from modules.commentsextractor.rate_limiter import RateLimiter, QuotaExceededError
+
+
+def test_burst_then_rate():
+    limiter = RateLimiter(rate=50, burst=5, quota=None)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.05
+
+    for _ in range(10):
+        limiter.acquire()
+    # 10 requests past the burst take at least 10 / 50 seconds
+    assert time.monotonic() - start >= 0.18
+
+
+def test_rate_is_shared_by_threads():
+    limiter = RateLimiter(rate=100, burst=1, quota=None)
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(10)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start >= 0.38
+
+
+def test_quota_is_enforced():
+    limiter = RateLimiter(rate=1000, quota=3)
+    limiter.acquire(cost=2)
+    assert limiter.get_quota_left() == 1
+    with pytest.raises(QuotaExceededError):
+        limiter.acquire(cost=2)
+    limiter.acquire(cost=1)
+    assert limiter.get_quota_left() == 0
+
+
+def test_quota_resets_after_its_period():
+    limiter = RateLimiter(rate=1000, quota=1, quota_period=0.05)
+    limiter.acquire()
+    time.sleep(0.06)
+    limiter.acquire()
+    assert limiter.get_quota_left() == 0
+
+
+def test_async_acquire_waits_without_blocking():
+    limiter = RateLimiter(rate=50, burst=1, quota=None)
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        ticker = asyncio.ensure_future(tick())
+        for _ in range(6):
+            await limiter.acquire_async()
+        ticker.cancel()
+        return ticks
+
+    start = time.monotonic()
+    ticks = asyncio.run(run())
+    assert time.monotonic() - start >= 0.09
+    # The event loop kept running other tasks while waiting
+    assert ticks > 5
@@ -0,0 +1,146 @@
+import pytest
+
+from modules.commentsextractor import run_comments_collector
+from modules.commentsextractor.rate_limiter import RateLimiter
+from modules.datasets import dataset_store
+
+
+class FakeRequest:
+    def __init__(self, respond):
+        self.respond = respond
+
+    def execute(self):
+        return self.respond()
+
+
+class FakeService:
+    '''
+    Stands in for the googleapiclient YouTube service: videos are titles and pages of
+    comments, and fail_after makes the request for that page number fail
+    '''
+    def __init__(self, videos):
+        self.videos_by_id = videos
+        self.requested_pages = []
+
+    def videos(self):
+        return self
+
+    def commentThreads(self):
+        return self
+
+    def list(self, part, id=None, videoId=None, pageToken=None, **kwargs):
+        if id is not None:
+            return FakeRequest(lambda: self._get_video(id))
+        return FakeRequest(lambda: self._get_page(videoId, int(pageToken or 0)))
+
+    def _get_video(self, video_ID):
+        if video_ID not in self.videos_by_id:
+            raise RuntimeError('videoNotFound')
+        return {'items': [{'snippet': {'title': self.videos_by_id[video_ID]['title']}}]}
+
+    def _get_page(self, video_ID, page):
+        self.requested_pages.append((video_ID, page))
+        video = self.videos_by_id[video_ID]
+        if page == video.get('fail_after'):
+            raise RuntimeError('backendError')
+        pages = video['pages']
+        items = [{'snippet': {'topLevelComment': {'id': f'{video_ID}-{page}-{i}',
+                                                  'snippet': {'authorDisplayName': 'someone', 'textDisplay': text, 'likeCount': i}}}}
+                 for i, text in enumerate(pages[page] if pages else [])]
+        response = {'items': items}
+        if page + 1 < len(pages):
+            response['nextPageToken'] = str(page + 1)
+        return response
+
+
+# Newest first: two pages of new comments, then the stored ones
+VIDEOS = {'refreshed': {'title': 'Refreshed video', 'pages': [['newest comment', 'new comment'], ['older new comment'], ['stored comment', 'older stored comment'], ['oldest stored comment']]},
+          'good': {'title': 'Good video', 'pages': [['a first comment that is long enough'] * 3, ['another comment that is long enough']]},
+          'empty': {'title': 'Empty video', 'pages': []},
+          'interrupted': {'title': 'Interrupted video', 'pages': [['a comment that is long enough'], ['never fetched']], 'fail_after': 1}}
+
+URLS = ['https://www.youtube.com/watch?v=good', 'https://www.youtube.com/watch?v=empty',
+        'https://www.youtube.com/watch?v=interrupted', 'https://www.youtube.com/watch?v=missing']
+
+
+@pytest.fixture
+def service(workdir, monkeypatch):
+    service = FakeService(VIDEOS)
+    monkeypatch.setattr(run_comments_collector, 'get_service', lambda api_key_file: service)
+    monkeypatch.setattr(run_comments_collector, 'YOUTUBE_ASYNC_CLIENT', False)
+    return service
+
+
+def test_collect_comments_reports_every_failure(service):
+    events = []
+    results = run_comments_collector.collect_comments(URLS, service=service, rate_limiter=RateLimiter(rate=1000, quota=None),
+                                                      progress_callback=lambda url, status, details: events.append((url, status)))
+
+    assert [result['error'] is None for result in results] == [True, False, False, False]
+    assert results[0]['title'] == 'Good video' and results[0]['num_comments'] == 4
+    assert results[1]['error'] == 'No comments fetched'
+    assert results[2]['error'].startswith('Interrupted after 1 comments')
+    assert results[3]['title'] is None
+    assert [(url, 'failed') in events for url in URLS] == [False, True, True, True]
+    assert dataset_store.find_dataset('Good video') is not None
+
+
+def test_failed_videos_have_no_title(service):
+    assert run_comments_collector.get_comments_from_urls(URLS) == ['Good video', None, None, None]
+
+
+def test_interrupted_fetch_resumes(service):
+    assert run_comments_collector.get_comments_from_urls([URLS[2]]) == [None]
+    del VIDEOS['interrupted']['fail_after']
+    try:
+        results = run_comments_collector.collect_comments([URLS[2]], service=service, rate_limiter=RateLimiter(rate=1000, quota=None))
+    finally:
+        VIDEOS['interrupted']['fail_after'] = 1
+    assert results[0]['error'] is None
+    assert results[0]['num_comments'] == 2
+
+
+@pytest.fixture
+def stored_video(service):
+    dataset_store.save_dataset({'Comment': ['stored comment', 'older stored comment', 'oldest stored comment'], 'Author': ['someone'] * 3,
+                                'Comment ID': ['refreshed-2-0', 'refreshed-2-1', 'refreshed-3-0'], 'Like Count': [0, 1, 0]}, 'Refreshed video')
+    return service
+
+
+def refresh(service):
+    return run_comments_collector.collect_comments(['https://www.youtube.com/watch?v=refreshed'], service=service,
+                                                   rate_limiter=RateLimiter(rate=1000, quota=None), refresh=True)[0]
+
+
+def read_comments(title):
+    return dataset_store.read_dataset(dataset_store.find_dataset(title))['Comment'].tolist()
+
+
+def test_refresh_stops_at_the_first_stored_comment(stored_video):
+    result = refresh(stored_video)
+    assert result['error'] is None and result['num_comments'] == 3
+    assert stored_video.requested_pages == [('refreshed', 0), ('refreshed', 1), ('refreshed', 2)]
+    assert read_comments('Refreshed video') == ['newest comment', 'new comment', 'older new comment',
+                                                'stored comment', 'older stored comment', 'oldest stored comment']
+
+    # Nothing new: the first page already reaches a stored comment
+    stored_video.requested_pages.clear()
+    result = refresh(stored_video)
+    assert result['num_comments'] == 0
+    assert stored_video.requested_pages == [('refreshed', 0)]
+    assert len(read_comments('Refreshed video')) == 6
+
+
+def test_failed_refresh_resumes_without_losing_pages(stored_video, monkeypatch):
+    monkeypatch.setitem(VIDEOS['refreshed'], 'fail_after', 1)
+    result = refresh(stored_video)
+    assert result['error'].startswith('Interrupted after 2 comments')
+    assert len(read_comments('Refreshed video')) == 3
+
+    monkeypatch.delitem(VIDEOS['refreshed'], 'fail_after')
+    stored_video.requested_pages.clear()
+    result = refresh(stored_video)
+    assert result['error'] is None and result['num_comments'] == 3
+    # The first page is not fetched again
+    assert stored_video.requested_pages == [('refreshed', 1), ('refreshed', 2)]
+    assert read_comments('Refreshed video')[:4] == ['newest comment', 'new comment', 'older new comment', 'stored comment']
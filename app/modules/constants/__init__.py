@@ -20,4 +20,179 @@ DICT_OF_CLOUDS = {'Simple Cloud' : 'fas fa-cloud',\
                     'Cute Dog': 'fas fa-dog', \
                     'Coffee Mug': 'fas fa-mug-hot'}
 
-OPTION_OF_CLOUDS = ['Simple Cloud', 'Retro Camera', 'Bitten Cookie', 'Cute Dog', 'Coffee Mug']
\ No newline at end of file
+OPTION_OF_CLOUDS = ['Simple Cloud', 'Retro Camera', 'Bitten Cookie', 'Cute Dog', 'Coffee Mug']
+
+# Clustering: comments at least CLUSTER_THRESHOLD similar form a topic of at least CLUSTER_MIN_COMMUNITY_SIZE comments
+CLUSTER_THRESHOLD = 0.85
+
+CLUSTER_MIN_COMMUNITY_SIZE = 15
+
+# Neighbour lists saved once per dataset, from which clusters are derived for any threshold
+# down to NEIGHBOUR_MIN_THRESHOLD; at most NEIGHBOUR_MAX_PER_ROW neighbours are kept per comment
+# (clusters are computed again when that cut could change them) and NEIGHBOUR_CACHE_MAX_ENTRIES
+# neighbour lists are kept in memory
+NEIGHBOUR_MIN_THRESHOLD = 0.75
+
+NEIGHBOUR_MAX_PER_ROW = 5000
+
+NEIGHBOUR_CACHE_MAX_ENTRIES = 4
+
+PATH_TO_NEIGHBOURS = './data/cache/neighbours'
+
+# Topics saved with a summary of every cluster: its size, centroid, TOPIC_NUM_REPRESENTATIVES
+# distinct comments closest to the centroid and TOPIC_NUM_KEYWORDS most frequent words;
+# TOPIC_CACHE_MAX_ENTRIES sets of topics are kept in memory
+PATH_TO_TOPICS = './data/cache/topics'
+
+TOPIC_NUM_REPRESENTATIVES = 5
+
+TOPIC_NUM_KEYWORDS = 10
+
+TOPIC_CACHE_MAX_ENTRIES = 16
+
+# Number of similarity matrix rows computed at a time by blocked community detection
+DETECTION_BLOCK_SIZE = 512
+
+# Corpora larger than this are clustered in blocks instead of with the full N x N matrix
+BLOCKED_DETECTION_MIN_SIZE = 20000
+
+# Corpora larger than this are clustered approximately: the comments of every IVF list are
+# only compared with those of the CLUSTERING_NPROBE lists closest to it (more is more accurate and slower)
+APPROXIMATE_CLUSTERING_MIN_SIZE = 200000
+
+CLUSTERING_NPROBE = 10
+
+# Models used to embed comments and to rerank retrieved comments
+ENCODER_MODEL_NAME = 'distilbert-base-nli-stsb-quora-ranking'
+
+CROSS_ENCODER_MODEL_NAME = 'cross-encoder/ms-marco-TinyBERT-L-6'
+
+# Load the models when the app starts instead of on the first query
+WARM_UP_MODELS = True
+
+# Content-addressed embedding store shared by clustering and retrieval
+PATH_TO_EMBEDDING_STORE = './data/cache/embeddings'
+
+# Corpus keys of dataset versions kept in memory, so a dataset is hashed once per version
+CORPUS_KEY_CACHE_SIZE = 64
+
+# Form of the corpus embeddings used by clustering and retrieval: 'float32', or 'float16'
+# and 'int8' to use half or a quarter of the memory, and rows converted back to float32 at a time
+EMBEDDING_DTYPE = 'float32'
+
+QUANTIZATION_CHUNK_SIZE = 8192
+
+# Retrieval uses an approximate nearest-neighbour (IVF) index above this corpus size
+ANN_MIN_CORPUS_SIZE = 20000
+
+# Number of IVF lists searched per query: higher is more accurate and slower. None uses the
+# nprobe picked when the index is built: the smallest one, from ANN_MIN_NPROBE and doubling,
+# whose recall@10 against exact search is at least ANN_TARGET_RECALL
+ANN_NPROBE = None
+
+ANN_MIN_NPROBE = 8
+
+ANN_TARGET_RECALL = 0.95
+
+# Number of IVF indexes kept in memory
+ANN_CACHE_MAX_ENTRIES = 8
+
+# Number of corpus vectors used as queries to measure the index recall@10
+ANN_RECALL_QUERIES = 200
+
+# Cross-encoder scores are cached in memory (LRU) and optionally on disk
+RERANK_CACHE_SIZE = 50000
+
+RERANK_DISK_CACHE = True
+
+PATH_TO_RERANK_CACHE = './data/cache/rerank_cache.sqlite'
+
+# Number of bi-encoder hits rescored by the cross-encoder
+RERANK_DEPTH = 10
+
+# Skip reranking when the top bi-encoder hit leads the next one by at least this much (None to always rerank)
+RERANK_SKIP_MARGIN = None
+
+# Number of query embeddings kept in memory
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+
+# YouTube Data API limits shared by every collector thread: request rate and daily quota units
+YOUTUBE_REQUESTS_PER_SECOND = 10
+
+YOUTUBE_QUOTA_PER_DAY = 10000
+
+# Number of videos fetched at the same time
+COLLECTOR_MAX_WORKERS = 4
+
+# Loaded datasets and their results kept in memory across reruns and sessions
+DATASET_CACHE_MAX_ENTRIES = 8
+
+DATASET_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Sentiment scoring: comments per batch, worker processes (None for one per CPU),
+# the number of comments to score before a process pool is worth starting
+# and the number of comment polarities kept in memory (LRU)
+SENTIMENT_BATCH_SIZE = 2000
+
+SENTIMENT_PROCESSES = None
+
+SENTIMENT_PARALLEL_MIN = 5000
+
+SENTIMENT_CACHE_SIZE = 500000
+
+COLUMN_SENTIMENT = 'Sentiment'
+
+# Term-frequency index (document-term matrices of words and bigrams) of every dataset
+PATH_TO_TERM_INDEX = './data/cache/terms'
+
+# Emoji counting: comments scanned per chunk, worker processes (None for one per CPU)
+# and the number of comments to scan before a process pool is worth starting
+EMOJI_CHUNK_SIZE = 10000
+
+EMOJI_PROCESSES = None
+
+EMOJI_PARALLEL_MIN = 100000
+
+# Results precomputed by the headless pipeline (run_pipeline.py), loaded by the app instead of recomputing
+PATH_TO_RESULTS = './data/results'
+
+PIPELINE_STAGES = ['clusters', 'emojis', 'statistics', 'sentiment', 'queries']
+
+# Datasets analysed at the same time, each worker process loads its own copy of the models
+PIPELINE_MAX_WORKERS = 2
+
+# Tracing of the analysis steps: spans kept in memory for the app, JSON lines log,
+# per-span peak of Python allocations (tracemalloc, slows everything down) and cProfile output
+TRACE_ENABLED = True
+
+TRACE_LOG = True
+
+PATH_TO_TRACE_LOG = './data/cache/trace.jsonl'
+
+TRACE_MAX_RECORDS = 1000
+
+TRACE_MEMORY = False
+
+PATH_TO_PROFILES = './data/cache/profiles'
+
+# Asyncio YouTube client (needs aiohttp): API address (a local stub server in tests),
+# quota units of each request, open connections, and retries of rate-limited or failed requests
+YOUTUBE_ASYNC_CLIENT = True
+
+YOUTUBE_API_BASE_URL = 'https://www.googleapis.com/youtube/v3'
+
+YOUTUBE_QUOTA_COSTS = {'videos': 1, 'commentThreads': 1}
+
+YOUTUBE_MAX_CONNECTIONS = 10
+
+YOUTUBE_MAX_RETRIES = 5
+
+YOUTUBE_RETRY_BACKOFF = 1.0
+
+# Background jobs of the app (fetching, clustering): worker threads shared by every session,
+# seconds between two polls of a running job, and seconds finished jobs are kept for
+JOB_MAX_WORKERS = 2
+
+JOB_POLL_INTERVAL = 1.0
+
+JOB_RESULT_TTL = 3600
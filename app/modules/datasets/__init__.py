@@ -0,0 +1 @@
+from .dataset_store import *
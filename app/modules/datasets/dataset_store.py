@@ -0,0 +1,207 @@
+'''
+Storage of the comment datasets under ./data.
+Datasets are written as Parquet when pyarrow is installed, so loaders can read only
+the columns they need; CSV files can still be imported, exported and loaded.
+'''
+
+import os
+import re
+import shutil
+import itertools
+import pandas as pd
+from csv import writer
+
+from modules.constants import *
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+COMMENT_COLUMNS = ['Comment', 'Author', 'Comment ID', 'Like Count']
+
+DATASET_EXTENSIONS = ('.parquet', '.csv')
+
+# Rows read at a time when converting or merging datasets
+CHUNK_SIZE = 50000
+
+
+def parquet_available():
+    return pq is not None
+
+
+def get_safe_name(title):
+    '''
+    To get a file name from a video title by removing special characters
+    '''
+    return re.sub(r'[<>:"/\\|?*]', '_', title)
+
+
+def get_dataset_path(filename):
+    return os.path.join(PATH_TO_DATA, filename)
+
+
+def get_dataset_version(filename):
+    '''
+    To get the modification time and size of a dataset file, which change whenever it is rewritten
+    '''
+    file_stat = os.stat(get_dataset_path(filename))
+    return [file_stat.st_mtime_ns, file_stat.st_size]
+
+
+def find_dataset(title):
+    '''
+    To get the path of the stored dataset of a video, preferring Parquet over CSV,
+    or None if the video has not been fetched yet
+    '''
+    safe_name = get_safe_name(title)
+    for extension in DATASET_EXTENSIONS:
+        path = os.path.join(PATH_TO_DATA, f'{safe_name}{extension}')
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def list_datasets():
+    '''
+    To get the file names of all datasets; a video stored both as Parquet and as CSV
+    is only listed once, as Parquet
+    '''
+    file_names = sorted(str(filename) for filename in os.listdir(PATH_TO_DATA))
+    datasets = {}
+    for filename in file_names:
+        stem, extension = os.path.splitext(filename)
+        if extension in DATASET_EXTENSIONS and (stem not in datasets or extension == '.parquet'):
+            datasets[stem] = filename
+    return sorted(datasets.values())
+
+
+def _get_schema():
+    return pa.schema([('Comment', pa.string()),
+                      ('Author', pa.string()),
+                      ('Comment ID', pa.string()),
+                      ('Like Count', pa.int64())])
+
+
+def _to_table(df):
+    df = df[COMMENT_COLUMNS].copy()
+    for column in ('Comment', 'Author', 'Comment ID'):
+        df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    df['Like Count'] = pd.to_numeric(df['Like Count'], errors='coerce').fillna(0).astype('int64')
+    return pa.Table.from_pandas(df, schema=_get_schema(), preserve_index=False)
+
+
+def read_dataset(path, columns=None):
+    '''
+    To read a dataset, only loading the given columns
+    '''
+    if path.endswith('.parquet'):
+        return pq.read_table(path, columns=columns).to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+def save_dataset(output_dict, title):
+    '''
+    To save the comments + other columns of a video, as Parquet when available and CSV otherwise.
+    Returns the path written, or None if there was nothing to save.
+    '''
+    if not output_dict.get('Comment'):
+        print(f"No comments found for {title}. Skipping save.")
+        return None
+
+    output_df = pd.DataFrame(output_dict)
+    path = os.path.join(PATH_TO_DATA, get_safe_name(title))
+    try:
+        if parquet_available():
+            path = f'{path}.parquet'
+            pq.write_table(_to_table(output_df), path)
+        else:
+            path = f'{path}.csv'
+            output_df.to_csv(path, index=False)
+        print(f"Successfully saved comments to {path}")
+        return path
+    except Exception as e:
+        print(f"Error saving comments for {title}: {e}")
+        return None
+
+
+def import_csv(csv_path, remove_csv=False):
+    '''
+    To convert a CSV dataset to Parquet next to it, reading it in chunks.
+    Returns the path of the dataset to use afterwards.
+    '''
+    if not parquet_available():
+        return csv_path
+
+    parquet_path = f'{os.path.splitext(csv_path)[0]}.parquet'
+    tmp_path = f'{parquet_path}.tmp'
+    with pq.ParquetWriter(tmp_path, _get_schema()) as parquet_writer:
+        for chunk in pd.read_csv(csv_path, chunksize=CHUNK_SIZE, dtype={'Comment ID': str}):
+            parquet_writer.write_table(_to_table(chunk))
+    os.replace(tmp_path, parquet_path)
+
+    if remove_csv:
+        os.remove(csv_path)
+    return parquet_path
+
+
+def export_csv(path, csv_path=None):
+    '''
+    To write a dataset out as CSV, one row group at a time
+    '''
+    if csv_path is None:
+        csv_path = f'{os.path.splitext(path)[0]}.csv'
+    if not path.endswith('.parquet'):
+        if os.path.abspath(path) != os.path.abspath(csv_path):
+            shutil.copyfile(path, csv_path)
+        return csv_path
+
+    with open(path, 'rb') as source:
+        parquet_file = pq.ParquetFile(source)
+        for group in range(parquet_file.num_row_groups):
+            parquet_file.read_row_group(group).to_pandas().to_csv(csv_path, index=False, header=(group == 0), mode='w' if group == 0 else 'a')
+        if parquet_file.num_row_groups == 0:
+            pd.DataFrame(columns=COMMENT_COLUMNS).to_csv(csv_path, index=False)
+    return csv_path
+
+
+def _write_row_groups(parquet_writer, tables):
+    '''
+    To write tables as row groups of CHUNK_SIZE rows, whatever their own sizes, so that
+    datasets merged again and again do not pile up small row groups
+    '''
+    pending, num_pending = [], 0
+    for table in tables:
+        pending.append(table)
+        num_pending += table.num_rows
+        if num_pending >= CHUNK_SIZE:
+            merged = pa.concat_tables(pending)
+            num_full = num_pending - num_pending % CHUNK_SIZE
+            parquet_writer.write_table(merged.slice(0, num_full), row_group_size=CHUNK_SIZE)
+            pending, num_pending = [merged.slice(num_full)], num_pending - num_full
+    if num_pending:
+        parquet_writer.write_table(pa.concat_tables(pending))
+
+
+def prepend_rows(path, rows):
+    '''
+    To add rows (comment, author, comment ID, like count) ahead of those already in a
+    dataset, copying the stored rows in chunks rather than loading them all.
+    Parquet datasets are rewritten in row groups of CHUNK_SIZE rows.
+    '''
+    tmp_path = f'{path}.merge.tmp'
+    if path.endswith('.parquet'):
+        # The stored file is closed before it is replaced, which Windows requires
+        with open(path, 'rb') as source, pq.ParquetWriter(tmp_path, _get_schema()) as parquet_writer:
+            parquet_file = pq.ParquetFile(source)
+            stored = (parquet_file.read_row_group(group).cast(_get_schema()) for group in range(parquet_file.num_row_groups))
+            _write_row_groups(parquet_writer, itertools.chain([_to_table(pd.DataFrame(rows, columns=COMMENT_COLUMNS))], stored))
+    else:
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as out, open(path, encoding='utf-8', newline='') as stored:
+            writer(out).writerow(COMMENT_COLUMNS)
+            writer(out).writerows(rows)
+            stored.readline()
+            shutil.copyfileobj(stored, out)
+    os.replace(tmp_path, path)
@@ -0,0 +1,43 @@
+import os
+
+import pyarrow.parquet as pq
+
+from modules.datasets import dataset_store
+
+
+def _rows(start, count):
+    return [(f'comment {i}', f'author {i}', str(i), i) for i in range(start, start + count)]
+
+
+def _save(rows, title='video'):
+    return dataset_store.save_dataset({column: [row[i] for row in rows] for i, column in enumerate(dataset_store.COMMENT_COLUMNS)}, title)
+
+
+def test_prepended_rows_come_first(workdir):
+    path = _save(_rows(100, 5))
+    dataset_store.prepend_rows(path, _rows(0, 3))
+
+    df = dataset_store.read_dataset(path)
+    assert df['Comment ID'].tolist() == ['0', '1', '2', '100', '101', '102', '103', '104']
+    assert df['Like Count'].dtype == 'int64'
+    assert not os.path.exists(f'{path}.merge.tmp')
+
+
+def test_refreshes_do_not_pile_up_row_groups(workdir, monkeypatch):
+    monkeypatch.setattr(dataset_store, 'CHUNK_SIZE', 10)
+    path = _save(_rows(1000, 25))
+    for refresh in range(8):
+        dataset_store.prepend_rows(path, _rows(refresh * 3, 3))
+
+    with open(path, 'rb') as f:
+        metadata = pq.ParquetFile(f).metadata
+    assert metadata.num_rows == 49
+    assert [metadata.row_group(group).num_rows for group in range(metadata.num_row_groups)] == [10, 10, 10, 10, 9]
+    assert dataset_store.read_dataset(path)['Comment ID'].tolist()[:6] == ['21', '22', '23', '18', '19', '20']
+
+
+def test_csv_datasets_are_prepended_too(workdir):
+    path = os.path.join('data', 'video.csv')
+    dataset_store.export_csv(_save(_rows(10, 2)), path)
+    dataset_store.prepend_rows(path, _rows(0, 1))
+    assert dataset_store.read_dataset(path)['Comment ID'].astype(str).tolist() == ['0', '10', '11']
@@ -0,0 +1 @@
+from .embedding_store import *
@@ -0,0 +1,332 @@
+'''
+Content-addressed store for corpus embeddings.
+Embeddings are keyed by a hash of the model name and the comment texts, saved as
+raw .npy files and opened memory-mapped, so every session and process reading
+the same corpus shares the same pages.
+Individual comment embeddings are also kept per model, keyed by Comment ID, so a
+re-fetched video only encodes the comments that were not seen before.
+Corpora can also be stored quantized (float16 or int8, see EMBEDDING_DTYPE) next to
+their float32 embeddings.
+'''
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+from modules.constants import *
+from modules.models import model_registry
+from modules.datasets import dataset_store
+from modules.tracing import tracer
+from . import quantization
+
+_dataset_corpus_keys = OrderedDict()
+# Index of the per-comment store of every model: store path -> index and keys files read
+_comment_indexes = {}
+
+
+def get_corpus_key(comments_list, model_name=ENCODER_MODEL_NAME):
+    '''
+    To get the key of a corpus: a hash of the model name and every comment text, in order
+    '''
+    corpus_hash = hashlib.sha256(model_name.encode('utf-8'))
+    for comment in comments_list:
+        comment = comment.encode('utf-8')
+        # Length prefix so that different splits of the same text hash differently
+        corpus_hash.update(len(comment).to_bytes(8, 'little'))
+        corpus_hash.update(comment)
+    return corpus_hash.hexdigest()[:32]
+
+
+def get_dataset_corpus_key(filename, comments_list, model_name=ENCODER_MODEL_NAME):
+    '''
+    To get the key of the comments of a dataset, hashing them once per version of the
+    dataset file (its modification time and size), so repeated queries skip the hash.
+    Comments that do not come from a dataset file are hashed every time.
+    '''
+    try:
+        version = (filename, *dataset_store.get_dataset_version(filename), len(comments_list), model_name)
+    except (OSError, TypeError):
+        return get_corpus_key(comments_list, model_name)
+
+    if version in _dataset_corpus_keys:
+        _dataset_corpus_keys.move_to_end(version)
+        return _dataset_corpus_keys[version]
+
+    corpus_key = get_corpus_key(comments_list, model_name)
+    _dataset_corpus_keys[version] = corpus_key
+    while len(_dataset_corpus_keys) > CORPUS_KEY_CACHE_SIZE:
+        _dataset_corpus_keys.popitem(last=False)
+    return corpus_key
+
+
+def _get_paths(key):
+    return (os.path.join(PATH_TO_EMBEDDING_STORE, f'{key}.npy'),
+            os.path.join(PATH_TO_EMBEDDING_STORE, f'{key}.json'))
+
+
+def _get_quantized_paths(key, dtype):
+    return (os.path.join(PATH_TO_EMBEDDING_STORE, f'{key}_{dtype}.npy'),
+            os.path.join(PATH_TO_EMBEDDING_STORE, f'{key}_{dtype}_scales.npy'))
+
+
+def _write_array(path, array):
+    '''
+    To write an array through a temporary file, so that readers never see a partially written file
+    '''
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(tmp_path, path)
+
+
+def _load_embeddings(key, num_comments, model_name):
+    '''
+    To open stored embeddings memory-mapped, or get None if they are missing or
+    do not match the corpus they are supposed to belong to
+    '''
+    embeddings_path, meta_path = _get_paths(key)
+    if not (os.path.isfile(embeddings_path) and os.path.isfile(meta_path)):
+        return None
+
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        # Copy-on-write mapping: pages are shared, and nothing is ever written back
+        embeddings = np.load(embeddings_path, mmap_mode='c')
+    except Exception as e:
+        print(f"Error loading embeddings {key}: {e}")
+        return None
+
+    if meta.get('model') != model_name or embeddings.shape[0] != num_comments or meta.get('count') != num_comments:
+        print(f"Stored embeddings {key} do not match the corpus, they will be recomputed")
+        return None
+
+    return embeddings
+
+
+def _save_embeddings(key, embeddings, model_name, filename):
+    '''
+    To write embeddings and their metadata, through temporary files so that
+    readers never see a partially written file
+    '''
+    os.makedirs(PATH_TO_EMBEDDING_STORE, exist_ok=True)
+    embeddings_path, meta_path = _get_paths(key)
+    _write_array(embeddings_path, embeddings)
+
+    meta = {'model': model_name,
+            'count': int(embeddings.shape[0]),
+            'dim': int(embeddings.shape[1]) if embeddings.ndim > 1 else 0,
+            'dtype': str(embeddings.dtype),
+            'source': filename,
+            'created': time.time()}
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def _load_quantized_embeddings(key, num_comments, dtype):
+    '''
+    To open stored quantized embeddings memory-mapped, or get None if they are missing
+    '''
+    codes_path, scales_path = _get_quantized_paths(key, dtype)
+    if not os.path.isfile(codes_path) or (dtype == 'int8' and not os.path.isfile(scales_path)):
+        return None
+
+    try:
+        codes = np.load(codes_path, mmap_mode='r')
+        scales = np.load(scales_path) if dtype == 'int8' else None
+    except Exception as e:
+        print(f"Error loading {dtype} embeddings {key}: {e}")
+        return None
+
+    if codes.shape[0] != num_comments:
+        print(f"Stored {dtype} embeddings {key} do not match the corpus, they will be recomputed")
+        return None
+
+    return quantization.QuantizedEmbeddings(codes, scales)
+
+
+def _save_quantized_embeddings(key, embeddings):
+    os.makedirs(PATH_TO_EMBEDDING_STORE, exist_ok=True)
+    codes_path, scales_path = _get_quantized_paths(key, embeddings.dtype)
+    if embeddings.scales is not None:
+        _write_array(scales_path, embeddings.scales)
+    _write_array(codes_path, embeddings.codes)
+
+
+def _get_comment_keys(comments_list, comment_ids=None):
+    '''
+    To get the key of every comment: its Comment ID together with a hash of its text,
+    so that an edited comment is encoded again. Without IDs the text alone is used.
+    '''
+    if comment_ids is None:
+        comment_ids = [''] * len(comments_list)
+    return [hashlib.sha1(f'{comment_id}\0{comment}'.encode('utf-8')).hexdigest()[:20]
+            for comment_id, comment in zip(comment_ids, comments_list)]
+
+
+def _get_comment_store_path(model_name):
+    model_slug = hashlib.sha1(model_name.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(PATH_TO_EMBEDDING_STORE, 'comments', model_slug)
+
+
+def _read_keys(keys_path):
+    try:
+        with open(keys_path) as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error loading comment embedding keys {keys_path}: {e}")
+        return None
+
+
+def _get_comment_index_state(store_path):
+    return _comment_indexes.setdefault(os.path.abspath(store_path), {'index': {}, 'loaded': set()})
+
+
+def _load_comment_index(store_path):
+    '''
+    To get the index of stored comment embeddings: comment key -> [block name, row].
+    Every block has its own list of keys, written once next to it, so processes adding
+    comments at the same time never overwrite each other's entries.
+    The index is kept in memory, only the keys of blocks added since the last call are read.
+    '''
+    state = _get_comment_index_state(store_path)
+    if not os.path.isdir(store_path):
+        state['index'].clear()
+        state['loaded'].clear()
+        return state['index']
+
+    keys_names = {name for name in os.listdir(store_path) if name.endswith('.keys.json')}
+    # Blocks never go away, unless the whole store was deleted
+    if not state['loaded'] <= keys_names:
+        state['index'].clear()
+        state['loaded'].clear()
+
+    for keys_name in sorted(keys_names - state['loaded']):
+        keys = _read_keys(os.path.join(store_path, keys_name))
+        if keys is None:
+            continue
+        block_name = keys_name[:-len('.keys.json')]
+        state['index'].update((key, [block_name, row]) for row, key in enumerate(keys))
+        state['loaded'].add(keys_name)
+    return state['index']
+
+
+def _append_comment_embeddings(store_path, index, keys, embeddings):
+    '''
+    To add a block of new comment embeddings to the store and record them in the index.
+    The keys of the block are written after the block, so they never point to a missing file.
+    '''
+    os.makedirs(store_path, exist_ok=True)
+    block_name = f'block_{time.time_ns()}_{os.getpid()}.npy'
+
+    tmp_path = os.path.join(store_path, f'{block_name}.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(embeddings))
+    os.replace(tmp_path, os.path.join(store_path, block_name))
+
+    keys_name = f'{block_name}.keys.json'
+    keys_path = os.path.join(store_path, keys_name)
+    tmp_path = f'{keys_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(list(keys), f)
+    os.replace(tmp_path, keys_path)
+
+    entries = [(key, [block_name, row]) for row, key in enumerate(keys)]
+    state = _get_comment_index_state(store_path)
+    state['index'].update(entries)
+    state['loaded'].add(keys_name)
+    if index is not state['index']:
+        index.update(entries)
+
+
+def _encode_incrementally(comments_list, comment_ids, model_name):
+    '''
+    To get the embeddings of a corpus from the per-comment store, encoding only the
+    comments that are not in it yet and appending them to it
+    '''
+    store_path = _get_comment_store_path(model_name)
+    index = _load_comment_index(store_path)
+    keys = _get_comment_keys(comments_list, comment_ids)
+
+    # Encode each missing comment once, even if it appears several times
+    missing = {}
+    for key, comment in zip(keys, comments_list):
+        if key not in index and key not in missing:
+            missing[key] = comment
+
+    if missing:
+        print(f"Encoding {len(missing)} new comments out of {len(comments_list)}")
+        model = model_registry.get_encoder(model_name)
+        with tracer.span('embedding_store.encode', items=len(missing)):
+            new_embeddings = model.encode(list(missing.values()), show_progress_bar=True, convert_to_numpy=True)
+        _append_comment_embeddings(store_path, index, list(missing.keys()), new_embeddings)
+
+    if not keys:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    # Gather the rows of the corpus from the blocks they are stored in, one block at a time
+    locations = [index[key] for key in keys]
+    block_names, block_of_rows = np.unique([block_name for block_name, _ in locations], return_inverse=True)
+    rows = np.fromiter((row for _, row in locations), dtype=np.int64, count=len(locations))
+    order = np.argsort(block_of_rows, kind='stable')
+    bounds = np.searchsorted(block_of_rows[order], np.arange(len(block_names) + 1))
+    embeddings = None
+    for b, block_name in enumerate(block_names):
+        block = np.load(os.path.join(store_path, block_name), mmap_mode='r')
+        if embeddings is None:
+            embeddings = np.empty((len(keys), block.shape[1]), dtype=block.dtype)
+        positions = order[bounds[b]:bounds[b + 1]]
+        embeddings[positions] = block[rows[positions]]
+
+    return embeddings
+
+
+def _set_storage_sizes(quantized):
+    # Size of the quantized embeddings and of the float32 ones they stand in for
+    tracer.current_span().set(stored_mb=quantized.nbytes / 1024 ** 2, float32_mb=quantized.shape[0] * quantized.shape[1] * 4 / 1024 ** 2)
+
+
+@tracer.traced('embedding_store.get_embeddings')
+def get_embeddings(comments_list, filename=None, model_name=ENCODER_MODEL_NAME, comment_ids=None, corpus_key=None, dtype=None):
+    '''
+    To get the embeddings of a list of comments, encoding and storing them if needed.
+    Only comments missing from the per-comment store are encoded.
+    corpus_key can be passed by callers that already hashed the corpus.
+    dtype (EMBEDDING_DTYPE by default) can be 'float16' or 'int8' to get
+    QuantizedEmbeddings, quantized from the float32 embeddings on first use.
+    The returned array is memory-mapped from the store.
+    '''
+    dtype = dtype or EMBEDDING_DTYPE
+    key = corpus_key or get_corpus_key(comments_list, model_name)
+    tracer.current_span().set(items=len(comments_list), dtype=dtype)
+
+    if dtype != 'float32':
+        quantized = _load_quantized_embeddings(key, len(comments_list), dtype)
+        if quantized is not None:
+            _set_storage_sizes(quantized)
+            tracer.current_span().set(cached=True)
+            return quantized
+
+    embeddings = _load_embeddings(key, len(comments_list), model_name)
+    if embeddings is not None and dtype == 'float32':
+        tracer.current_span().set(cached=True)
+        return embeddings
+
+    if embeddings is None:
+        embeddings = _encode_incrementally(comments_list, comment_ids, model_name)
+        _save_embeddings(key, embeddings, model_name, filename)
+        embeddings = _load_embeddings(key, len(comments_list), model_name)
+
+    if dtype == 'float32':
+        return embeddings
+
+    quantized = quantization.quantize(embeddings, dtype)
+    _save_quantized_embeddings(key, quantized)
+    _set_storage_sizes(quantized)
+    return _load_quantized_embeddings(key, len(comments_list), dtype) or quantized
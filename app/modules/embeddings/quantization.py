@@ -0,0 +1,152 @@
+'''
+Compact forms of corpus embeddings for clustering and retrieval.
+Only cosine similarities are computed from corpus embeddings, so they are
+normalized and stored either as float16 (half the size of float32) or as int8
+codes with one scale per dimension (a quarter of the size). Similarities are
+computed one chunk of rows at a time, converting only that chunk back to float32,
+so the full float32 matrix is never held in memory.
+'''
+
+import numpy as np
+
+from modules.constants import *
+
+QUANTIZED_DTYPES = ('float16', 'int8')
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class QuantizedEmbeddings:
+    '''
+    Normalized embeddings stored as float16, or as int8 codes that are multiplied by
+    scales (one per dimension) to get the vectors back.
+    Indexing gives float32 rows normalized again, so rows can be used wherever float32
+    embeddings are. Converting the whole matrix with np.asarray raises TypeError, since
+    it would undo the savings: use cos_sim, take or a slice of rows instead.
+    '''
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float32)
+        self._inverse_norms = None
+
+    @property
+    def dtype(self):
+        return str(self.codes.dtype)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        vectors = np.asarray(self.codes[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales
+        # Rounding leaves the vectors slightly off unit length
+        return _normalize(vectors)
+
+    def __array__(self, dtype=None, copy=None):
+        raise TypeError(f'Converting {self.dtype} embeddings to a float32 matrix would hold all of them in memory, '
+                        'use quantization.cos_sim, take or a slice of rows instead')
+
+    def get_inverse_norms(self, chunk_size=QUANTIZATION_CHUNK_SIZE):
+        '''
+        To get 1 / the norm of every row as stored, computed once
+        '''
+        if self._inverse_norms is None:
+            scales = 1 if self.scales is None else self.scales
+            norms = np.concatenate([np.linalg.norm(np.asarray(self.codes[start:start + chunk_size], dtype=np.float32) * scales, axis=1)
+                                    for start in range(0, len(self.codes), chunk_size)] or [np.zeros(0, dtype=np.float32)])
+            self._inverse_norms = (1 / np.maximum(norms, 1e-12)).astype(np.float32)
+        return self._inverse_norms
+
+    def take(self, ids):
+        '''
+        To get the embeddings of the given rows, still quantized
+        '''
+        return QuantizedEmbeddings(self.codes[ids], self.scales)
+
+
+def quantize(embeddings, dtype, chunk_size=QUANTIZATION_CHUNK_SIZE):
+    '''
+    To get the compact form of float32 embeddings, converting a chunk of rows at a time
+    '''
+    if dtype not in QUANTIZED_DTYPES:
+        raise ValueError(f'Unknown embedding dtype {dtype}, expected one of {QUANTIZED_DTYPES}')
+
+    codes = np.empty(embeddings.shape, dtype=dtype)
+    if dtype == 'float16':
+        for start in range(0, len(embeddings), chunk_size):
+            codes[start:start + chunk_size] = _normalize(embeddings[start:start + chunk_size])
+        return QuantizedEmbeddings(codes)
+
+    # Symmetric int8: the largest absolute value of every dimension maps to 127
+    max_values = np.zeros(embeddings.shape[1], dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        max_values = np.maximum(max_values, np.abs(_normalize(embeddings[start:start + chunk_size])).max(axis=0, initial=0))
+    scales = np.maximum(max_values, 1e-12) / 127
+
+    for start in range(0, len(embeddings), chunk_size):
+        codes[start:start + chunk_size] = np.clip(np.rint(_normalize(embeddings[start:start + chunk_size]) / scales), -127, 127)
+    return QuantizedEmbeddings(codes, scales)
+
+
+def cos_sim(vectors, embeddings, chunk_size=QUANTIZATION_CHUNK_SIZE, buffer=None):
+    '''
+    To get the cosine similarities of float32 vectors to every quantized embedding,
+    as a float32 matrix of len(vectors) x len(embeddings).
+    buffer, a float32 array of chunk_size x dimensions, saves allocating one on every call.
+    '''
+    if buffer is None:
+        buffer = np.empty((min(chunk_size, len(embeddings)), embeddings.shape[1]), dtype=np.float32)
+
+    vectors = _normalize(np.atleast_2d(vectors))
+    # Scales are applied to the vectors and norms to the scores, so that the codes only need a cast
+    if embeddings.scales is not None:
+        vectors *= embeddings.scales
+    scores = np.empty((len(vectors), len(embeddings)), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = buffer[:min(chunk_size, len(embeddings) - start)]
+        chunk[...] = embeddings.codes[start:start + chunk_size]
+        np.matmul(vectors, chunk.T, out=scores[:, start:start + len(chunk)])
+    scores *= embeddings.get_inverse_norms()
+    return scores
+
+
+def iter_similarity_blocks(embeddings, block_size=DETECTION_BLOCK_SIZE):
+    '''
+    Yield the cosine similarity matrix of quantized embeddings one block of rows at a time
+    '''
+    buffer = np.empty((min(QUANTIZATION_CHUNK_SIZE, len(embeddings)), embeddings.shape[1]), dtype=np.float32)
+    for start in range(0, len(embeddings), block_size):
+        yield cos_sim(embeddings[start:start + block_size], embeddings, buffer=buffer)
+
+
+def semantic_search(query_embeddings, embeddings, top_k=10):
+    '''
+    To get the top_k most similar quantized embeddings of every query, in the same
+    shape as util.semantic_search: one list of {'corpus_id', 'score'} per query
+    '''
+    if hasattr(query_embeddings, 'cpu'):
+        query_embeddings = query_embeddings.cpu().numpy()
+    scores = cos_sim(query_embeddings, embeddings)
+
+    k = min(top_k, scores.shape[1])
+    if k == 0:
+        return [[] for _ in scores]
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    all_hits = []
+    for row, candidates in enumerate(best):
+        candidates = candidates[np.argsort(-scores[row, candidates], kind='stable')]
+        all_hits.append([{'corpus_id': int(i), 'score': float(scores[row, i])} for i in candidates])
+    return all_hits
@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pytest
+
+from modules.constants import *
+from modules.embeddings import embedding_store
+from modules.models import model_registry
+from benchmarks import stub_encoder
+
+
+class CountingEncoder(stub_encoder.StubEncoder):
+    def __init__(self):
+        super().__init__()
+        self.encoded = []
+
+    def encode(self, sentences, **kwargs):
+        self.encoded.extend(sentences)
+        return super().encode(sentences, **kwargs)
+
+
+@pytest.fixture
+def encoder(workdir):
+    encoder = CountingEncoder()
+    model_registry.register_model(encoder, ENCODER_MODEL_NAME)
+    return encoder
+
+
+def test_only_new_comments_are_encoded(encoder):
+    comments = [f'comment number {i} about the video' for i in range(50)]
+    ids = [f'id{i}' for i in range(50)]
+    first = np.array(embedding_store.get_embeddings(comments[:30], comment_ids=ids[:30]))
+    assert len(encoder.encoded) == 30
+
+    # New comments on top, like a refreshed video, and a repeated one
+    comments = comments[30:] + comments[:30] + [comments[0]]
+    ids = ids[30:] + ids[:30] + [ids[0]]
+    embeddings = np.array(embedding_store.get_embeddings(comments, comment_ids=ids))
+    assert len(encoder.encoded) == 50
+    np.testing.assert_array_equal(embeddings[20:50], first)
+    np.testing.assert_allclose(embeddings, stub_encoder.StubEncoder().encode(comments), atol=1e-6)
+
+
+def test_concurrent_appends_keep_every_entry(encoder):
+    store_path = embedding_store._get_comment_store_path(ENCODER_MODEL_NAME)
+    # Both writers read the index before either of them adds comments
+    first_index = embedding_store._load_comment_index(store_path)
+    second_index = embedding_store._load_comment_index(store_path)
+    embedding_store._append_comment_embeddings(store_path, first_index, ['a', 'b'], np.ones((2, 4), dtype=np.float32))
+    embedding_store._append_comment_embeddings(store_path, second_index, ['c'], np.zeros((1, 4), dtype=np.float32))
+
+    index = embedding_store._load_comment_index(store_path)
+    assert sorted(index) == ['a', 'b', 'c']
+    assert index['b'][1] == 1
+
+
+def test_only_new_blocks_are_read(encoder, monkeypatch):
+    store_path = embedding_store._get_comment_store_path(ENCODER_MODEL_NAME)
+    embedding_store._append_comment_embeddings(store_path, {}, ['a'], np.ones((1, 4), dtype=np.float32))
+
+    # A block added by another process
+    np.save(os.path.join(store_path, 'block_other.npy'), np.zeros((2, 4), dtype=np.float32))
+    with open(os.path.join(store_path, 'block_other.npy.keys.json'), 'w') as f:
+        f.write('["b", "c"]')
+
+    read = []
+    read_keys = embedding_store._read_keys
+    monkeypatch.setattr(embedding_store, '_read_keys', lambda path: read.append(os.path.basename(path)) or read_keys(path))
+    index = embedding_store._load_comment_index(store_path)
+    assert sorted(index) == ['a', 'b', 'c']
+    assert index['c'] == ['block_other.npy', 1]
+
+    embedding_store._load_comment_index(store_path)
+    assert read == ['block_other.npy.keys.json']
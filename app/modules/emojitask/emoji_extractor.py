@@ -1,16 +1,144 @@
-import emoji as em
+'''
+Counting of the emojis used in comments.
+Every emoji sequence known to the emoji package (skin tones, ZWJ families, flags,
+keycaps...) is compiled into one trie-shaped regex, so comments are scanned once and
+the longest sequence at each position is counted as one emoji.
+Large lists of comments are scanned in chunks across a process pool.
+'''
+
 import re
-from collections import defaultdict
+import emoji as em
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from modules.constants import *
+from modules.tracing import tracer
+
+_run_regex = None
+_emoji_regex = None
+_canonical_emojis = None
+
+
+def _get_emoji_sequences():
+    '''
+    To get every emoji sequence of the installed emoji package, whether it has
+    EMOJI_DATA (1.7 and later) or UNICODE_EMOJI (earlier versions)
+    '''
+    if hasattr(em, 'EMOJI_DATA'):
+        return list(em.EMOJI_DATA)
+
+    unicode_emoji = em.UNICODE_EMOJI
+    # From 1.0 the emojis are grouped by language
+    if 'en' in unicode_emoji and isinstance(unicode_emoji['en'], dict):
+        unicode_emoji = unicode_emoji['en']
+    return list(unicode_emoji)
+
+
+def _get_trie_pattern(trie):
+    '''
+    To get a regex matching the sequences of a trie, trying longer sequences first
+    '''
+    branches = [re.escape(char) + _get_trie_pattern(child) for char, child in sorted(trie.items()) if char != '']
+    if not branches:
+        return ''
+    pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if '' in trie:
+        # A sequence ends here, and may also continue into a longer one
+        pattern = '(?:' + pattern + ')?'
+    return pattern
+
+
+def _get_char_class(chars, max_gap=16):
+    '''
+    To get a regex character class covering the given characters, as ranges of code points.
+    Ranges less than max_gap code points apart are merged: a class of a few ranges is
+    much faster to scan with, and may let in some characters that are not emojis.
+    '''
+    code_points = sorted(ord(char) for char in chars)
+    ranges = []
+    for code_point in code_points:
+        if ranges and code_point - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = code_point
+        else:
+            ranges.append([code_point, code_point])
+    return '[' + ''.join(re.escape(chr(first)) if first == last else f'{re.escape(chr(first))}-{re.escape(chr(last))}'
+                         for first, last in ranges) + ']'
 
-def get_most_freq_emojis(comments_list, count = 5):
-    text = em.demojize(' '.join(comments_list))
-    text = re.findall(r'(:[!_\-\w]+:)', text)
-    list_emoji = [em.emojize(x) for x in text]
 
-    all_emojis_count = defaultdict(int)
+def _load_emoji_regexes():
+    '''
+    To compile the regex finding runs of emoji characters and the trie regex splitting
+    a run into emojis, and to get the form each emoji is counted as
+    '''
+    global _run_regex, _emoji_regex, _canonical_emojis
+    sequences = _get_emoji_sequences()
 
-    for emoji in list_emoji:
-        all_emojis_count[emoji] += 1
+    trie = {}
+    for sequence in sequences:
+        node = trie
+        for char in sequence:
+            node = node.setdefault(char, {})
+        node[''] = {}
 
-    sorted_emojis_count = [k for k, v in sorted(all_emojis_count.items(), key = lambda item: item[1], reverse = True)]
-    return sorted_emojis_count[:count]
+    # Runs are found with a coarse class of the emoji characters, and split exactly by the trie.
+    # Keycaps start with an ASCII character (#, * or a digit), so a run may start with one.
+    emoji_chars = {char for sequence in sequences for char in sequence if ord(char) > 127}
+    ascii_chars = {char for sequence in sequences for char in sequence if ord(char) <= 127}
+    run_pattern = _get_char_class(emoji_chars) + '+'
+    if ascii_chars:
+        run_pattern = _get_char_class(ascii_chars, max_gap=0) + '?' + run_pattern
+
+    # Fully-qualified and unqualified forms of an emoji (with and without U+FE0F) are counted as the longest form
+    canonical_emojis = {}
+    for sequence in sequences:
+        key = sequence.replace('\ufe0f', '')
+        if len(sequence) > len(canonical_emojis.get(key, '')):
+            canonical_emojis[key] = sequence
+
+    _run_regex = re.compile(run_pattern)
+    _emoji_regex = re.compile(_get_trie_pattern(trie))
+    _canonical_emojis = {sequence: canonical_emojis[sequence.replace('\ufe0f', '')] for sequence in sequences}
+
+
+def count_emojis(comments_list):
+    '''
+    To count every emoji of a list of comments
+    '''
+    if _emoji_regex is None:
+        _load_emoji_regexes()
+
+    # No emoji contains a newline, so joined comments never create new sequences
+    emoji_counts = Counter()
+    for run in _run_regex.findall('\n'.join(comments_list)):
+        emoji_counts.update(_emoji_regex.findall(run))
+
+    canonical_counts = Counter()
+    for emoji, emoji_count in emoji_counts.items():
+        if emoji:
+            canonical_counts[_canonical_emojis[emoji]] += emoji_count
+    return canonical_counts
+
+
+@tracer.traced('emoji_extractor.get_emoji_counts')
+def get_emoji_counts(comments_list, chunk_size=EMOJI_CHUNK_SIZE, processes=EMOJI_PROCESSES):
+    '''
+    To count every emoji of a list of comments, one chunk of chunk_size comments at a
+    time, on a pool of worker processes when there are enough comments
+    '''
+    chunks = [comments_list[i:i + chunk_size] for i in range(0, len(comments_list), chunk_size)]
+    emoji_counts = Counter()
+    tracer.current_span().set(items=len(comments_list), chunks=len(chunks))
+
+    if processes != 1 and len(comments_list) >= EMOJI_PARALLEL_MIN:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for chunk_counts in executor.map(count_emojis, chunks):
+                emoji_counts.update(chunk_counts)
+    else:
+        for chunk in chunks:
+            emoji_counts.update(count_emojis(chunk))
+
+    return emoji_counts
+
+
+def get_most_freq_emojis(comments_list, count = 5):
+    return [emoji for emoji, _ in get_emoji_counts(comments_list).most_common(count)]
@@ -0,0 +1,32 @@
+from collections import Counter
+
+from modules.emojitask import emoji_extractor
+
+THUMBS_UP_MEDIUM = '\U0001F44D\U0001F3FD'
+FAMILY = '\U0001F468\u200d\U0001F469\u200d\U0001F467\u200d\U0001F466'
+RAINBOW_FLAG = '\U0001F3F3\ufe0f\u200d\U0001F308'
+US_FLAG = '\U0001F1FA\U0001F1F8'
+KEYCAP_ONE = '1\ufe0f\u20e3'
+HEART = '\u2764\ufe0f'
+
+
+def test_multi_codepoint_emojis_count_once():
+    counts = emoji_extractor.count_emojis([f'great {THUMBS_UP_MEDIUM}{THUMBS_UP_MEDIUM}',
+                                           f'{FAMILY} and {RAINBOW_FLAG}',
+                                           f'{US_FLAG}{US_FLAG} number {KEYCAP_ONE}'])
+    assert counts == Counter({THUMBS_UP_MEDIUM: 2, FAMILY: 1, RAINBOW_FLAG: 1, US_FLAG: 2, KEYCAP_ONE: 1})
+
+
+def test_forms_with_and_without_variation_selector_count_together():
+    counts = emoji_extractor.count_emojis([f'{HEART} love', 'no selector \u2764', f'1 is not a keycap {HEART}'])
+    assert counts == Counter({HEART: 3})
+
+
+def test_chunked_and_pool_counts_equal_a_single_count(monkeypatch):
+    comments = [f'comment {i} ' + [THUMBS_UP_MEDIUM, FAMILY, RAINBOW_FLAG, US_FLAG, KEYCAP_ONE, HEART, ''][i % 7] * (i % 3) for i in range(500)]
+    expected = emoji_extractor.count_emojis(comments)
+    assert sum(expected.values()) > 0
+
+    assert emoji_extractor.get_emoji_counts(comments, chunk_size=37, processes=1) == expected
+    monkeypatch.setattr(emoji_extractor, 'EMOJI_PARALLEL_MIN', 100)
+    assert emoji_extractor.get_emoji_counts(comments, chunk_size=37, processes=2) == expected
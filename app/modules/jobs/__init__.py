@@ -0,0 +1 @@
+from .job_runner import *
@@ -0,0 +1,155 @@
+'''
+Background jobs of the app.
+Long actions (fetching comments, clustering) run on a pool of worker threads shared
+by every Streamlit session instead of in the script thread, so they keep running
+through reruns and clicks. Jobs are kept in a process-wide table: submitting a job
+with the same key as one still queued or running returns that job instead of
+starting another, and the app polls the table for the stage, progress and result.
+'''
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.constants import *
+from modules.tracing import tracer
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_jobs = OrderedDict()
+# Key of every queued or running job, to the job
+_active = {}
+_lock = threading.Lock()
+_executor = None
+
+
+class Job:
+    def __init__(self, kind, key, description):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.key = key
+        self.description = description
+        self.status = QUEUED
+        self.stage = None
+        self.done = None
+        self.total = None
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = threading.Event()
+
+    def report(self, stage, done=None, total=None):
+        '''
+        To report the stage the job is at and, when known, how much of it is done
+        '''
+        self.stage, self.done, self.total = stage, done, total
+
+    @property
+    def progress(self):
+        '''
+        The share of the current stage done, or None if it is not known
+        '''
+        if not self.total or self.done is None:
+            return None
+        return min(1.0, self.done / self.total)
+
+    @property
+    def is_finished(self):
+        return self.status in (DONE, FAILED)
+
+    def get_status_text(self):
+        if self.status != RUNNING or not self.stage:
+            return f'{self.description}: {self.status}'
+        if self.total:
+            return f'{self.description}: {self.stage} ({self.done:,} of {self.total:,})'
+        if self.done is not None:
+            return f'{self.description}: {self.stage} ({self.done:,})'
+        return f'{self.description}: {self.stage}'
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix='job')
+        return _executor
+
+
+def _run(job, function, args, kwargs):
+    job.status = RUNNING
+    job.started_at = time.time()
+    try:
+        with tracer.span(f'jobs.{job.kind}', job_id=job.id):
+            job.result = function(job, *args, **kwargs)
+        job.status = DONE
+    except Exception as e:
+        print(f"Error in job {job.description}: {e}")
+        job.error = str(e) or repr(e)
+        job.status = FAILED
+    finally:
+        job.finished_at = time.time()
+        with _lock:
+            if _active.get(job.key) is job:
+                del _active[job.key]
+        job.finished.set()
+
+
+def _purge():
+    '''
+    To forget the jobs finished more than JOB_RESULT_TTL seconds ago
+    '''
+    now = time.time()
+    for job_id in [job_id for job_id, job in _jobs.items() if job.is_finished and now - job.finished_at > JOB_RESULT_TTL]:
+        del _jobs[job_id]
+
+
+def submit(kind, key, function, *args, description=None, **kwargs):
+    '''
+    To run function(job, *args, **kwargs) in the background, unless a job with the same
+    key is already queued or running, in which case that job is returned.
+    The function can report its progress with job.report.
+    '''
+    key = (kind, key)
+    with _lock:
+        if key in _active:
+            return _active[key]
+        _purge()
+        job = Job(kind, key, description or kind)
+        _jobs[job.id] = job
+        _active[key] = job
+
+    _get_executor().submit(_run, job, function, args, kwargs)
+    return job
+
+
+def get_job(job_id):
+    '''
+    To get a job from its ID, or None if it is unknown or was forgotten
+    '''
+    with _lock:
+        return _jobs.get(job_id)
+
+
+def list_jobs(kind=None):
+    '''
+    To get the jobs of the table, oldest first, optionally only those of one kind
+    '''
+    with _lock:
+        return [job for job in _jobs.values() if kind is None or job.kind == kind]
+
+
+def wait(job_id, timeout=None):
+    '''
+    To wait for a job to finish. Returns the job, or None if it is unknown.
+    '''
+    job = get_job(job_id)
+    if job is not None:
+        job.finished.wait(timeout)
+    return job
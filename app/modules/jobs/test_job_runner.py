@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from modules.constants import *
+from modules.jobs import job_runner
+
+
+@pytest.fixture(autouse=True)
+def jobs(monkeypatch):
+    '''An empty job table'''
+    monkeypatch.setattr(job_runner, '_jobs', type(job_runner._jobs)())
+    monkeypatch.setattr(job_runner, '_active', {})
+
+
+def _blocked(release):
+    def function(job, value):
+        job.report('waiting', 1, 4)
+        release.wait(5)
+        return value
+    return function
+
+
+def test_same_key_returns_the_job_in_flight():
+    release = threading.Event()
+    first = job_runner.submit('fetch', 'video', _blocked(release), 1)
+    assert job_runner.submit('fetch', 'video', _blocked(release), 2) is first
+    # Another kind or key starts a job of its own
+    other = job_runner.submit('cluster', 'video', _blocked(release), 3)
+    assert other is not first
+
+    release.set()
+    assert job_runner.wait(first.id, 5).result == 1
+    assert job_runner.wait(other.id, 5).result == 3
+
+    # A finished job is not reused
+    again = job_runner.submit('fetch', 'video', lambda job: 4)
+    assert again is not first
+    assert job_runner.wait(again.id, 5).result == 4
+
+
+def test_errors_are_captured():
+    def fail(job):
+        raise ValueError('quota exceeded')
+
+    job = job_runner.wait(job_runner.submit('fetch', 'video', fail).id, 5)
+    assert job.status == job_runner.FAILED
+    assert job.error == 'quota exceeded'
+    assert job.result is None
+    assert job.finished_at is not None
+
+
+def test_progress_is_reported():
+    release = threading.Event()
+    job = job_runner.submit('fetch', 'video', _blocked(release), 1, description='Fetching comments')
+    while job.stage is None:
+        job.finished.wait(0.01)
+
+    assert job.status == job_runner.RUNNING
+    assert job.progress == 0.25
+    assert job.get_status_text() == 'Fetching comments: waiting (1 of 4)'
+
+    release.set()
+    job_runner.wait(job.id, 5)
+    assert job.get_status_text() == 'Fetching comments: done'
+
+
+def test_finished_jobs_are_forgotten_after_their_ttl():
+    release = threading.Event()
+    finished = job_runner.wait(job_runner.submit('fetch', 'first', lambda job: 1).id, 5)
+    running = job_runner.submit('fetch', 'second', _blocked(release), 2)
+
+    job_runner.submit('fetch', 'third', lambda job: 3)
+    assert job_runner.get_job(finished.id) is finished
+
+    finished.finished_at -= JOB_RESULT_TTL + 1
+    job_runner.submit('fetch', 'fourth', lambda job: 4)
+    assert job_runner.get_job(finished.id) is None
+    assert job_runner.get_job(running.id) is running
+
+    release.set()
+    job_runner.wait(running.id, 5)
@@ -0,0 +1,102 @@
+'''
+Process-wide registry of the sentence encoders and cross-encoders, so that every
+model is loaded once and shared by clustering and retrieval
+'''
+
+import threading
+import time
+from sentence_transformers import SentenceTransformer, CrossEncoder
+
+from modules.constants import *
+from modules.tracing import tracer
+
+ENCODER = 'encoder'
+CROSS_ENCODER = 'cross-encoder'
+
+_MODEL_CLASSES = {ENCODER: SentenceTransformer, CROSS_ENCODER: CrossEncoder}
+
+_models = {}
+_load_metrics = {}
+_key_locks = {}
+_registry_lock = threading.Lock()
+
+
+def _get_model(kind, name, device):
+    '''
+    To get a model from the registry, loading it on first use.
+    Concurrent callers asking for the same model wait for a single load.
+    '''
+    key = (kind, name, device)
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _registry_lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        if key not in _models:
+            start = time.perf_counter()
+            with tracer.span('model_registry.load', kind=kind, model=name):
+                _models[key] = _MODEL_CLASSES[kind](name, device=device)
+            _load_metrics[key] = {'kind': kind,
+                                  'name': name,
+                                  'device': device,
+                                  'load_seconds': time.perf_counter() - start,
+                                  'loaded_at': time.time()}
+            print(f"Loaded {kind} {name} in {_load_metrics[key]['load_seconds']:.2f}s")
+        return _models[key]
+
+
+def get_encoder(name=ENCODER_MODEL_NAME, device=None):
+    '''
+    To get the shared SentenceTransformer for the given model name and device
+    '''
+    return _get_model(ENCODER, name, device)
+
+
+def get_cross_encoder(name=CROSS_ENCODER_MODEL_NAME, device=None):
+    '''
+    To get the shared CrossEncoder for the given model name and device
+    '''
+    return _get_model(CROSS_ENCODER, name, device)
+
+
+def register_model(model, name, kind=ENCODER, device=None):
+    '''
+    To put an already built model in the registry under the given name, e.g. a
+    lightweight local encoder standing in for the real one in tests
+    '''
+    with _registry_lock:
+        _models[(kind, name, device)] = model
+        _load_metrics[(kind, name, device)] = {'kind': kind,
+                                               'name': name,
+                                               'device': device,
+                                               'load_seconds': 0.0,
+                                               'loaded_at': time.time()}
+
+
+def warm_up(encoders=(ENCODER_MODEL_NAME,), cross_encoders=(CROSS_ENCODER_MODEL_NAME,), device=None):
+    '''
+    To load the given models ahead of the first query
+    '''
+    for name in encoders:
+        get_encoder(name, device)
+    for name in cross_encoders:
+        get_cross_encoder(name, device)
+
+
+def get_load_metrics():
+    '''
+    To get how long each model in the registry took to load
+    '''
+    return list(_load_metrics.values())
+
+
+def clear_models():
+    '''
+    To drop every model from the registry
+    '''
+    with _registry_lock:
+        _models.clear()
+        _load_metrics.clear()
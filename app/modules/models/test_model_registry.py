@@ -0,0 +1,70 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from modules.models import model_registry
+
+
+class SlowModel:
+    loads = []
+
+    def __init__(self, name, device=None):
+        SlowModel.loads.append((name, device))
+        time.sleep(0.05)
+        self.name = name
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    '''An empty registry loading SlowModels'''
+    monkeypatch.setattr(model_registry, '_models', {})
+    monkeypatch.setattr(model_registry, '_load_metrics', {})
+    monkeypatch.setattr(model_registry, '_key_locks', {})
+    monkeypatch.setattr(model_registry, '_MODEL_CLASSES', {model_registry.ENCODER: SlowModel, model_registry.CROSS_ENCODER: SlowModel})
+    SlowModel.loads = []
+
+
+def test_concurrent_callers_share_one_load():
+    start = threading.Barrier(8)
+
+    def get_encoder(_):
+        start.wait()
+        return model_registry.get_encoder('encoder-model')
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        models = list(executor.map(get_encoder, range(8)))
+
+    assert SlowModel.loads == [('encoder-model', None)]
+    assert all(model is models[0] for model in models)
+    # Another device or kind is another model
+    assert model_registry.get_encoder('encoder-model', 'cpu') is not models[0]
+    assert model_registry.get_cross_encoder('encoder-model') is not models[0]
+    assert len(SlowModel.loads) == 3
+
+
+def test_registered_models_are_returned():
+    model = object()
+    model_registry.register_model(model, 'stub-model')
+    assert model_registry.get_encoder('stub-model') is model
+    assert SlowModel.loads == []
+
+    cross_encoder = object()
+    model_registry.register_model(cross_encoder, 'stub-model', kind=model_registry.CROSS_ENCODER)
+    assert model_registry.get_cross_encoder('stub-model') is cross_encoder
+    assert model_registry.get_encoder('stub-model') is model
+
+
+def test_load_timings_are_recorded():
+    model_registry.warm_up(encoders=('encoder-model',), cross_encoders=('cross-model',))
+    model_registry.get_encoder('encoder-model')
+
+    # One load per model
+    loads = sorted(model_registry.get_load_metrics(), key=lambda load: load['kind'])
+    assert [(load['kind'], load['name'], load['device']) for load in loads] == [(model_registry.CROSS_ENCODER, 'cross-model', None),
+                                                                                (model_registry.ENCODER, 'encoder-model', None)]
+    assert all(load['load_seconds'] >= 0.05 for load in loads)
+
+    model_registry.clear_models()
+    assert model_registry.get_load_metrics() == []
@@ -0,0 +1,295 @@
+'''
+Headless analysis of datasets outside Streamlit.
+The chosen stages (clusters, top emojis, statistics, sentiment, query results) run
+for many datasets in parallel worker processes, each loading the models once, and
+the results are written as JSON under PATH_TO_RESULTS (per-comment sentiment as
+Parquet) for the app to load instead of recomputing them.
+'''
+
+import os
+import json
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from modules.constants import *
+from modules.clustering import cluster_maker, topic_store
+from modules.emojitask import emoji_extractor
+from modules.retrieval import relevant_comments
+from modules.models import model_registry
+from modules.datasets import dataset_store
+from modules.sentiment import sentiment_engine
+from modules.terms import term_index
+
+# Number of top emojis kept, the app shows up to 10
+NUM_TOP_EMOJIS = 10
+
+# Worker processes of the pipeline score sentiment and count emojis in-process
+# instead of starting pools of their own
+_processes = None
+
+
+def get_sentiments(df, processes=SENTIMENT_PROCESSES, stats=None):
+    '''
+    To get the polarity of every comment of the dataframe as a Sentiment series, from its
+    Sentiment column when it has one. stats is passed to sentiment_engine.score_comments.
+    '''
+    return sentiment_engine.add_sentiment_column(df, processes=processes, stats=stats)[COLUMN_SENTIMENT]
+
+
+def get_statistics(df, comments_list, terms, processes=SENTIMENT_PROCESSES, sentiments=None, sentiment_stats=None):
+    '''
+    To compute everything shown in the Statistics panel.
+    sentiments (see get_sentiments) can be passed by callers that already scored the
+    comments, with the sentiment_stats filled when they were scored.
+    '''
+    total_comments = len(comments_list)
+    avg_comment_length = sum(len(comment) for comment in comments_list) / total_comments
+    top_comments = df.nlargest(5, COLUMN_LIKE_COUNT)[[COLUMN_COMMENT, COLUMN_LIKE_COUNT]]
+    unique_authors = df['Author'].nunique()
+
+    words_df = pd.DataFrame(term_index.get_top_words(terms, 10), columns=['Word', 'Frequency'])
+    bigrams_df = pd.DataFrame(term_index.get_top_bigrams(terms, 10), columns=['Bigram', 'Frequency'])
+
+    sentiment_stats = {} if sentiment_stats is None else sentiment_stats
+    if sentiments is None:
+        sentiments = get_sentiments(df, processes, sentiment_stats)
+    sentiment_counts = pd.Series(sentiment_engine.get_sentiment_labels(sentiments), name='Sentiment').value_counts()
+    # 0 when the comments were already scored
+    sentiment_throughput = sentiment_stats.get('comments_per_second', 0.0)
+
+    return {'total_comments': total_comments,
+            'avg_comment_length': avg_comment_length,
+            'top_comments': top_comments,
+            'unique_authors': unique_authors,
+            'words_df': words_df,
+            'bigrams_df': bigrams_df,
+            'sentiment_counts': sentiment_counts,
+            'sentiment_throughput': sentiment_throughput}
+
+
+def _statistics_to_json(statistics):
+    return {'total_comments': int(statistics['total_comments']),
+            'avg_comment_length': float(statistics['avg_comment_length']),
+            'top_comments': statistics['top_comments'].to_dict(orient='records'),
+            'unique_authors': int(statistics['unique_authors']),
+            'words_df': statistics['words_df'].to_dict(orient='records'),
+            'bigrams_df': statistics['bigrams_df'].to_dict(orient='records'),
+            'sentiment_counts': {label: int(count) for label, count in statistics['sentiment_counts'].items()},
+            'sentiment_throughput': float(statistics['sentiment_throughput'] or 0.0)}
+
+
+def _statistics_from_json(statistics):
+    return dict(statistics,
+                top_comments=pd.DataFrame(statistics['top_comments'], columns=[COLUMN_COMMENT, COLUMN_LIKE_COUNT]),
+                words_df=pd.DataFrame(statistics['words_df'], columns=['Word', 'Frequency']),
+                bigrams_df=pd.DataFrame(statistics['bigrams_df'], columns=['Bigram', 'Frequency']),
+                sentiment_counts=pd.Series(statistics['sentiment_counts'], name='Sentiment', dtype='int64'))
+
+
+def _hits_to_json(hits):
+    return [{'corpus_id': int(hit['corpus_id']),
+             'score': float(hit['score']),
+             'cross-score': None if hit.get('cross-score') is None else float(hit['cross-score'])}
+            for hit in hits]
+
+
+def get_results_path(filename):
+    return os.path.join(PATH_TO_RESULTS, f'{filename}.json')
+
+
+def _read_results(filename):
+    path = get_results_path(filename)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading results {path}: {e}")
+        return None
+
+
+def _write_results(filename, results):
+    os.makedirs(PATH_TO_RESULTS, exist_ok=True)
+    path = get_results_path(filename)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _save_sentiments(filename, df):
+    '''
+    To save the polarity of every comment, as Parquet when available and CSV otherwise
+    '''
+    columns = [column for column in ('Comment ID', COLUMN_SENTIMENT) if column in df]
+    os.makedirs(PATH_TO_RESULTS, exist_ok=True)
+    path = os.path.join(PATH_TO_RESULTS, f'{filename}.sentiment')
+    if dataset_store.parquet_available():
+        path = f'{path}.parquet'
+        df[columns].to_parquet(path, index=False)
+    else:
+        path = f'{path}.csv'
+        df[columns].to_csv(path, index=False)
+    return path
+
+
+def _load_sentiments(path):
+    '''
+    To read the polarities saved by _save_sentiments as a Sentiment series, or None if they cannot be read
+    '''
+    try:
+        return dataset_store.read_dataset(path, columns=[COLUMN_SENTIMENT])[COLUMN_SENTIMENT].astype('float32')
+    except Exception as e:
+        print(f"Error reading sentiments {path}: {e}")
+        return None
+
+
+def load_results(filename):
+    '''
+    To get the results precomputed for the current version of a dataset, under the
+    names the app caches them with, or an empty dictionary if there are none
+    '''
+    stored = _read_results(filename)
+    try:
+        if not stored or stored['dataset_version'] != dataset_store.get_dataset_version(filename):
+            return {}
+    except OSError:
+        return {}
+
+    results = {}
+    for name, value in stored['results'].items():
+        if name == 'statistics':
+            results[name] = _statistics_from_json(value)
+        elif name == 'hits':
+            results.update({('hits', query): hits for query, hits in value.items()})
+        elif name == 'sentiment_path':
+            # The polarity of every comment, in the order of the rows of the dataset
+            sentiments = _load_sentiments(value)
+            if sentiments is not None:
+                results['sentiment'] = sentiments
+        else:
+            results[name] = value
+    return results
+
+
+def analyze_dataset(filename, stages=PIPELINE_STAGES, queries=(), force=False):
+    '''
+    To run the given stages on a dataset and save their results.
+    Stages already computed for the current version of the dataset are skipped
+    unless force is set. Returns a summary with the time taken by every stage and
+    the error and stage that stopped the analysis, if any; the results of the stages
+    finished before it are saved.
+    '''
+    summary = {'filename': filename, 'stages': {}, 'error': None, 'failed_stage': None}
+    stored = None
+    try:
+        dataset_version = dataset_store.get_dataset_version(filename)
+        stored = _read_results(filename)
+        if force or not stored or stored['dataset_version'] != dataset_version:
+            stored = {'dataset': filename, 'dataset_version': dataset_version, 'stages': {}, 'results': {}}
+        results = stored['results']
+
+        short_comments_list, long_comments_list, df = cluster_maker.load_data(filename)
+        if df is None:
+            raise ValueError('Could not load the dataset')
+        comment_ids = df['Comment ID'].astype(str).tolist() if 'Comment ID' in df else None
+
+        for stage in stages:
+            if stage in stored['stages'] and stage != 'queries':
+                continue
+            summary['failed_stage'] = stage
+            start = time.perf_counter()
+
+            if stage == 'clusters':
+                # Topics are saved with their summaries under PATH_TO_TOPICS, where the app finds them
+                topics = topic_store.get_topics(filename, long_comments_list, comment_ids=comment_ids)
+                results['clusters'] = topics['clusters']
+            elif stage == 'emojis':
+                emoji_counts = emoji_extractor.get_emoji_counts(short_comments_list, processes=_processes or EMOJI_PROCESSES)
+                results['top_emojis'] = [emoji for emoji, _ in emoji_counts.most_common(NUM_TOP_EMOJIS)]
+            elif stage == 'statistics':
+                if long_comments_list:
+                    terms = term_index.get_term_index(filename, long_comments_list)
+                    # The scored copy of the dataframe is kept for the sentiment stage
+                    sentiment_stats = {}
+                    df = sentiment_engine.add_sentiment_column(df, processes=_processes or SENTIMENT_PROCESSES, stats=sentiment_stats)
+                    results['statistics'] = _statistics_to_json(get_statistics(df, long_comments_list, terms, sentiment_stats=sentiment_stats))
+            elif stage == 'sentiment':
+                df = sentiment_engine.add_sentiment_column(df, processes=_processes or SENTIMENT_PROCESSES)
+                results['sentiment_path'] = _save_sentiments(filename, df)
+            elif stage == 'queries':
+                hits = results.setdefault('hits', {})
+                new_queries = [query for query in queries if query not in hits]
+                all_hits = relevant_comments.get_relevant_comments_batch(new_queries, filename, long_comments_list, comment_ids=comment_ids)
+                hits.update({query: _hits_to_json(query_hits) for query, query_hits in zip(new_queries, all_hits)})
+            else:
+                raise ValueError(f'Unknown stage {stage}')
+
+            stored['stages'][stage] = {'seconds': time.perf_counter() - start, 'finished_at': time.time()}
+            summary['stages'][stage] = stored['stages'][stage]['seconds']
+
+        summary['failed_stage'] = None
+        _write_results(filename, stored)
+    except Exception as e:
+        summary['error'] = str(e)
+        print(f"Failed to analyze {filename}: {e}")
+        # The stages finished before the failure are kept
+        if stored is not None and stored['stages']:
+            try:
+                _write_results(filename, stored)
+            except Exception as e:
+                print(f"Error saving the results of {filename}: {e}")
+    return summary
+
+
+def _load_models(stages):
+    '''
+    To load the models the stages need, once per process
+    '''
+    encoders = (ENCODER_MODEL_NAME,) if 'clusters' in stages or 'queries' in stages else ()
+    cross_encoders = (CROSS_ENCODER_MODEL_NAME,) if 'queries' in stages else ()
+    model_registry.warm_up(encoders, cross_encoders)
+
+
+def _init_worker(stages):
+    '''
+    To set up a worker process before its first dataset
+    '''
+    global _processes
+    _processes = 1
+    _load_models(stages)
+
+
+def run_pipeline(filenames=None, stages=PIPELINE_STAGES, queries=(), max_workers=PIPELINE_MAX_WORKERS, force=False, progress_callback=None):
+    '''
+    To analyze many datasets (all of them by default), max_workers at a time in
+    separate processes. A failing dataset is reported in its summary without
+    stopping the others; progress_callback, if given, is called with every summary
+    as soon as its dataset is done.
+    Returns one summary per dataset, in the order of the file names.
+    '''
+    filenames = list(filenames) if filenames is not None else dataset_store.list_datasets()
+    stages = [stage for stage in PIPELINE_STAGES if stage in stages]
+    if 'queries' in stages and not queries:
+        stages.remove('queries')
+
+    summaries = {}
+
+    def report(summary):
+        summaries[summary['filename']] = summary
+        if progress_callback:
+            progress_callback(summary)
+
+    if max_workers == 1 or len(filenames) <= 1:
+        _load_models(stages)
+        for filename in filenames:
+            report(analyze_dataset(filename, stages, queries, force))
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(filenames)), initializer=_init_worker, initargs=(stages,)) as executor:
+            futures = [executor.submit(analyze_dataset, filename, stages, queries, force) for filename in filenames]
+            for future in as_completed(futures):
+                report(future.result())
+
+    return [summaries[filename] for filename in filenames]
@@ -0,0 +1,86 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import run_pipeline
+from modules.clustering import cluster_maker, topic_store
+from modules.emojitask import emoji_extractor
+from modules.pipeline import batch_pipeline
+from modules.retrieval import relevant_comments
+from modules.sentiment import sentiment_engine
+from modules.terms import term_index
+from benchmarks import synthetic_corpus
+
+QUERIES = ['love this song', 'best part of the video']
+
+
+@pytest.fixture
+def dataset(workdir, stub_models):
+    return synthetic_corpus.write_dataset(300, 0)
+
+
+def test_finished_stages_are_skipped_unless_forced(dataset):
+    stages = ['emojis', 'statistics']
+    assert list(batch_pipeline.analyze_dataset(dataset, stages)['stages']) == stages
+    assert batch_pipeline.analyze_dataset(dataset, stages)['stages'] == {}
+    # Stages not run yet still run
+    assert list(batch_pipeline.analyze_dataset(dataset, stages + ['sentiment'])['stages']) == ['sentiment']
+    assert list(batch_pipeline.analyze_dataset(dataset, stages, force=True)['stages']) == stages
+
+
+def test_results_of_every_stage_are_loaded(dataset):
+    summary = batch_pipeline.analyze_dataset(dataset, queries=QUERIES)
+    assert summary['error'] is None
+    assert list(summary['stages']) == batch_pipeline.PIPELINE_STAGES
+
+    results = batch_pipeline.load_results(dataset)
+    short_comments_list, long_comments_list, df = cluster_maker.load_data(dataset)
+    assert results['clusters'] == topic_store.get_topics(dataset, long_comments_list)['clusters']
+    assert results['top_emojis'] == [emoji for emoji, _ in emoji_extractor.get_emoji_counts(short_comments_list).most_common(batch_pipeline.NUM_TOP_EMOJIS)]
+
+    statistics = batch_pipeline.get_statistics(df, long_comments_list, term_index.get_term_index(dataset, long_comments_list))
+    for name in ('total_comments', 'unique_authors'):
+        assert results['statistics'][name] == statistics[name]
+    assert results['statistics']['avg_comment_length'] == pytest.approx(statistics['avg_comment_length'])
+    for name in ('top_comments', 'words_df', 'bigrams_df'):
+        pd.testing.assert_frame_equal(results['statistics'][name].reset_index(drop=True), statistics[name].reset_index(drop=True), check_dtype=False)
+    pd.testing.assert_series_equal(results['statistics']['sentiment_counts'], statistics['sentiment_counts'], check_names=False, check_index_type=False)
+
+    # Polarities are loaded in the order of the rows of the dataset
+    np.testing.assert_allclose(results['sentiment'], sentiment_engine.add_sentiment_column(df)[batch_pipeline.COLUMN_SENTIMENT], rtol=1e-6)
+
+    all_hits = relevant_comments.get_relevant_comments_batch(QUERIES, dataset, long_comments_list)
+    for query, hits in zip(QUERIES, all_hits):
+        assert results[('hits', query)] == batch_pipeline._hits_to_json(hits)
+
+
+def test_failed_stage_keeps_the_stages_before_it(dataset, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('no emojis today')
+    with monkeypatch.context() as patched:
+        patched.setattr(emoji_extractor, 'get_emoji_counts', fail)
+        summary = batch_pipeline.analyze_dataset(dataset, ['statistics', 'emojis', 'sentiment'])
+    assert summary['error'] == 'no emojis today'
+    assert summary['failed_stage'] == 'emojis'
+    assert list(summary['stages']) == ['statistics']
+    assert 'statistics' in batch_pipeline.load_results(dataset)
+
+    summary = batch_pipeline.analyze_dataset(dataset, ['statistics', 'emojis', 'sentiment'])
+    assert summary['error'] is None
+    assert list(summary['stages']) == ['emojis', 'sentiment']
+
+
+def test_cli_reports_every_dataset(dataset, workdir, capsys):
+    summary_path = workdir / 'summary.json'
+    assert run_pipeline.main([dataset, 'missing.csv', '--stages', 'emojis', '--workers', '1', '--summary', str(summary_path)]) == 1
+
+    summaries = json.loads(summary_path.read_text())
+    assert [summary['filename'] for summary in summaries] == [dataset, 'missing.csv']
+    assert summaries[0]['error'] is None and list(summaries[0]['stages']) == ['emojis']
+    assert summaries[1]['error']
+    assert 'Analyzed 1 of 2 datasets' in capsys.readouterr().out
+
+    assert run_pipeline.main([dataset, '--stages', 'emojis', '--workers', '1']) == 0
+    assert f'{dataset}: up to date' in capsys.readouterr().out
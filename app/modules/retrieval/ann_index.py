@@ -0,0 +1,285 @@
+'''
+Approximate nearest-neighbour search over corpus embeddings with an inverted file
+(IVF) index: vectors are grouped around k-means centroids and a query only scans
+the lists of its nprobe closest centroids.
+The index is built once per corpus and saved next to its embeddings; the index of
+quantized embeddings keeps its vectors quantized.
+'''
+
+import os
+import json
+import time
+import shutil
+import numpy as np
+from collections import OrderedDict
+
+from modules.constants import *
+from modules.embeddings import quantization
+
+_loaded_indexes = OrderedDict()
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _train_centroids(vectors, nlist, iterations=10, seed=0):
+    '''
+    To get nlist unit-length centroids with spherical k-means on a sample of the vectors
+    '''
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(len(vectors), nlist * 64), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+
+        # Reseed empty lists with random sample vectors
+        empty = np.bincount(assignment, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+
+    return centroids
+
+
+def _assign(vectors, centroids, chunk_size=16384):
+    return np.concatenate([np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+                           for start in range(0, len(vectors), chunk_size)])
+
+
+def build_index(corpus_embeddings, nlist=None):
+    '''
+    To build an IVF index over the corpus embeddings.
+    The index holds the normalized vectors reordered so that every list is contiguous.
+    '''
+    quantized = isinstance(corpus_embeddings, quantization.QuantizedEmbeddings)
+    # Rows of quantized embeddings come back normalized, a chunk at a time
+    vectors = corpus_embeddings if quantized else _normalize(corpus_embeddings)
+    if nlist is None:
+        nlist = max(1, int(np.sqrt(len(vectors))))
+    nlist = min(nlist, len(vectors))
+
+    centroids = _train_centroids(vectors, nlist)
+    assignment = _assign(vectors, centroids)
+
+    ids = np.argsort(assignment, kind='stable')
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignment, minlength=nlist))
+
+    return {'centroids': centroids,
+            'ids': ids,
+            'offsets': offsets,
+            'vectors': vectors.take(ids) if quantized else vectors[ids],
+            'meta': {'nlist': int(nlist), 'count': int(len(vectors)), 'dtype': vectors.dtype if quantized else 'float32'}}
+
+
+def search(index, query_embeddings, top_k=10, nprobe=ANN_NPROBE):
+    '''
+    To get the top_k approximate nearest neighbours of every query, in the same
+    shape as util.semantic_search: one list of {'corpus_id', 'score'} per query.
+    nprobe=None uses the nprobe picked for the index when it was built.
+    '''
+    queries = _normalize(np.atleast_2d(np.asarray(query_embeddings)))
+    centroids, offsets = index['centroids'], index['offsets']
+    if nprobe is None:
+        nprobe = index['meta'].get('nprobe') or ANN_MIN_NPROBE
+    nprobe = min(nprobe, len(centroids))
+
+    all_hits = []
+    for query in queries:
+        lists = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+        # Lists are contiguous, so each one is scored straight from its slice
+        positions = np.concatenate([np.arange(offsets[l], offsets[l + 1]) for l in lists])
+        scores = np.concatenate([index['vectors'][offsets[l]:offsets[l + 1]] @ query for l in lists])
+
+        k = min(top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k] if k > 0 else np.array([], dtype=np.int64)
+        best = best[np.argsort(-scores[best], kind='stable')]
+
+        all_hits.append([{'corpus_id': int(index['ids'][positions[i]]), 'score': float(scores[i])} for i in best])
+
+    return all_hits
+
+
+def exact_search(corpus_embeddings, query_embeddings, top_k=10, chunk_size=QUANTIZATION_CHUNK_SIZE):
+    '''
+    To get the exact top_k nearest neighbours of every query by brute force, scoring
+    the corpus a chunk of rows at a time so that no normalized copy of it is made
+    '''
+    if isinstance(corpus_embeddings, quantization.QuantizedEmbeddings):
+        return quantization.semantic_search(query_embeddings, corpus_embeddings, top_k)
+    queries = _normalize(np.atleast_2d(np.asarray(query_embeddings)))
+    k = min(top_k, len(corpus_embeddings))
+    if k == 0:
+        return [[] for _ in queries]
+
+    # Best k so far of every query, merged with the scores of every chunk
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(corpus_embeddings), chunk_size):
+        scores = queries @ _normalize(corpus_embeddings[start:start + chunk_size]).T
+        ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids], axis=1)
+        if scores.shape[1] > k:
+            keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores, ids = np.take_along_axis(scores, keep, axis=1), np.take_along_axis(ids, keep, axis=1)
+        best_scores, best_ids = scores, ids
+
+    all_hits = []
+    for scores, ids in zip(best_scores, best_ids):
+        order = np.lexsort((ids, -scores))
+        all_hits.append([{'corpus_id': int(ids[i]), 'score': float(scores[i])} for i in order])
+    return all_hits
+
+
+def _get_recall(approximate, exact):
+    '''
+    To get the share of the exact hits found. Corpora have many duplicate comments, so
+    a hit scoring as high as the last exact hit counts as found whatever its id.
+    '''
+    found = sum(min(len(e), sum(hit['score'] >= e[-1]['score'] - 1e-6 for hit in a)) for a, e in zip(approximate, exact) if e)
+    total = sum(len(e) for e in exact)
+    return found / total if total else 1.0
+
+
+def _sample_queries(corpus_embeddings, num_queries, seed):
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(corpus_embeddings), size=min(num_queries, len(corpus_embeddings)), replace=False)
+    return np.asarray(corpus_embeddings[np.sort(sample)], dtype=np.float32)
+
+
+def measure_recall(index, corpus_embeddings, num_queries=ANN_RECALL_QUERIES, top_k=10, nprobe=ANN_NPROBE, seed=0):
+    '''
+    To get the recall@top_k of the index against brute force, using random corpus
+    vectors as queries
+    '''
+    queries = _sample_queries(corpus_embeddings, num_queries, seed)
+    return _get_recall(search(index, queries, top_k, nprobe), exact_search(corpus_embeddings, queries, top_k))
+
+
+def tune_nprobe(index, corpus_embeddings, target_recall=ANN_TARGET_RECALL, num_queries=ANN_RECALL_QUERIES, top_k=10, seed=0):
+    '''
+    To get the smallest nprobe, from ANN_MIN_NPROBE and doubling, whose recall@top_k
+    reaches target_recall on random corpus vectors, with that recall.
+    Brute force is run once for every nprobe tried.
+    '''
+    queries = _sample_queries(corpus_embeddings, num_queries, seed)
+    exact = exact_search(corpus_embeddings, queries, top_k)
+    nlist = len(index['centroids'])
+    nprobe = min(ANN_MIN_NPROBE, nlist)
+    while True:
+        recall = _get_recall(search(index, queries, top_k, nprobe), exact)
+        if recall >= target_recall or nprobe >= nlist:
+            return nprobe, recall
+        nprobe = min(nprobe * 2, nlist)
+
+
+def _get_index_path(key):
+    return os.path.join(PATH_TO_EMBEDDING_STORE, f'{key}_ivf')
+
+
+def save_index(index, key):
+    '''
+    To save the index next to the embeddings of its corpus, replacing any saved one
+    '''
+    index_path = _get_index_path(key)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    vectors = index['vectors']
+    arrays = {'centroids': index['centroids'], 'ids': index['ids'], 'offsets': index['offsets']}
+    if isinstance(vectors, quantization.QuantizedEmbeddings):
+        arrays['vectors'] = vectors.codes
+        if vectors.scales is not None:
+            arrays['scales'] = vectors.scales
+    else:
+        arrays['vectors'] = vectors
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(index['meta'], f)
+
+    # A directory can only replace an empty one: the previous index, e.g. of an older
+    # version of the corpus, is moved aside first and deleted once the new one is in place.
+    # Indexes already open keep their memory-mapped files.
+    old_path = f'{index_path}.{os.getpid()}.old'
+    try:
+        os.replace(index_path, old_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # Another process saved an index in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def load_index(key):
+    '''
+    To load a saved index memory-mapped, or get None if there is none for the corpus
+    '''
+    index_path = _get_index_path(key)
+    if not os.path.isfile(os.path.join(index_path, 'meta.json')):
+        return None
+
+    try:
+        index = {name: np.load(os.path.join(index_path, f'{name}.npy'), mmap_mode='r')
+                 for name in ('centroids', 'ids', 'offsets', 'vectors')}
+        with open(os.path.join(index_path, 'meta.json')) as f:
+            index['meta'] = json.load(f)
+        if index['meta'].get('dtype', 'float32') != 'float32':
+            scales_path = os.path.join(index_path, 'scales.npy')
+            index['vectors'] = quantization.QuantizedEmbeddings(index['vectors'], np.load(scales_path) if os.path.isfile(scales_path) else None)
+    except Exception as e:
+        print(f"Error loading index {index_path}: {e}")
+        return None
+
+    return index
+
+
+def _remember(key, index):
+    _loaded_indexes[key] = index
+    _loaded_indexes.move_to_end(key)
+    while len(_loaded_indexes) > ANN_CACHE_MAX_ENTRIES:
+        _loaded_indexes.popitem(last=False)
+
+
+def get_index(key, corpus_embeddings, nprobe=ANN_NPROBE):
+    '''
+    To get the index of a corpus, building, measuring and saving it on first use.
+    nprobe=None picks the nprobe of the index when it is built (see tune_nprobe),
+    otherwise the recall is measured at the given nprobe.
+    Returns None for corpora small enough to be searched exactly.
+    '''
+    if len(corpus_embeddings) < ANN_MIN_CORPUS_SIZE:
+        return None
+
+    if isinstance(corpus_embeddings, quantization.QuantizedEmbeddings):
+        key = f'{key}_{corpus_embeddings.dtype}'
+
+    if key in _loaded_indexes:
+        _loaded_indexes.move_to_end(key)
+        return _loaded_indexes[key]
+
+    index = load_index(key)
+    if index is None or index['meta'].get('count') != len(corpus_embeddings):
+        start = time.perf_counter()
+        index = build_index(corpus_embeddings)
+        index['meta']['build_seconds'] = time.perf_counter() - start
+        if nprobe is None:
+            index['meta']['nprobe'], index['meta']['recall_at_10'] = tune_nprobe(index, corpus_embeddings)
+        else:
+            index['meta']['nprobe'], index['meta']['recall_at_10'] = nprobe, measure_recall(index, corpus_embeddings, nprobe=nprobe)
+        print(f"Built IVF index with {index['meta']['nlist']} lists in {index['meta']['build_seconds']:.2f}s, "
+              f"recall@10 = {index['meta']['recall_at_10']:.3f} at nprobe = {index['meta']['nprobe']}")
+        save_index(index, key)
+        index = load_index(key) or index
+
+    _remember(key, index)
+    return index
@@ -1,48 +1,126 @@
-import os
-import pickle
-from sentence_transformers import SentenceTransformer, CrossEncoder, util
+import functools
+from sentence_transformers import util
 from modules.constants import *
+from modules.models import model_registry
+from modules.embeddings import embedding_store, quantization
+from modules.tracing import tracer
+from . import ann_index, rerank_cache
 
 
-def _get_relevant_comments_helper(comments, query, query_embedding, corpus_embeddings):
-    hits = util.semantic_search(query_embedding, corpus_embeddings, top_k = 10)
-    hits = hits[0]  
-    
-    cross_encoder = CrossEncoder('cross-encoder/ms-marco-TinyBERT-L-6')
-
-    cross_inp = [[query, comments[hit['corpus_id']]] for hit in hits]
-    cross_scores = cross_encoder.predict(cross_inp)
-    
-    for idx in range(len(cross_scores)):
-        hits[idx]['cross-score'] = cross_scores[idx]
-        
-    hits = sorted(hits, key=lambda x: x['cross-score'], reverse=True)
-    
+def _search_corpus(query_embeddings, corpus_embeddings, index = None, nprobe = ANN_NPROBE, top_k = 10):
+    '''
+    Get the top_k bi-encoder hits of every query in one search over the corpus.
+    Quantized corpus embeddings are searched in their compact form.
+    '''
+    with tracer.span('relevant_comments.search', items=len(corpus_embeddings), ann=index is not None):
+        if index is None and isinstance(corpus_embeddings, quantization.QuantizedEmbeddings):
+            return quantization.semantic_search(query_embeddings, corpus_embeddings, top_k = top_k)
+        if index is None:
+            return util.semantic_search(query_embeddings, corpus_embeddings, top_k = top_k)
+        return ann_index.search(index, query_embeddings.cpu().numpy(), top_k = top_k, nprobe = nprobe)
+
+
+def _rerank_hits(comments, queries, all_hits, rerank_depth = RERANK_DEPTH, skip_margin = RERANK_SKIP_MARGIN):
+    '''
+    Score the top rerank_depth hits of every query with the cross-encoder in one
+    predict call (cached scores are reused) and sort them by cross-score.
+    Queries whose best hit already leads by skip_margin are not reranked; hits that
+    are not reranked keep their bi-encoder order and have a cross-score of None.
+    '''
+    cross_encoder = model_registry.get_cross_encoder()
+
+    depths = []
+    for hits in all_hits:
+        decisive = skip_margin is not None and len(hits) > 1 and hits[0]['score'] - hits[1]['score'] >= skip_margin
+        depths.append(0 if decisive else min(rerank_depth, len(hits)))
+
+    cross_inp = [[query, comments[hit['corpus_id']]] for query, hits, depth in zip(queries, all_hits, depths) for hit in hits[:depth]]
+    with tracer.span('relevant_comments.rerank', items=len(cross_inp)):
+        cross_scores = rerank_cache.predict(cross_encoder, CROSS_ENCODER_MODEL_NAME, cross_inp) if cross_inp else []
+
+    pos = 0
+    reranked_hits = []
+    for hits, depth in zip(all_hits, depths):
+        for hit in hits[:depth]:
+            hit['cross-score'] = cross_scores[pos]
+            pos += 1
+        for hit in hits[depth:]:
+            hit['cross-score'] = None
+
+        reranked = sorted(hits[:depth], key=lambda x: x['cross-score'], reverse=True)
+        reranked_hits.append((reranked + hits[depth:])[:10])
+
+    return reranked_hits
+
+
+@functools.lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)
+def _encode_with(encoder, query):
+    return encoder.encode(query, convert_to_tensor=True)
+
+
+def _encode_query(query, model_name = ENCODER_MODEL_NAME):
+    '''
+    Embeddings of recent queries are cached per encoder instance, so a model
+    registered under the same name is not answered from the old one
+    '''
+    return _encode_with(model_registry.get_encoder(model_name), query)
+
+
+def _get_relevant_comments_helper(comments, query, query_embedding, corpus_embeddings, index = None, nprobe = ANN_NPROBE):
+    hits = _search_corpus(query_embedding, corpus_embeddings, index, nprobe)
+
     #print top 10 hits
     # for hit in hits[:10]:
         #print(hit['score'], comments[hit['corpus_id']])
-    
-    return hits[:10]
+
+    return _rerank_hits(comments, [query], hits[:1])[0]
 
 
 
-def get_relevant_comments(query, filename, comments_list = None):
-    encoder = SentenceTransformer('distilbert-base-nli-stsb-quora-ranking')
-    
-    if not os.path.isfile(os.path.join(PATH_TO_DATA_CACHE, f'{filename}_embedding_cache.pkl')):
-        corpus_embeddings = encoder.encode(comments_list, show_progress_bar=True, convert_to_numpy=True)
+@tracer.traced('relevant_comments.get_relevant_comments')
+def get_relevant_comments(query, filename, comments_list = None, comment_ids = None, nprobe = ANN_NPROBE, corpus_key = None):
+    '''
+    Get the 10 comments most relevant to the query.
+    Large corpora are searched through an IVF index, nprobe trades recall for speed.
+    corpus_key can be passed by callers that already have it, the comments of a dataset
+    are otherwise hashed once per version of the dataset.
+    '''
+    corpus_key = corpus_key or embedding_store.get_dataset_corpus_key(filename, comments_list)
 
-        with open(os.path.join(PATH_TO_DATA_CACHE, f'{filename}_embedding_cache.pkl'), 'wb') as f:
-            pickle.dump(corpus_embeddings, f)
-    else:
-        # load embeddings from cache
-        with open(os.path.join(PATH_TO_DATA_CACHE, f'{filename}_embedding_cache.pkl'), 'rb') as f:
-            corpus_embeddings = pickle.load(f)
+    corpus_embeddings = embedding_store.get_embeddings(comments_list, filename, comment_ids=comment_ids, corpus_key=corpus_key)
 
-    query_embedding = encoder.encode(query, convert_to_tensor=True)
+    index = ann_index.get_index(corpus_key, corpus_embeddings, nprobe)
 
-    top_retrieved_comments = _get_relevant_comments_helper(comments_list, query, query_embedding, corpus_embeddings)
+    with tracer.span('relevant_comments.encode_queries', items=1):
+        query_embedding = _encode_query(query)
+
+    top_retrieved_comments = _get_relevant_comments_helper(comments_list, query, query_embedding, corpus_embeddings, index, nprobe)
 
     return top_retrieved_comments
 
 
+@tracer.traced('relevant_comments.get_relevant_comments_batch')
+def get_relevant_comments_batch(queries, filename, comments_list = None, comment_ids = None, nprobe = ANN_NPROBE, corpus_key = None):
+    '''
+    Get the 10 comments most relevant to each of the queries.
+    The queries are encoded in one batch, searched with a single matrix search and
+    reranked with a single cross-encoder call; one hit list is returned per query.
+    '''
+    if not queries:
+        return []
+    tracer.current_span().set(items=len(queries))
+
+    encoder = model_registry.get_encoder()
+
+    corpus_key = corpus_key or embedding_store.get_dataset_corpus_key(filename, comments_list)
+
+    corpus_embeddings = embedding_store.get_embeddings(comments_list, filename, comment_ids=comment_ids, corpus_key=corpus_key)
+
+    index = ann_index.get_index(corpus_key, corpus_embeddings, nprobe)
+
+    with tracer.span('relevant_comments.encode_queries', items=len(queries)):
+        query_embeddings = encoder.encode(list(queries), convert_to_tensor=True)
+
+    all_hits = _search_corpus(query_embeddings, corpus_embeddings, index, nprobe)
+
+    return _rerank_hits(comments_list, queries, all_hits)
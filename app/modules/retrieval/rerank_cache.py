@@ -0,0 +1,112 @@
+'''
+Cache of cross-encoder scores keyed by (model, query, comment hash): an in-memory
+LRU shared by the whole process, backed by an optional SQLite file so that scores
+survive restarts and are shared between processes
+'''
+
+import os
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from modules.constants import *
+
+_scores = OrderedDict()
+_lock = threading.Lock()
+
+
+def _get_key(model_name, query, comment):
+    comment_hash = hashlib.sha1(comment.encode('utf-8')).hexdigest()
+    return (model_name, query, comment_hash)
+
+
+def _connect():
+    os.makedirs(os.path.dirname(PATH_TO_RERANK_CACHE), exist_ok=True)
+    connection = sqlite3.connect(PATH_TO_RERANK_CACHE, timeout=5)
+    connection.execute('CREATE TABLE IF NOT EXISTS scores '
+                       '(model TEXT, query TEXT, comment_hash TEXT, score REAL, '
+                       'PRIMARY KEY (model, query, comment_hash))')
+    return connection
+
+
+def _remember(key, score):
+    _scores[key] = score
+    _scores.move_to_end(key)
+    while len(_scores) > RERANK_CACHE_SIZE:
+        _scores.popitem(last=False)
+
+
+def _read_disk(keys):
+    try:
+        connection = _connect()
+        found = {}
+        with connection:
+            for key in keys:
+                row = connection.execute('SELECT score FROM scores WHERE model = ? AND query = ? AND comment_hash = ?', key).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+        connection.close()
+        return found
+    except Exception as e:
+        print(f"Error reading rerank cache: {e}")
+        return {}
+
+
+def _write_disk(items):
+    try:
+        connection = _connect()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+                                   [key + (score,) for key, score in items])
+        connection.close()
+    except Exception as e:
+        print(f"Error writing rerank cache: {e}")
+
+
+def predict(cross_encoder, model_name, pairs):
+    '''
+    To get the cross-encoder score of every [query, comment] pair, only running the
+    model on the pairs that are not cached yet
+    '''
+    keys = [_get_key(model_name, query, comment) for query, comment in pairs]
+
+    with _lock:
+        scores = {key: _scores[key] for key in keys if key in _scores}
+        for key in scores:
+            _scores.move_to_end(key)
+
+    missing = [key for key in dict.fromkeys(keys) if key not in scores]
+    if missing and RERANK_DISK_CACHE:
+        found = _read_disk(missing)
+        scores.update(found)
+        with _lock:
+            for key, score in found.items():
+                _remember(key, score)
+        missing = [key for key in missing if key not in found]
+
+    if missing:
+        missing = set(missing)
+        missing_pairs = {}
+        for key, pair in zip(keys, pairs):
+            if key in missing and key not in missing_pairs:
+                missing_pairs[key] = pair
+
+        new_scores = [float(score) for score in cross_encoder.predict(list(missing_pairs.values()))]
+        new_items = list(zip(missing_pairs.keys(), new_scores))
+        scores.update(new_items)
+        with _lock:
+            for key, score in new_items:
+                _remember(key, score)
+        if RERANK_DISK_CACHE:
+            _write_disk(new_items)
+
+    return [scores[key] for key in keys]
+
+
+def clear():
+    '''
+    To empty the in-memory cache
+    '''
+    with _lock:
+        _scores.clear()
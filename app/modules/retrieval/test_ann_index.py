@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+from modules.retrieval import ann_index
+
+
+def test_chunked_exact_search_matches_brute_force(topic_embeddings):
+    rng = np.random.default_rng(0)
+    corpus = topic_embeddings * rng.uniform(0.5, 2, size=(len(topic_embeddings), 1)).astype(np.float32)
+    queries = rng.normal(size=(20, corpus.shape[1])).astype(np.float32)
+
+    hits = ann_index.exact_search(corpus, queries, top_k=7, chunk_size=64)
+    scores = ann_index._normalize(queries) @ ann_index._normalize(corpus).T
+    for query_hits, query_scores in zip(hits, scores):
+        np.testing.assert_allclose([hit['score'] for hit in query_hits], np.sort(query_scores)[::-1][:7], rtol=1e-5)
+
+
+def test_tuned_nprobe_reaches_target_recall(topic_embeddings):
+    index = ann_index.build_index(topic_embeddings)
+    nprobe, recall = ann_index.tune_nprobe(index, topic_embeddings, target_recall=0.95)
+    assert recall >= 0.95
+    assert ann_index.measure_recall(index, topic_embeddings, nprobe=nprobe) == recall
+
+    # Searches use the nprobe of the index unless told otherwise
+    index['meta']['nprobe'] = nprobe
+    queries = topic_embeddings[:5]
+    assert ann_index.search(index, queries) == ann_index.search(index, queries, nprobe=nprobe)
+
+
+def test_loaded_indexes_are_bounded(monkeypatch):
+    monkeypatch.setattr(ann_index, 'ANN_CACHE_MAX_ENTRIES', 2)
+    monkeypatch.setattr(ann_index, '_loaded_indexes', type(ann_index._loaded_indexes)())
+    for key in ('a', 'b', 'c'):
+        ann_index._remember(key, {})
+    assert list(ann_index._loaded_indexes) == ['b', 'c']
+
+
+def test_saved_index_is_replaced(workdir, topic_embeddings):
+    old_index = ann_index.build_index(topic_embeddings[:1000])
+    ann_index.save_index(old_index, 'corpus')
+    old_loaded = ann_index.load_index('corpus')
+
+    # The corpus grew: its new index replaces the saved one
+    ann_index.save_index(ann_index.build_index(topic_embeddings), 'corpus')
+    index = ann_index.load_index('corpus')
+    assert index['meta']['count'] == len(topic_embeddings)
+    assert ann_index.search(index, topic_embeddings[:5]) == ann_index.search(ann_index.build_index(topic_embeddings), topic_embeddings[:5])
+    assert os.listdir(os.path.dirname(ann_index._get_index_path('corpus'))) == ['corpus_ivf']
+
+    # The index loaded before stays readable
+    assert len(np.asarray(old_loaded['ids'])) == 1000
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+
+from modules.constants import *
+from modules.clustering import cluster_maker
+from modules.embeddings import embedding_store
+from modules.models import model_registry
+from modules.retrieval import relevant_comments, rerank_cache
+from benchmarks import stub_encoder, synthetic_corpus
+
+
+def test_corpus_is_hashed_once_per_dataset_version(workdir, stub_models, monkeypatch):
+    filename = synthetic_corpus.write_dataset(300, 0)
+    _, comments_list, _ = cluster_maker.load_data(filename)
+
+    hashed = []
+    get_corpus_key = embedding_store.get_corpus_key
+    monkeypatch.setattr(embedding_store, 'get_corpus_key', lambda comments, *args: hashed.append(len(comments)) or get_corpus_key(comments, *args))
+
+    first = relevant_comments.get_relevant_comments_batch(['love this song'], filename, comments_list)
+    second = relevant_comments.get_relevant_comments_batch(['love this song'], filename, comments_list)
+    assert first == second
+    assert hashed == [len(comments_list)]
+
+    # A rewritten dataset is hashed again
+    path = os.path.join('data', filename)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    relevant_comments.get_relevant_comments_batch(['love this song'], filename, comments_list)
+    assert len(hashed) == 2
+
+
+def test_comments_without_dataset_are_hashed(workdir):
+    assert embedding_store.get_dataset_corpus_key(None, ['a comment']) == embedding_store.get_corpus_key(['a comment'])
+    assert embedding_store.get_dataset_corpus_key('missing.parquet', ['a comment']) == embedding_store.get_corpus_key(['a comment'])
+
+
+class CountingEncoder(stub_encoder.StubEncoder):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def encode(self, sentences, *args, **kwargs):
+        self.calls += 1
+        return super().encode(sentences, *args, **kwargs)
+
+
+class CountingCrossEncoder(stub_encoder.StubCrossEncoder):
+    def __init__(self):
+        self.calls = 0
+
+    def predict(self, sentence_pairs, *args, **kwargs):
+        self.calls += 1
+        return super().predict(sentence_pairs, *args, **kwargs)
+
+
+def test_batch_matches_single_queries_with_one_model_call_each(workdir, stub_models, monkeypatch):
+    filename = synthetic_corpus.write_dataset(300, 0)
+    _, comments_list, _ = cluster_maker.load_data(filename)
+    corpus_key = embedding_store.get_dataset_corpus_key(filename, comments_list)
+    embedding_store.get_embeddings(comments_list, filename, corpus_key=corpus_key)
+
+    encoder, cross_encoder = CountingEncoder(), CountingCrossEncoder()
+    model_registry.register_model(encoder, ENCODER_MODEL_NAME)
+    model_registry.register_model(cross_encoder, CROSS_ENCODER_MODEL_NAME, kind=model_registry.CROSS_ENCODER)
+    monkeypatch.setattr(rerank_cache, 'RERANK_DISK_CACHE', False)
+    rerank_cache.clear()
+
+    queries = ['love this song', 'the video quality', 'first comment here']
+    batch = relevant_comments.get_relevant_comments_batch(queries, filename, comments_list, corpus_key=corpus_key)
+    assert encoder.calls == 1
+    assert cross_encoder.calls == 1
+
+    assert len(batch) == len(queries)
+    for query, hits in zip(queries, batch):
+        single = relevant_comments.get_relevant_comments(query, filename, comments_list, corpus_key=corpus_key)
+        assert [hit['corpus_id'] for hit in hits] == [hit['corpus_id'] for hit in single]
+        np.testing.assert_allclose([hit['score'] for hit in hits], [hit['score'] for hit in single], rtol=1e-5)
+        assert [hit['cross-score'] for hit in hits] == [hit['cross-score'] for hit in single]
+
+
+def test_decisive_hits_are_not_reranked(stub_models, monkeypatch):
+    monkeypatch.setattr(rerank_cache, 'RERANK_DISK_CACHE', False)
+    rerank_cache.clear()
+    cross_encoder = CountingCrossEncoder()
+    model_registry.register_model(cross_encoder, CROSS_ENCODER_MODEL_NAME, kind=model_registry.CROSS_ENCODER)
+
+    comments = ['love this song', 'i love this song', 'a bad video', 'video quality']
+    decisive = [{'corpus_id': 0, 'score': 0.9}, {'corpus_id': 1, 'score': 0.5}]
+    close = [{'corpus_id': 2, 'score': 0.6}, {'corpus_id': 3, 'score': 0.55}]
+    reranked = relevant_comments._rerank_hits(comments, ['love this song', 'video quality'], [decisive, close], skip_margin=0.2)
+
+    assert cross_encoder.calls == 1
+    assert [hit['cross-score'] for hit in reranked[0]] == [None, None]
+    assert [hit['corpus_id'] for hit in reranked[0]] == [0, 1]
+    assert [hit['corpus_id'] for hit in reranked[1]] == [3, 2]
+    assert all(hit['cross-score'] is not None for hit in reranked[1])
+
+
+def test_query_embeddings_follow_the_registered_encoder(stub_models):
+    query = 'love this song'
+    first = relevant_comments._encode_query(query)
+
+    model_registry.register_model(stub_encoder.StubEncoder(embedding_size=16), ENCODER_MODEL_NAME)
+    assert first.shape == (stub_encoder.EMBEDDING_SIZE,)
+    assert relevant_comments._encode_query(query).shape == (16,)
@@ -0,0 +1,50 @@
+from modules.constants import *
+from modules.retrieval import rerank_cache
+from benchmarks import stub_encoder
+
+
+class CountingCrossEncoder(stub_encoder.StubCrossEncoder):
+    def __init__(self):
+        self.pairs = []
+
+    def predict(self, sentence_pairs, *args, **kwargs):
+        self.pairs.append(list(sentence_pairs))
+        return super().predict(sentence_pairs, *args, **kwargs)
+
+
+PAIRS = [['love this song', 'i love this song so much'],
+         ['love this song', 'the video quality is bad'],
+         ['first comment', 'first comment here']]
+
+
+def test_cached_scores_are_not_predicted_again(workdir, monkeypatch):
+    monkeypatch.setattr(rerank_cache, 'RERANK_DISK_CACHE', False)
+    rerank_cache.clear()
+    cross_encoder = CountingCrossEncoder()
+
+    scores = rerank_cache.predict(cross_encoder, CROSS_ENCODER_MODEL_NAME, PAIRS)
+    assert len(cross_encoder.pairs) == 1
+
+    # Only the new pair is scored, repeated pairs are scored once
+    new_pair = ['first comment', 'not the first one']
+    again = rerank_cache.predict(cross_encoder, CROSS_ENCODER_MODEL_NAME, PAIRS + [new_pair, new_pair])
+    assert again[:len(PAIRS)] == scores
+    assert again[-1] == again[-2]
+    assert cross_encoder.pairs[1:] == [[new_pair]]
+
+    # Scores are kept per model
+    rerank_cache.predict(cross_encoder, 'another-model', PAIRS[:1])
+    assert cross_encoder.pairs[2:] == [PAIRS[:1]]
+
+
+def test_scores_are_shared_through_the_disk_cache(workdir, monkeypatch):
+    monkeypatch.setattr(rerank_cache, 'RERANK_DISK_CACHE', True)
+    rerank_cache.clear()
+    scores = rerank_cache.predict(CountingCrossEncoder(), CROSS_ENCODER_MODEL_NAME, PAIRS)
+    assert (workdir / 'data' / 'cache' / 'rerank_cache.sqlite').exists()
+
+    # An empty in-memory cache, as in a new process, reads the scores from SQLite
+    rerank_cache.clear()
+    cross_encoder = CountingCrossEncoder()
+    assert rerank_cache.predict(cross_encoder, CROSS_ENCODER_MODEL_NAME, PAIRS) == scores
+    assert cross_encoder.pairs == []
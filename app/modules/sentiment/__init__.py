@@ -0,0 +1 @@
+from .sentiment_engine import *
@@ -0,0 +1,107 @@
+'''
+Sentiment scoring of comments with TextBlob.
+Comments are scored in batches across a process pool, and the polarity of every
+comment is cached by the hash of its text (the SENTIMENT_CACHE_SIZE most recently
+used ones), so a comment is scored once per process while it is still cached.
+'''
+
+import time
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from textblob import TextBlob
+
+from modules.constants import *
+
+_polarities = OrderedDict()
+_lock = threading.Lock()
+
+
+def _get_hash(comment):
+    return hashlib.sha1(comment.encode('utf-8')).digest()
+
+
+def _score_batch(comments):
+    return [TextBlob(comment).sentiment.polarity for comment in comments]
+
+
+def score_comments(comments_list, batch_size=SENTIMENT_BATCH_SIZE, processes=SENTIMENT_PROCESSES, stats=None):
+    '''
+    To get the polarity (-1 to 1) of every comment as an array.
+    Only comments that are not cached are scored, in batches of batch_size,
+    on a pool of worker processes when there are enough of them.
+    stats, if given, is a dict filled with the comments, the comments scored, the seconds
+    taken and the comments per second of this call.
+    '''
+    start = time.perf_counter()
+    hashes = [_get_hash(comment) for comment in comments_list]
+
+    # Each distinct comment is scored once
+    known = {}
+    missing = {}
+    with _lock:
+        for comment_hash, comment in zip(hashes, comments_list):
+            if comment_hash in known or comment_hash in missing:
+                continue
+            if comment_hash in _polarities:
+                _polarities.move_to_end(comment_hash)
+                known[comment_hash] = _polarities[comment_hash]
+            else:
+                missing[comment_hash] = comment
+
+    if missing:
+        missing_comments = list(missing.values())
+        batches = [missing_comments[i:i + batch_size] for i in range(0, len(missing_comments), batch_size)]
+
+        if processes != 1 and len(missing_comments) >= SENTIMENT_PARALLEL_MIN:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                scores = [score for batch in executor.map(_score_batch, batches) for score in batch]
+        else:
+            scores = [score for batch in batches for score in _score_batch(batch)]
+
+        scored = dict(zip(missing.keys(), scores))
+        known.update(scored)
+        with _lock:
+            _polarities.update(scored)
+            while len(_polarities) > SENTIMENT_CACHE_SIZE:
+                _polarities.popitem(last=False)
+
+    polarities = np.array([known[comment_hash] for comment_hash in hashes], dtype=np.float32)
+
+    if stats is not None:
+        seconds = time.perf_counter() - start
+        stats.update({'comments': len(comments_list),
+                      'scored': len(missing),
+                      'seconds': seconds,
+                      'comments_per_second': len(comments_list) / seconds if seconds > 0 else 0.0})
+    return polarities
+
+
+def get_sentiment_labels(polarities):
+    '''
+    To get 'Positive', 'Negative' or 'Neutral' for every polarity
+    '''
+    polarities = np.asarray(polarities)
+    return np.select([polarities > 0, polarities < 0], ['Positive', 'Negative'], 'Neutral')
+
+
+def add_sentiment_column(df, column=COLUMN_COMMENT, processes=SENTIMENT_PROCESSES, stats=None):
+    '''
+    To get a copy of the dataframe with the polarity of every comment as its Sentiment column,
+    or the dataframe itself if it already has one. The dataframe, which may be shared by
+    the dataset cache, is left unchanged. stats is passed to score_comments.
+    '''
+    if COLUMN_SENTIMENT in df:
+        return df
+    polarities = score_comments(df[column].fillna('').astype(str).tolist(), processes=processes, stats=stats)
+    return df.assign(**{COLUMN_SENTIMENT: polarities})
+
+
+def clear():
+    '''
+    To forget every cached polarity
+    '''
+    with _lock:
+        _polarities.clear()
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from modules.constants import *
+from modules.sentiment import sentiment_engine
+
+
+def test_dataframe_is_scored_on_a_copy():
+    sentiment_engine.clear()
+    df = pd.DataFrame({COLUMN_COMMENT: ['I love this video', 'This is awful', None]})
+    stats = {}
+    scored_df = sentiment_engine.add_sentiment_column(df, processes=1, stats=stats)
+
+    assert COLUMN_SENTIMENT not in df
+    assert list(sentiment_engine.get_sentiment_labels(scored_df[COLUMN_SENTIMENT])) == ['Positive', 'Negative', 'Neutral']
+    assert stats['comments'] == 3 and stats['scored'] == 3
+    assert stats['comments_per_second'] >= 0
+    # A scored dataframe is not scored again
+    assert sentiment_engine.add_sentiment_column(scored_df) is scored_df
+
+
+def test_cached_polarities_are_bounded(monkeypatch):
+    sentiment_engine.clear()
+    monkeypatch.setattr(sentiment_engine, 'SENTIMENT_CACHE_SIZE', 2)
+    comments = ['great', 'terrible', 'fine', 'great']
+    polarities = sentiment_engine.score_comments(comments, processes=1)
+
+    np.testing.assert_allclose(polarities, sentiment_engine._score_batch(comments), rtol=1e-6)
+    assert len(sentiment_engine._polarities) == 2
+    stats = {}
+    sentiment_engine.score_comments(['fine'], processes=1, stats=stats)
+    assert stats['scored'] == 0
+    sentiment_engine.clear()
@@ -0,0 +1 @@
+from .term_index import *
@@ -0,0 +1,255 @@
+'''
+Term-frequency index of a dataset: sparse document-term matrices of its words and
+bigrams (stop words left out), built with vectorized tokenization and saved under
+PATH_TO_TERM_INDEX, so top words, top bigrams and per-cluster term counts are
+sums over the matrices.
+When comments are added to the start or the end of a dataset, only those comments
+are tokenized and the saved index is extended.
+'''
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from modules.constants import *
+
+TOKEN_PATTERN = r'\b\w+\b'
+
+_stop_words = None
+
+
+def get_stop_words():
+    '''
+    To get the English stop words of nltk, or none if they are not downloaded
+    '''
+    global _stop_words
+    if _stop_words is None:
+        try:
+            from nltk.corpus import stopwords
+            _stop_words = set(stopwords.words('english'))
+        except LookupError:
+            print("nltk stop words are not downloaded, no words will be left out")
+            _stop_words = set()
+    return _stop_words
+
+
+def get_row_hashes(comments_list):
+    return pd.util.hash_pandas_object(pd.Series(comments_list, dtype=object), index=False).to_numpy()
+
+
+def _tokenize(comments_list):
+    '''
+    To get the row of every token and the tokens of all comments, in order
+    '''
+    tokens = pd.Series(comments_list, dtype=object).str.lower().str.findall(TOKEN_PATTERN).explode().dropna()
+    return tokens.index.to_numpy(dtype=np.int64), tokens.to_numpy(dtype=object)
+
+
+def _encode(terms, vocabulary):
+    '''
+    To get the column of every term, adding the terms not seen before to the vocabulary
+    '''
+    codes = pd.Index(vocabulary, dtype=object).get_indexer(terms) if vocabulary else np.full(len(terms), -1)
+    new = codes < 0
+    if new.any():
+        new_codes, new_terms = pd.factorize(terms[new])
+        codes[new] = new_codes + len(vocabulary)
+        vocabulary = vocabulary + list(new_terms)
+    return codes, vocabulary
+
+
+def _count(rows, codes, num_rows, num_terms):
+    counts = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, codes)), shape=(num_rows, num_terms))
+    counts.sum_duplicates()
+    return counts
+
+
+def _build_matrices(comments_list, word_vocabulary, bigram_vocabulary):
+    rows, tokens = _tokenize(comments_list)
+    is_stop_word = pd.Series(tokens, dtype=object).isin(get_stop_words()).to_numpy()
+
+    # Bigrams are pairs of consecutive tokens of a comment, neither of them a stop word
+    pairs = (rows[1:] == rows[:-1]) & ~is_stop_word[1:] & ~is_stop_word[:-1]
+    bigram_rows = rows[1:][pairs]
+    bigrams = tokens[:-1][pairs] + ' ' + tokens[1:][pairs]
+
+    word_rows, words = rows[~is_stop_word], tokens[~is_stop_word]
+    word_codes, word_vocabulary = _encode(words, word_vocabulary)
+    bigram_codes, bigram_vocabulary = _encode(bigrams, bigram_vocabulary)
+
+    num_rows = len(comments_list)
+    return (_count(word_rows, word_codes, num_rows, len(word_vocabulary)), word_vocabulary,
+            _count(bigram_rows, bigram_codes, num_rows, len(bigram_vocabulary)), bigram_vocabulary)
+
+
+def _make_index(words, word_vocabulary, bigrams, bigram_vocabulary, row_hashes):
+    return {'words': words,
+            'word_vocabulary': word_vocabulary,
+            'word_totals': np.asarray(words.sum(axis=0)).ravel(),
+            'bigrams': bigrams,
+            'bigram_vocabulary': bigram_vocabulary,
+            'bigram_totals': np.asarray(bigrams.sum(axis=0)).ravel(),
+            'row_hashes': row_hashes}
+
+
+def build_index(comments_list):
+    '''
+    To build the term-frequency index of a list of comments
+    '''
+    words, word_vocabulary, bigrams, bigram_vocabulary = _build_matrices(comments_list, [], [])
+    return _make_index(words, word_vocabulary, bigrams, bigram_vocabulary, get_row_hashes(comments_list))
+
+
+def _widen(counts, num_terms):
+    return sp.csr_matrix((counts.data, counts.indices, counts.indptr), shape=(counts.shape[0], num_terms))
+
+
+def update_index(index, comments_list, row_hashes=None):
+    '''
+    To get the index of comments_list from the index of an older version of it.
+    Comments added before or after the indexed ones are tokenized and stacked onto the
+    stored matrices; any other change rebuilds the index.
+    '''
+    if row_hashes is None:
+        row_hashes = get_row_hashes(comments_list)
+    old_hashes = index['row_hashes']
+    num_old, num_new = len(old_hashes), len(row_hashes) - len(old_hashes)
+
+    if num_new == 0 and np.array_equal(row_hashes, old_hashes):
+        return index
+    if num_new < 0:
+        return build_index(comments_list)
+
+    if np.array_equal(row_hashes[num_new:], old_hashes):
+        new_rows, prepend = comments_list[:num_new], True
+    elif np.array_equal(row_hashes[:num_old], old_hashes):
+        new_rows, prepend = comments_list[num_old:], False
+    else:
+        return build_index(comments_list)
+
+    words, word_vocabulary, bigrams, bigram_vocabulary = _build_matrices(new_rows, index['word_vocabulary'], index['bigram_vocabulary'])
+    old_words = _widen(index['words'], len(word_vocabulary))
+    old_bigrams = _widen(index['bigrams'], len(bigram_vocabulary))
+
+    if prepend:
+        words, bigrams = sp.vstack([words, old_words], format='csr'), sp.vstack([bigrams, old_bigrams], format='csr')
+    else:
+        words, bigrams = sp.vstack([old_words, words], format='csr'), sp.vstack([old_bigrams, bigrams], format='csr')
+    return _make_index(words, word_vocabulary, bigrams, bigram_vocabulary, row_hashes)
+
+
+def _get_index_path(filename):
+    return os.path.join(PATH_TO_TERM_INDEX, f'{filename}_terms')
+
+
+def save_index(index, filename):
+    '''
+    To save the index of a dataset, replacing the one saved before
+    '''
+    index_path = _get_index_path(filename)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    sp.save_npz(os.path.join(tmp_path, 'words.npz'), index['words'])
+    sp.save_npz(os.path.join(tmp_path, 'bigrams.npz'), index['bigrams'])
+    np.save(os.path.join(tmp_path, 'row_hashes.npy'), index['row_hashes'])
+    with open(os.path.join(tmp_path, 'vocabulary.json'), 'w', encoding='utf-8') as f:
+        json.dump({'words': index['word_vocabulary'], 'bigrams': index['bigram_vocabulary']}, f, ensure_ascii=False)
+
+    if os.path.isdir(index_path):
+        shutil.rmtree(index_path, ignore_errors=True)
+    os.replace(tmp_path, index_path)
+
+
+def load_index(filename):
+    '''
+    To load the saved index of a dataset, or get None if there is none
+    '''
+    index_path = _get_index_path(filename)
+    if not os.path.isfile(os.path.join(index_path, 'vocabulary.json')):
+        return None
+
+    try:
+        with open(os.path.join(index_path, 'vocabulary.json'), encoding='utf-8') as f:
+            vocabulary = json.load(f)
+        return _make_index(sp.load_npz(os.path.join(index_path, 'words.npz')).tocsr(), vocabulary['words'],
+                           sp.load_npz(os.path.join(index_path, 'bigrams.npz')).tocsr(), vocabulary['bigrams'],
+                           np.load(os.path.join(index_path, 'row_hashes.npy')))
+    except Exception as e:
+        print(f"Error loading term index {index_path}: {e}")
+        return None
+
+
+def get_term_index(filename, comments_list):
+    '''
+    To get the index of the comments of a dataset, loading the saved one and
+    extending it with any comments added since, or building it on first use
+    '''
+    row_hashes = get_row_hashes(comments_list)
+    index = load_index(filename)
+    if index is not None and np.array_equal(index['row_hashes'], row_hashes):
+        return index
+
+    index = build_index(comments_list) if index is None else update_index(index, comments_list, row_hashes)
+    try:
+        save_index(index, filename)
+    except Exception as e:
+        print(f"Error saving term index of {filename}: {e}")
+    return index
+
+
+def _top_terms(totals, vocabulary, k, columns=None):
+    '''
+    To get the k terms with the highest counts; columns are the columns of the counts
+    when only the counts of some terms are given, e.g. the non-zero ones of a sparse row
+    '''
+    k = min(k, int(np.count_nonzero(totals)))
+    if k <= 0:
+        return []
+    # Terms tied with the k-th count are ordered alphabetically, whatever their columns
+    kth_count = np.partition(totals, len(totals) - k)[len(totals) - k]
+    top = np.flatnonzero(totals >= kth_count)
+    top_columns = top if columns is None else columns[top]
+    top_terms = sorted(((-int(totals[i]), vocabulary[column]) for i, column in zip(top, top_columns)))[:k]
+    return [(term, -count) for count, term in top_terms]
+
+
+def _get_totals(index, term, rows):
+    if rows is None:
+        return index[f'{term}_totals']
+    return np.asarray(index[f'{term}s'][np.asarray(rows)].sum(axis=0)).ravel()
+
+
+def get_top_words(index, k=10, rows=None):
+    '''
+    To get the k most frequent words with their counts, over all comments or the given rows
+    '''
+    return _top_terms(_get_totals(index, 'word', rows), index['word_vocabulary'], k)
+
+
+def get_top_bigrams(index, k=10, rows=None):
+    '''
+    To get the k most frequent bigrams with their counts, over all comments or the given rows
+    '''
+    return _top_terms(_get_totals(index, 'bigram', rows), index['bigram_vocabulary'], k)
+
+
+def get_cluster_term_counts(index, clusters, k=10, bigrams=False):
+    '''
+    To get the k most frequent words (or bigrams) of every cluster of comment rows
+    '''
+    term = 'bigram' if bigrams else 'word'
+    if not clusters:
+        return []
+    rows = np.concatenate([np.asarray(cluster, dtype=np.int64) for cluster in clusters])
+    cluster_ids = np.repeat(np.arange(len(clusters)), [len(cluster) for cluster in clusters])
+    membership = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (cluster_ids, rows)), shape=(len(clusters), len(index['row_hashes'])))
+
+    # Only the terms found in a cluster are ranked, the counts stay sparse
+    counts = (membership @ index[f'{term}s']).tocsr()
+    vocabulary = index[f'{term}_vocabulary']
+    return [_top_terms(counts.data[start:end], vocabulary, k, columns=counts.indices[start:end])
+            for start, end in zip(counts.indptr[:-1], counts.indptr[1:])]
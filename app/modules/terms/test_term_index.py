@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.terms import term_index
+from benchmarks import synthetic_corpus
+
+COMMENTS = ['I love this song, love it',
+            'The video is so good',
+            'love this song so much',
+            'this song is the best song',
+            'so good so good']
+
+
+@pytest.fixture(autouse=True)
+def stop_words(monkeypatch):
+    '''Fixed stop words, nltk's may not be downloaded'''
+    monkeypatch.setattr(term_index, '_stop_words', {'i', 'the', 'is', 'it', 'this'})
+
+
+def _as_frame(index, term):
+    '''Counts by term name, whatever the columns of the terms'''
+    counts = pd.DataFrame(index[f'{term}s'].toarray(), columns=index[f'{term}_vocabulary'])
+    return counts[sorted(counts.columns)]
+
+
+@pytest.mark.parametrize('start, end', [(0, 150), (150, 400), (100, 300)])
+def test_updated_index_matches_a_built_one(start, end):
+    comments_list = synthetic_corpus.generate_comments(400, 0)
+    index = term_index.update_index(term_index.build_index(comments_list[start:end]), comments_list)
+    built = term_index.build_index(comments_list)
+
+    for term in ('word', 'bigram'):
+        pd.testing.assert_frame_equal(_as_frame(index, term), _as_frame(built, term))
+    assert term_index.get_top_words(index, 20) == term_index.get_top_words(built, 20)
+    assert term_index.get_top_bigrams(index, 20) == term_index.get_top_bigrams(built, 20)
+
+
+def test_top_bigrams_leave_stop_words_out():
+    index = term_index.build_index(COMMENTS)
+    assert term_index.get_top_bigrams(index, 3) == [('so good', 3), ('best song', 1), ('good so', 1)]
+    assert term_index.get_top_words(index, 2) == [('so', 4), ('song', 4)]
+    assert term_index.get_top_bigrams(index, 10, rows=[1, 4]) == [('so good', 3), ('good so', 1)]
+
+
+def test_cluster_term_counts_match_the_counts_of_their_rows():
+    comments_list = synthetic_corpus.generate_comments(400, 0)
+    index = term_index.build_index(comments_list)
+    rng = np.random.default_rng(0)
+    clusters = [rng.choice(len(comments_list), size=size, replace=False) for size in (1, 10, 80)] + [[0, 1, 2]]
+
+    for bigrams in (False, True):
+        counts = term_index.get_cluster_term_counts(index, clusters, k=8, bigrams=bigrams)
+        top_terms = term_index.get_top_bigrams if bigrams else term_index.get_top_words
+        assert counts == [top_terms(index, 8, rows=cluster) for cluster in clusters]
+
+    assert term_index.get_cluster_term_counts(term_index.build_index(COMMENTS), [[0, 2], [1]], k=2) == [[('love', 3), ('song', 2)], [('good', 1), ('so', 1)]]
+    assert term_index.get_cluster_term_counts(index, []) == []
@@ -0,0 +1,41 @@
+import asyncio
+import threading
+
+from modules.tracing import tracer
+
+
+def test_records_are_filtered_by_trace():
+    trace_id = tracer.start_trace()
+
+    def other_session():
+        tracer.start_trace()
+        with tracer.span('other'):
+            pass
+
+    def job():
+        with tracer.span('job'):
+            pass
+
+    async def task():
+        with tracer.span('task'):
+            pass
+
+    with tracer.span('mine'):
+        for target in (other_session, job):
+            thread = threading.Thread(target=target)
+            thread.start()
+            thread.join()
+        asyncio.run(task())
+
+    assert [record['name'] for record in tracer.get_records(trace_id)] == ['task', 'mine']
+    assert {'other', 'job'} <= {record['name'] for record in tracer.get_records()}
+
+
+def test_process_peak_is_reported_with_the_growth_of_the_span():
+    with tracer.span('allocate'):
+        data = bytearray(64 * 1024 ** 2)
+        data[::4096] = b'x' * len(data[::4096])
+    record = tracer.get_records()[-1]
+    if record['process_peak_rss_mb'] is not None:
+        assert 0 <= record['peak_rss_growth_mb'] <= record['process_peak_rss_mb']
+        assert record['process_peak_rss_mb'] >= 64
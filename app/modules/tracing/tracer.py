@@ -0,0 +1,246 @@
+'''
+Lightweight tracing of the analysis steps.
+A span records the wall time of a named block of code, the peak memory of the
+process since it started (and how much the span raised it) and the number of items
+it handled; spans opened inside another one are its children. Spans finished inside
+a trace (see start_trace) carry its id, so the spans of one rerun of the app can be
+told apart from those of other sessions and background jobs. Finished spans are kept in memory for the app and
+appended to a JSON lines log, and a single action can be profiled with cProfile.
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import functools
+import itertools
+import threading
+import contextvars
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+from modules.constants import *
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_records = deque(maxlen=TRACE_MAX_RECORDS)
+_records_lock = threading.Lock()
+_log_lock = threading.Lock()
+# Open spans of the current thread or asyncio task, innermost last
+_open_spans = contextvars.ContextVar('open_spans', default=())
+# Trace of the current thread or asyncio task, asyncio tasks inherit it but new threads do not
+_current_trace = contextvars.ContextVar('trace_id', default=None)
+_span_ids = itertools.count(1)
+_trace_ids = itertools.count(1)
+
+
+def _get_process_peak_rss_mb():
+    # ru_maxrss is the peak of the whole process since it started, not of a span
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak_rss / 1024 ** 2 if sys.platform == 'darwin' else peak_rss / 1024
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.id = next(_span_ids)
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.peak_traced = 0
+
+    def set(self, **attributes):
+        '''
+        To add attributes to the span, e.g. the number of items it produced
+        '''
+        self.attributes.update(attributes)
+
+    def add(self, name, value):
+        '''
+        To add value to a numeric attribute, e.g. time spent in a part of the span
+        '''
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+
+class _NoSpan:
+    def set(self, **attributes):
+        pass
+
+    def add(self, name, value):
+        pass
+
+
+def _write_log(record):
+    try:
+        os.makedirs(os.path.dirname(PATH_TO_TRACE_LOG), exist_ok=True)
+        with _log_lock, open(PATH_TO_TRACE_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    except Exception as e:
+        print(f"Error writing trace log {PATH_TO_TRACE_LOG}: {e}")
+
+
+def _update_traced_peak(stack):
+    # tracemalloc only keeps one peak, so it is handed to the open spans before being reset
+    if stack and tracemalloc.is_tracing():
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_span in stack:
+            open_span.peak_traced = max(open_span.peak_traced, peak)
+        tracemalloc.reset_peak()
+
+
+@contextmanager
+def span(name, **attributes):
+    '''
+    To trace a block of code:
+
+        with tracer.span('cluster_maker.load_data', filename=filename) as current:
+            ...
+            current.set(items=len(comments_list))
+    '''
+    if not TRACE_ENABLED:
+        yield _NoSpan()
+        return
+
+    if TRACE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    stack = _open_spans.get()
+    _update_traced_peak(stack)
+    current = Span(name, stack[-1] if stack else None, attributes)
+    token = _open_spans.set(stack + (current,))
+    start_peak_rss = _get_process_peak_rss_mb()
+    started_at = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        _update_traced_peak(_open_spans.get())
+        _open_spans.reset(token)
+
+        process_peak_rss = _get_process_peak_rss_mb()
+        record = {'id': current.id,
+                  'trace_id': _current_trace.get(),
+                  'parent_id': current.parent.id if current.parent else None,
+                  'name': name,
+                  'depth': len(stack),
+                  'thread': threading.current_thread().name,
+                  'started_at': started_at,
+                  'seconds': seconds,
+                  'process_peak_rss_mb': process_peak_rss,
+                  'peak_rss_growth_mb': None if process_peak_rss is None else process_peak_rss - start_peak_rss,
+                  'peak_traced_mb': current.peak_traced / 1024 ** 2 if TRACE_MEMORY else None,
+                  'error': error}
+        record.update(current.attributes)
+
+        with _records_lock:
+            _records.append(record)
+        if TRACE_LOG:
+            _write_log(record)
+
+
+def traced(name=None):
+    '''
+    Decorator tracing every call of a function
+    '''
+    def decorator(function):
+        span_name = name or f'{function.__module__.split(".")[-1]}.{function.__name__}'
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+def current_span():
+    '''
+    To get the innermost open span of the calling thread or task, to set attributes on it
+    '''
+    stack = _open_spans.get()
+    return stack[-1] if stack and TRACE_ENABLED else _NoSpan()
+
+
+def timed_iter(iterable, current, attribute):
+    '''
+    To iterate over a lazy iterable, adding the time spent producing its items to an
+    attribute of the current span
+    '''
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            current.add(attribute, time.perf_counter() - start)
+            return
+        current.add(attribute, time.perf_counter() - start)
+        yield item
+
+
+def start_trace():
+    '''
+    To start a new trace in the calling thread or task: the spans it finishes from then on
+    (and those of the asyncio tasks it starts) get the returned id, to pass to get_records
+    '''
+    trace_id = next(_trace_ids)
+    _current_trace.set(trace_id)
+    return trace_id
+
+
+def get_records(trace_id=None):
+    '''
+    To get the finished spans kept in memory, oldest first, optionally only those of a trace from start_trace
+    '''
+    with _records_lock:
+        records = list(_records)
+    if trace_id is None:
+        return records
+    return [record for record in records if record['trace_id'] == trace_id]
+
+
+def clear():
+    '''
+    To forget the spans kept in memory
+    '''
+    with _records_lock:
+        _records.clear()
+
+
+@contextmanager
+def profile(name, num_lines=30):
+    '''
+    To profile a block of code with cProfile.
+    The stats are saved under PATH_TO_PROFILES and the yielded dictionary gets the path
+    and the num_lines most expensive functions, by cumulative time, as text.
+    '''
+    result = {'name': name, 'path': None, 'stats': ''}
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield result
+    finally:
+        profiler.disable()
+        os.makedirs(PATH_TO_PROFILES, exist_ok=True)
+        safe_name = ''.join(char if char.isalnum() else '_' for char in name)
+        result['path'] = os.path.join(PATH_TO_PROFILES, f'{time.strftime("%Y%m%d-%H%M%S")}_{safe_name}.prof')
+        profiler.dump_stats(result['path'])
+
+        stats_text = io.StringIO()
+        pstats.Stats(profiler, stream=stats_text).sort_stats('cumulative').print_stats(num_lines)
+        result['stats'] = stats_text.getvalue()
@@ -0,0 +1,56 @@
+'''
+Precompute the analysis of datasets without the app, e.g. overnight:
+
+    python run_pipeline.py                                  # every dataset, every stage
+    python run_pipeline.py "reviews.csv" --stages clusters emojis
+    python run_pipeline.py --query "battery life" --query "price" --workers 4
+
+Run it from the app directory. The results are written under data/results and the
+app loads them instead of recomputing.
+'''
+
+import sys
+import json
+import argparse
+
+sys.path.append('modules')
+
+from modules.pipeline import batch_pipeline
+from modules.constants import *
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze comment datasets without the app.')
+    parser.add_argument('datasets', nargs='*', help='dataset files under data/ (default: all of them)')
+    parser.add_argument('--stages', nargs='+', choices=PIPELINE_STAGES, default=PIPELINE_STAGES, help='stages to run (default: all)')
+    parser.add_argument('--query', action='append', default=[], dest='queries', help='query to fetch related comments for, can be repeated')
+    parser.add_argument('--workers', type=int, default=PIPELINE_MAX_WORKERS, help='datasets analyzed at the same time')
+    parser.add_argument('--force', action='store_true', help='recompute stages that already have results')
+    parser.add_argument('--summary', help='write the summary of every dataset to this JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    def report(summary):
+        if summary['error']:
+            failed_stage = f" at {summary['failed_stage']}" if summary['failed_stage'] else ''
+            print(f"{summary['filename']}: failed{failed_stage}, {summary['error']}")
+        else:
+            stages = ', '.join(f'{stage} {seconds:.1f}s' for stage, seconds in summary['stages'].items()) or 'up to date'
+            print(f"{summary['filename']}: {stages}")
+
+    summaries = batch_pipeline.run_pipeline(args.datasets or None, args.stages, args.queries, args.workers, args.force, report)
+
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(summaries, f, indent=2, ensure_ascii=False)
+
+    failed = [summary for summary in summaries if summary['error']]
+    print(f"Analyzed {len(summaries) - len(failed)} of {len(summaries)} datasets")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,15 +2,24 @@ import os
 import sys
 import time
 import base64
+from contextlib import contextmanager
 from PIL import Image
 
 sys.path.append('data')
 sys.path.append('modules')
 
 from modules.commentsextractor import run_comments_collector
-from modules.clustering import cluster_maker, chart_maker
+from modules.clustering import cluster_maker, chart_maker, topic_store
 from modules.emojitask import emoji_extractor
 from modules.retrieval import relevant_comments
+from modules.models import model_registry
+from modules.datasets import dataset_store
+from modules.embeddings import embedding_store
+from modules.cache import dataset_cache
+from modules.terms import term_index
+from modules.pipeline import batch_pipeline
+from modules.tracing import tracer
+from modules.jobs import job_runner
 from modules.constants import *
 
 import streamlit as st
@@ -18,12 +27,6 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 import nltk
-from nltk.corpus import stopwords
-from textblob import TextBlob
-
-# For text preprocessing
-from collections import Counter
-import re
 
 IMAGES_PATH = os.path.join(os.path.dirname(__file__), 'images')
 
@@ -32,15 +35,42 @@ st.sidebar.image(os.path.join(IMAGES_PATH, 'logo.png'), width=250)
 st.sidebar.title('MoodMap')
 st.empty()
 
+# Spans of this trace were run by this rerun, not by other sessions or background jobs
+trace_id = tracer.start_trace()
+
 # Download the stopwords list if not already available
 nltk.download('stopwords')
-STOP_WORDS = set(stopwords.words('english'))
 
-def preprocess_text(text):
-    '''Simple text preprocessing to remove non-alphanumeric characters and filter stop words.'''
-    words = re.findall(r'\b\w+\b', text.lower())
-    meaningful_words = [word for word in words if word not in STOP_WORDS]
-    return meaningful_words
+# Models are loaded once per process, later reruns reuse them
+if WARM_UP_MODELS:
+    with st.spinner('Loading models...'):
+        model_registry.warm_up()
+
+# Reruns the script, to poll the background jobs of the session
+rerun = getattr(st, 'rerun', None) or st.experimental_rerun
+
+# Cached under this name with the clustering parameters when no saved topics were found for them
+NO_STORED_TOPICS = 'no_stored_topics'
+
+
+def fetch_comments_job(job, url, refresh):
+    '''Fetch the comments of a video, in a background job.'''
+    def report(url, status, details):
+        if status == 'page':
+            job.report('Fetching comments', details['num_comments'])
+
+    return run_comments_collector.collect_comments([url], refresh=refresh, progress_callback=report)[0]
+
+
+def get_topics_job(job, dataset, name, threshold, min_community_size):
+    '''Get the topics of a cached dataset and their summaries, in a background job.'''
+    index = dataset_cache.get_result(dataset, 'term_index', lambda: term_index.get_term_index(dataset['filename'], dataset['long_comments_list']))
+    topics = dataset_cache.get_result(dataset, name, lambda: topic_store.get_topics(dataset['filename'], dataset['long_comments_list'], comment_ids=dataset['comment_ids'], progress_callback=job.report,
+                                                                                    threshold=threshold, min_community_size=min_community_size, index=index))
+    # The neighbour lists saved with these topics may give the topics of other parameters
+    dataset_cache.drop_results(dataset, [result for result in list(dataset['results']) if isinstance(result, tuple) and result[0] == NO_STORED_TOPICS])
+    return topics
+
 
 class Starter:
     def __init__(self):
@@ -49,39 +79,153 @@ class Starter:
         self.short_comments_list = None
         self.long_comments_list = None
         self.df = None
-        self.all_clusters = None
+        self.comment_ids = None
+        self.dataset = None
+        self.topics = None
         self.top_emojis = None
-
-    def get_data_from_url(self, url):
-        video_titles = run_comments_collector.get_comments_from_urls([url])
-        return video_titles[0]
+        # Actions are profiled with cProfile while the 'Profile actions' box is ticked
+        self.profile_actions = st.session_state.get('profile_actions', False)
+        self.profiles = []
+        # Background jobs of this session still running on this rerun
+        self.running_jobs = []
+
+    @contextmanager
+    def trace_action(self, name):
+        '''Trace a UI action, and profile it when asked to.'''
+        with tracer.span(f'ui.{name}', filename=self.data_file_selected):
+            if self.profile_actions:
+                with tracer.profile(name) as profile:
+                    yield
+                self.profiles.append(profile)
+            else:
+                yield
+
+    def show_performance_panel(self):
+        '''Show the timings of everything this rerun ran, and the profiles taken.'''
+        st.sidebar.subheader('Performance')
+        show_timings = st.sidebar.checkbox('Show timings', key='show_timings')
+        st.sidebar.checkbox('Profile actions', key='profile_actions')
+
+        if show_timings:
+            records = sorted(tracer.get_records(trace_id), key=lambda record: record['started_at'])
+            if records:
+                st.sidebar.dataframe(pd.DataFrame({'Step': ['  ' * record['depth'] + record['name'] for record in records],
+                                                   'Seconds': [round(record['seconds'], 3) for record in records],
+                                                   'Items': [record.get('items') for record in records],
+                                                   'Process peak MB': [record['process_peak_rss_mb'] for record in records]}))
+            else:
+                st.sidebar.write('Nothing was run on this rerun.')
+
+        for profile in self.profiles:
+            with st.expander(f"Profile of {profile['name']} (saved to {profile['path']})"):
+                st.text(profile['stats'])
+
+    def show_job(self, state_key, container):
+        '''Show the progress of the background job of this session saved under state_key, and get it once it has finished.'''
+        job = job_runner.get_job(st.session_state.get(state_key))
+        if job is None:
+            st.session_state.pop(state_key, None)
+            return None
+
+        if not job.is_finished:
+            container.write(job.get_status_text())
+            if job.progress is not None:
+                container.progress(int(job.progress * 100))
+            self.running_jobs.append(job)
+            return None
+
+        # A finished job is reported once
+        del st.session_state[state_key]
+        return job
+
+    def poll_jobs(self):
+        '''Rerun the script after a while as long as a job of this session is running.'''
+        if self.running_jobs:
+            time.sleep(JOB_POLL_INTERVAL)
+            rerun()
 
     def get_list_of_data_files(self):
-        file_list = os.listdir('data/')
-        return [str(filename) for filename in file_list if str(filename).endswith('.csv')]
-
-    def get_sentences_in_cluster(self, cluster):
-        sentences = set()
-        num = 0
-        for sentence_id in cluster:
-            if num >= 5:
-                break
-            if self.long_comments_list[sentence_id] not in sentences:
-                sentences.add(self.long_comments_list[sentence_id])
-                num += 1
-        return sentences
+        return dataset_store.list_datasets()
+
+    def load_dataset(self):
+        '''Get the selected dataset from the cache shared by every rerun and session, loading it on first use.'''
+        if not self.data_file_selected:
+            self.short_comments_list, self.long_comments_list, self.df = [], [], None
+            return
+
+        self.dataset = dataset_cache.get_dataset(self.data_file_selected)
+        self.short_comments_list = self.dataset['short_comments_list']
+        self.long_comments_list = self.dataset['long_comments_list']
+        self.df = self.dataset['df']
+        self.comment_ids = self.dataset['comment_ids']
+
+    def get_result(self, name, compute):
+        '''Get a result computed from the selected dataset, computing it only once.'''
+        if self.dataset is None:
+            return compute()
+        return dataset_cache.get_result(self.dataset, name, compute)
+
+    def has_result(self, name):
+        return self.dataset is not None and dataset_cache.has_result(self.dataset, name)
+
+    def get_term_index(self):
+        '''Get the term-frequency index of the selected dataset, saved with it and extended as comments are added.'''
+        return self.get_result('term_index', lambda: term_index.get_term_index(self.data_file_selected, self.long_comments_list))
+
+    def get_corpus_key(self):
+        '''Get the key of the selected dataset in the embedding store, hashed once per version of it.'''
+        return self.get_result('corpus_key', lambda: embedding_store.get_dataset_corpus_key(self.data_file_selected, self.long_comments_list))
+
+    def get_topics_name(self, threshold, min_community_size):
+        '''Get the name the topics for these parameters are cached under.'''
+        return ('topics', threshold, min_community_size)
+
+    def get_stored_topics(self, threshold, min_community_size):
+        '''
+        Get the topics for these parameters from the saved topics and neighbour lists, or None.
+        A miss is cached with the dataset, so reruns do not look again until topics are computed.
+        '''
+        missing_name = (NO_STORED_TOPICS, threshold, min_community_size)
+        if self.dataset is None or self.has_result(missing_name):
+            return None
+        stored_topics = topic_store.get_topics(self.data_file_selected, self.long_comments_list, comment_ids=self.comment_ids, threshold=threshold, min_community_size=min_community_size,
+                                               stored_only=True, corpus_key=self.get_corpus_key(), index=self.get_term_index() if self.has_result('term_index') else None)
+        if stored_topics is None:
+            self.get_result(missing_name, lambda: True)
+        return stored_topics
+
+    def get_sentiments(self, stats=None):
+        '''Get the polarity of every comment of the selected dataset, scored once and shared by every view.'''
+        return self.get_result('sentiment', lambda: batch_pipeline.get_sentiments(self.df, stats=stats))
+
+    def get_statistics(self):
+        '''Compute everything shown in the Statistics panel.'''
+        sentiment_stats = {}
+        return batch_pipeline.get_statistics(self.df, self.long_comments_list, self.get_term_index(),
+                                             sentiments=self.get_sentiments(sentiment_stats), sentiment_stats=sentiment_stats)
 
     def run_all(self):
         st.sidebar.subheader('Fetch comments from URL')
         url_input = st.sidebar.text_input(label='Enter a YouTube Video URL')
+        only_new_comments = st.sidebar.checkbox('Only fetch new comments')
 
         if st.sidebar.button('Get and Load'):
             if not url_input:
                 st.sidebar.error('URL cannot be empty!')
             else:
-                with st.spinner('Fetching comments...'):
-                    video_title = self.get_data_from_url(url_input)
-                    st.sidebar.success(f'Comments fetched from "{video_title}"! Now select it from the below list.')
+                # Sessions fetching the same video share one job
+                job = job_runner.submit('fetch', (run_comments_collector.get_id(url_input), only_new_comments), fetch_comments_job, url_input, only_new_comments, description='Fetching comments')
+                st.session_state['fetch_job'] = job.id
+
+        fetch_job = self.show_job('fetch_job', st.sidebar)
+        if fetch_job:
+            if fetch_job.status != job_runner.DONE:
+                st.sidebar.error(f'Could not fetch comments from this URL: {fetch_job.error}')
+            elif fetch_job.result['error']:
+                # Comments fetched before an interruption are saved, fetching the video again resumes
+                st.sidebar.error(f"Could not fetch comments from {fetch_job.result['url']}: {fetch_job.result['error']}")
+            else:
+                st.sidebar.success(f'Comments fetched from "{fetch_job.result["title"]}"! Now select it from the below list.')
 
         st.sidebar.write('OR')
 
@@ -89,12 +233,11 @@ class Starter:
         st.sidebar.subheader('Load data from an existing file')
         self.data_file_selected = st.sidebar.selectbox(label='Select the data to load:', options=self.list_of_files)
         st.sidebar.write(f'Selected: {self.data_file_selected}')
-        self.short_comments_list, self.long_comments_list, self.df = cluster_maker.load_data(self.data_file_selected)
+        with self.trace_action('load_dataset'):
+            self.load_dataset()
 
         if st.sidebar.button('Load'):
-            with st.spinner('Loading data...'):
-                time.sleep(0.5)
-                st.success('Data loaded!')
+            st.success('Data loaded!')
 
         if st.sidebar.checkbox('Show dataframe'):
             with st.expander('See Dataframe:'):
@@ -108,43 +251,60 @@ class Starter:
 
         with st.container():
             st.sidebar.subheader('Find different topics from comments')
+            threshold = round(st.sidebar.slider('Similarity of comments in a topic:', min_value=NEIGHBOUR_MIN_THRESHOLD, max_value=0.99, value=CLUSTER_THRESHOLD, step=0.01), 2)
+            min_community_size = st.sidebar.slider('Minimum comments in a topic:', min_value=2, max_value=100, value=CLUSTER_MIN_COMMUNITY_SIZE)
             start_clustering_btn = st.sidebar.button('Get topics')
+            topics_name = self.get_topics_name(threshold, min_community_size)
+
+            # Saved topics are loaded, and once the neighbour lists of the dataset are saved,
+            # topics for other parameters are derived from them at once
+            if self.dataset is not None and not self.has_result(topics_name):
+                stored_topics = self.get_stored_topics(threshold, min_community_size)
+                if stored_topics is not None:
+                    self.get_result(topics_name, lambda: stored_topics)
+
+            if start_clustering_btn and not self.has_result(topics_name):
+                if self.dataset is None:
+                    st.error('No data loaded!')
+                else:
+                    # Clustering runs in the background, sessions clustering the same version of a dataset share one job
+                    job = job_runner.submit('clusters', (self.data_file_selected, *dataset_store.get_dataset_version(self.data_file_selected), threshold, min_community_size),
+                                            get_topics_job, self.dataset, topics_name, threshold, min_community_size, description=f'Getting topics of {self.data_file_selected}')
+                    st.session_state['clusters_job'] = job.id
 
-            if start_clustering_btn:
-                with st.spinner('Getting topics...'):
-                    time.sleep(1)
-                    # Run clustering
-                    self.all_clusters = cluster_maker.get_clusters_from_file(self.data_file_selected, self.long_comments_list)
+            clusters_job = self.show_job('clusters_job', st)
+            if clusters_job and clusters_job.status == job_runner.FAILED:
+                st.error(f'Could not get topics: {clusters_job.error}')
+
+            # Topics stay on screen once they have been computed for this dataset
+            if self.has_result(topics_name):
+                with self.trace_action('get_topics'):
+                    self.topics = self.get_result(topics_name, dict)
+                    summaries = self.topics.get('summaries', [])
 
                     # Check if clusters are found
-                    if not self.all_clusters or len(self.all_clusters) == 0:
+                    if not summaries:
                         st.error("No clusters found. Please try clustering again.")
                     else:
-                        st.success(f"Found {len(self.all_clusters)} clusters!")
+                        st.success(f"Found {len(summaries)} clusters!")
                         with st.expander('Topics talked about from the comments:', expanded=True):
-                            for i in range(1, 20, 2):
-                                c1, c2 = st.columns(2)
-                                try:
-                                    curr_cluster1 = self.all_clusters[i-1]
-                                    curr_cluster2 = self.all_clusters[i]
-                                    with c1:
-                                        st.subheader(f'Topic {i}:')
-                                        st.write(list(self.get_sentences_in_cluster(curr_cluster1)))
-
-                                    with c2:
-                                        st.subheader(f'Topic {i+1}:')
-                                        st.write(list(self.get_sentences_in_cluster(curr_cluster2)))
-                                except Exception as e:
-                                    pass 
-
-                    st.plotly_chart(chart_maker.get_donut_of_topics(self.all_clusters))
+                            # Summaries were computed with the topics, showing them is only a lookup
+                            for i in range(0, min(len(summaries), 20), 2):
+                                for column, topic_number in zip(st.columns(2), range(i, min(i + 2, len(summaries)))):
+                                    summary = summaries[topic_number]
+                                    with column:
+                                        st.subheader(f'Topic {topic_number + 1}:')
+                                        st.caption(f"{summary['size']} comments - " + ', '.join(word for word, _ in summary['keywords']))
+                                        st.write(summary['representatives'])
+
+                        st.plotly_chart(chart_maker.get_donut_of_topics([summary['size'] for summary in summaries]))
 
         with st.container():
             st.sidebar.subheader('Find top emojis from the comments')
             count_of_emojis = st.sidebar.slider('Top:', min_value=3, max_value=10)
             if st.sidebar.button('Get'):
-                with st.spinner('Getting top emojis...'):
-                    self.top_emojis = emoji_extractor.get_most_freq_emojis(self.short_comments_list, 10)
+                with st.spinner('Getting top emojis...'), self.trace_action('top_emojis'):
+                    self.top_emojis = self.get_result('top_emojis', lambda: emoji_extractor.get_most_freq_emojis(self.short_comments_list, 10))
                     with st.expander(label=f'Top {count_of_emojis} emojis:', expanded=True):
                         st.write(self.top_emojis[:count_of_emojis])
 
@@ -152,8 +312,9 @@ class Starter:
             st.sidebar.subheader('Enter a query to fetch related comments')
             query = st.sidebar.text_input('Type here.')
             if st.sidebar.button('Get comments'):
-                with st.spinner('Fetching comments...'):
-                    hits = relevant_comments.get_relevant_comments(query, self.data_file_selected, self.long_comments_list)
+                with st.spinner('Fetching comments...'), self.trace_action('related_comments'):
+                    hits = self.get_result(('hits', query), lambda: relevant_comments.get_relevant_comments(query, self.data_file_selected, self.long_comments_list, comment_ids=self.comment_ids,
+                                                                                                                                 corpus_key=self.get_corpus_key()))
                     st.write([self.long_comments_list[hit['corpus_id']] for hit in hits])
 
         with st.container():
@@ -161,38 +322,40 @@ class Starter:
             show_stats_btn = st.sidebar.button('Show')
 
             if show_stats_btn:
-                if not self.df.empty:
-                    with st.spinner('Calculating statistics...'):
-                        total_comments = len(self.long_comments_list)
-                        avg_comment_length = sum(len(comment) for comment in self.long_comments_list) / total_comments
-                        top_comments = self.df.nlargest(5, 'Like Count')[['Comment', 'Like Count']]
-                        unique_authors = self.df['Author'].nunique()
+                if self.df is not None and not self.df.empty:
+                    with st.spinner('Calculating statistics...'), self.trace_action('statistics'):
+                        stats = self.get_result('statistics', self.get_statistics)
 
                         with st.expander('Statistics Summary', expanded=True):
-                            st.write(f"**Total comments:** {total_comments}")
-                            st.write(f"**Average comment length:** {avg_comment_length:.2f} characters")
-                            st.write(f"**Total unique authors:** {unique_authors}")
+                            st.write(f"**Total comments:** {stats['total_comments']}")
+                            st.write(f"**Average comment length:** {stats['avg_comment_length']:.2f} characters")
+                            st.write(f"**Total unique authors:** {stats['unique_authors']}")
                             st.write("Top 5 Most Liked Comments:")
-                            st.write(top_comments)
+                            st.write(stats['top_comments'])
 
                         st.subheader("Top 10 Most Frequent Words")
-                        all_words = [word for comment in self.long_comments_list for word in preprocess_text(comment)]
-                        word_freq = Counter(all_words)
-                        words_df = pd.DataFrame(word_freq.most_common(10), columns=['Word', 'Frequency'])
                         fig, ax = plt.subplots()
-                        sns.barplot(data=words_df, x='Frequency', y='Word', ax=ax)
+                        sns.barplot(data=stats['words_df'], x='Frequency', y='Word', ax=ax)
                         ax.set_title("Top 10 Frequent Words")
                         st.pyplot(fig)
 
-                        sentiments = [TextBlob(comment).sentiment.polarity for comment in self.long_comments_list]
-                        sentiment_labels = ['Positive' if s > 0 else 'Negative' if s < 0 else 'Neutral' for s in sentiments]
-                        sentiment_df = pd.DataFrame({'Sentiment': sentiment_labels})
+                        st.subheader("Top 10 Most Frequent Bigrams")
+                        fig, ax = plt.subplots()
+                        sns.barplot(data=stats['bigrams_df'], x='Frequency', y='Bigram', ax=ax)
+                        ax.set_title("Top 10 Frequent Bigrams")
+                        st.pyplot(fig)
+
                         fig, ax = plt.subplots()
-                        sentiment_df['Sentiment'].value_counts().plot.pie(autopct='%1.1f%%', ax=ax)
+                        stats['sentiment_counts'].plot.pie(autopct='%1.1f%%', ax=ax)
                         ax.set_title("Sentiment Distribution")
                         st.pyplot(fig)
+                        if stats.get('sentiment_throughput'):
+                            st.write(f"*Sentiment scored at {stats['sentiment_throughput']:,.0f} comments/sec*")
                 else:
                     st.error('No data loaded!')
 
+        self.show_performance_panel()
+        self.poll_jobs()
+
 starter = Starter()
 starter.run_all()
\ No newline at end of file